@@ -0,0 +1,88 @@
+"""
+Measures ingest throughput (rows/sec) of the SQLite storage adapter for batch sizes 1 to 10k.
+
+Compares the per-row path (`insert_measurement`, one autocommitted INSERT per value) with the
+group-commit path (`insert_measurements`, one executemany transaction per batch).
+
+Run from the repository root:
+
+	python -m benchmarks.batch_insert
+	python -m benchmarks.batch_insert --sizes 1 10 100 --repeat 5
+"""
+import argparse
+import pathlib
+import random
+import tempfile
+import time
+from datetime import datetime
+from itertools import count
+from typing import Callable, Iterator, List
+
+from storage.models import Measurement
+from storage.sqlite_api.driver import MeasurementsDBAdapter
+
+DEFAULT_SIZES = [1, 10, 100, 1000, 10000]
+
+
+def generate_batch(size:int, station:str) -> List[Measurement]:
+	now = datetime.now()
+	return [Measurement(key = station,
+						measurement_name = "Temperature",
+						unit = "C",
+						value = random.random() * 50,
+						timestamp = datetime.fromtimestamp(1600000000 + i),
+						receipt_time = now,
+						latitude = (random.random() - .5) * 10,
+						longitude = (random.random() - .5) * 10,
+						hardware = "Thermometer")
+			for i in range(size)]
+
+
+def time_insert(insert:Callable[[List[Measurement]], int], batches:Iterator[List[Measurement]], repeat:int) -> float:
+	"""
+	Returns the best rows/sec over `repeat` runs, each inserting the next of `batches`. Every batch has to be
+	new to the table: re-sent samples are ignored by the unique index and would only time that check.
+	"""
+	best = 0.0
+	for _ in range(repeat):
+		batch = next(batches)
+		t1 = time.perf_counter()
+		inserted = insert(batch)
+		t2 = time.perf_counter()
+		assert inserted == len(batch), f"only {inserted} of {len(batch)} rows were new"
+		best = max(best, len(batch) / (t2 - t1))
+	return best
+
+
+def run(sizes:List[int], repeat:int, per_row_limit:int) -> None:
+	with tempfile.TemporaryDirectory() as tmp:
+		adapter = MeasurementsDBAdapter(db_path = str(pathlib.Path(tmp) / "bench.db"), echo = False)
+
+		def per_row(batch:List[Measurement]) -> int:
+			for m in batch:
+				adapter.insert_measurement(m)
+			return len(batch)
+
+		# A station of its own for every batch, so nothing collides with rows inserted earlier.
+		stations = count()
+		batches = lambda size: (generate_batch(size, station = f"bench {size}/{next(stations)}") for _ in iter(int, 1))
+
+		print(f"{'batch size':>10} {'per-row rows/s':>16} {'executemany rows/s':>20} {'speedup':>8}")
+		for size in sizes:
+			bulk = time_insert(adapter.insert_measurements, batches(size), repeat)
+			if size <= per_row_limit:
+				single = time_insert(per_row, batches(size), repeat)
+				print(f"{size:>10} {single:>16.0f} {bulk:>20.0f} {bulk / single:>7.1f}x")
+			else:
+				print(f"{size:>10} {'skipped':>16} {bulk:>20.0f} {'-':>8}")
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--sizes", type = int, nargs = "+", default = DEFAULT_SIZES)
+	parser.add_argument("--repeat", type = int, default = 3)
+	parser.add_argument("--per-row-limit", type = int, default = 10000,
+						help = "Skip the per-row baseline for batches larger than this.")
+	args = parser.parse_args()
+
+	run(args.sizes, args.repeat, args.per_row_limit)
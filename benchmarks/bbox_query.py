@@ -0,0 +1,124 @@
+"""
+Compares lat/lon bounding-box query latency with and without the R*Tree spatial index of the SQLite driver.
+
+"with index"     `MeasurementsDBAdapter.get_bounded`, which answers the box from measurements_rtree.
+"without index"  The same filters as plain latitude/longitude/timestamp predicates on measurements.
+
+Run from the repository root (10M rows takes a few minutes to load and about 2 GB of disk):
+
+	python -m benchmarks.bbox_query
+	python -m benchmarks.bbox_query --rows 1000000 --queries 20
+"""
+import argparse
+import pathlib
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import and_
+
+from storage.models import MeasurementsQuery
+from storage.sqlite_api.driver import MeasurementsDBAdapter
+
+START = 1600000000
+SPAN = 365 * 86400
+
+
+def load(adapter:MeasurementsDBAdapter, rows:int, batch:int = 100000) -> None:
+	"""
+	Drones wandering around the globe: random positions and times, written straight through executemany until
+	the table holds `rows` rows. Samples are unique per (key, measurement_name, timestamp), so the rare random
+	repeat is skipped with INSERT OR IGNORE and made up for by the next batch.
+	"""
+	raw = adapter.engine.raw_connection()
+	try:
+		stored = raw.execute("SELECT count(*) FROM measurements").fetchone()[0]
+		# Seeded by what is already there, so topping up a database does not regenerate the same rows.
+		rng = np.random.default_rng(stored)
+		while stored < rows:
+			n = min(batch, rows - stored)
+			timestamps = rng.integers(START, START + SPAN, n)
+			lats = rng.uniform(-80, 80, n)
+			lons = rng.uniform(-180, 180, n)
+			values = rng.uniform(-10, 40, n)
+			stations = rng.integers(0, 1000, n)
+			cursor = raw.executemany("""INSERT OR IGNORE INTO measurements (key, measurement_name, unit, value, timestamp,
+																		 receipt_time, latitude, longitude, hardware)
+										VALUES (?, 'Temperature', 'C', ?, ?, ?, ?, ?, 'Thermometer')""",
+									 ((f"drone {s}", v, t, t, la, lo) for s, v, t, la, lo in
+									  zip(stations.tolist(), values.tolist(), timestamps.tolist(), lats.tolist(), lons.tolist())))
+			raw.commit()
+			stored += cursor.rowcount
+			print(f"\rloaded {stored}/{rows}", end = "", flush = True)
+		print()
+	finally:
+		raw.close()
+
+
+def random_box(rng:random.Random, size:float) -> Tuple[Tuple[float, float], Tuple[float, float]]:
+	lat = rng.uniform(-80, 80 - size)
+	lon = rng.uniform(-180, 180 - size)
+	return (lat, lat + size), (lon, lon + size)
+
+
+def random_window(rng:random.Random, days:int) -> Tuple[datetime, datetime]:
+	start = rng.randrange(START, START + SPAN - days * 86400)
+	return datetime.fromtimestamp(start), datetime.fromtimestamp(start + days * 86400)
+
+
+def without_index(adapter:MeasurementsDBAdapter, query:MeasurementsQuery) -> int:
+	m = adapter.measurements.c
+	criteria = [m.latitude > query.lats[0], m.latitude < query.lats[1],
+				m.longitude > query.lons[0], m.longitude < query.lons[1]]
+	if query.time_range is not None:
+		criteria += [m.timestamp > query.time_range[0], m.timestamp < query.time_range[1]]
+	sel = adapter.measurements.select().where(and_(*criteria)).order_by(m.timestamp, m.id)
+	return len(adapter.conn.execute(sel).fetchall())
+
+
+def with_index(adapter:MeasurementsDBAdapter, query:MeasurementsQuery) -> int:
+	return sum(len(chunk) for chunk in adapter.iter_bounded_chunks(query))
+
+
+def measure(run:Callable[[MeasurementsQuery], int], queries:List[MeasurementsQuery]) -> Tuple[float, float, float]:
+	latencies = []
+	rows = 0
+	for query in queries:
+		t1 = time.perf_counter()
+		rows += run(query)
+		latencies.append((time.perf_counter() - t1) * 1000)
+	return statistics.median(latencies), max(latencies), rows / len(queries)
+
+
+def main(rows:int, queries:int, db:Optional[str]) -> None:
+	with tempfile.TemporaryDirectory() as tmp:
+		path = db or str(pathlib.Path(tmp) / "bbox.db")
+		adapter = MeasurementsDBAdapter(db_path = path, echo = False)
+		load(adapter, rows)
+
+		rng = random.Random(1)
+		cases = {"1 deg box": [MeasurementsQuery(lats = b[0], lons = b[1]) for b in (random_box(rng, 1) for _ in range(queries))],
+				 "5 deg box": [MeasurementsQuery(lats = b[0], lons = b[1]) for b in (random_box(rng, 5) for _ in range(queries))],
+				 "5 deg box, 7 days": [MeasurementsQuery(lats = b[0], lons = b[1], time_range = random_window(rng, 7))
+									   for b in (random_box(rng, 5) for _ in range(queries))]}
+
+		print(f"{rows} rows, {queries} queries per case, latency in ms")
+		print(f"{'case':<20} {'rows/query':>10} {'no index p50':>13} {'max':>8} {'rtree p50':>10} {'max':>8} {'speedup':>8}")
+		for name, case in cases.items():
+			slow_p50, slow_max, hits = measure(lambda q: without_index(adapter, q), case)
+			fast_p50, fast_max, _ = measure(lambda q: with_index(adapter, q), case)
+			print(f"{name:<20} {hits:>10.0f} {slow_p50:>13.1f} {slow_max:>8.1f} {fast_p50:>10.1f} {fast_max:>8.1f} {slow_p50 / fast_p50:>7.1f}x")
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--rows", type = int, default = 10000000)
+	parser.add_argument("--queries", type = int, default = 10)
+	parser.add_argument("--db", default = None, help = "Reuse (and top up) this database instead of a temporary one.")
+	args = parser.parse_args()
+
+	main(args.rows, args.queries, args.db)
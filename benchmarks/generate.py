@@ -0,0 +1,111 @@
+"""
+Writes a reproducible synthetic history into an SQLite measurements database: `--stations` stations at fixed
+positions, each reporting every channel of CHANNELS once per `--interval` seconds, up to `--rows` rows in
+total and ending now or at `--end`. The same seed and end always produce the same rows.
+
+Run from the repository root (1M rows take about a minute; 100M rows need about 20 GB of disk):
+
+	python -m benchmarks.generate --db /tmp/bench.db --rows 1000000
+	python -m benchmarks.generate --db /tmp/bench.db --rows 100000000 --stations 10000
+
+The server reads the file directly with `storage.partition: none` in configs/server_config.yaml, or after
+`python -m storage.sqlite_api.partitioned import /tmp/bench.db` for partitioned storage.
+"""
+import argparse
+import time
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from storage.sqlite_api.driver import MeasurementsDBAdapter
+
+# (measurement_name, unit, hardware, mean, daily amplitude, noise)
+CHANNELS = [("Temperature", "C", "BME280", 15.0, 8.0, 0.5),
+			("Humidity", "%", "BME280", 60.0, 15.0, 2.0),
+			("Pressure", "hPa", "BME280", 1013.0, 2.0, 0.3),
+			("Wind speed", "m/s", "Anemometer", 4.0, 2.0, 1.5),
+			("PM2.5", "ug/m3", "SDS011", 12.0, 6.0, 3.0)]
+
+
+def station_keys(stations:int) -> List[str]:
+	return [f"bench station {i}" for i in range(stations)]
+
+
+def generate_chunks(rows:int, stations:int = 1000, interval:int = 60, seed:int = 0,
+					end:Optional[int] = None, chunk_size:int = 100000) -> Iterator[List[Tuple]]:
+	"""
+	Rows as (key, measurement_name, unit, value, timestamp, receipt_time, latitude, longitude, hardware)
+	tuples, one reporting interval after the other, `chunk_size` at a time.
+	"""
+	rng = np.random.default_rng(seed)
+	keys = station_keys(stations)
+	lats = rng.uniform(-60, 70, stations)
+	lons = rng.uniform(-180, 180, stations)
+	# Stations do not report in lockstep.
+	offsets = rng.integers(0, interval, stations)
+
+	per_tick = stations * len(CHANNELS)
+	ticks = -(-rows // per_tick)
+	end = int(time.time()) if end is None else end
+	start = end - ticks * interval
+
+	station_index = np.repeat(np.arange(stations), len(CHANNELS))
+	channel_index = np.tile(np.arange(len(CHANNELS)), stations)
+	means, amplitudes, noise = (np.array([c[i] for c in CHANNELS])[channel_index] for i in (3, 4, 5))
+
+	written = 0
+	pending:List[Tuple] = []
+	for tick in range(ticks):
+		n = min(per_tick, rows - written)
+		timestamps = start + tick * interval + offsets[station_index[:n]]
+		phase = 2 * np.pi * (timestamps % 86400) / 86400
+		values = means[:n] + amplitudes[:n] * np.sin(phase) + rng.normal(0, 1, n) * noise[:n]
+		receipt_times = timestamps + rng.integers(0, 5, n)
+
+		pending += [(keys[s], CHANNELS[c][0], CHANNELS[c][1], v, t, r, float(lats[s]), float(lons[s]), CHANNELS[c][2])
+					for s, c, v, t, r in zip(station_index[:n].tolist(), channel_index[:n].tolist(), values.tolist(),
+											 timestamps.tolist(), receipt_times.tolist())]
+		written += n
+		while len(pending) >= chunk_size:
+			yield pending[:chunk_size]
+			pending = pending[chunk_size:]
+	if pending:
+		yield pending
+
+
+def load(adapter:MeasurementsDBAdapter, chunks:Iterator[List[Tuple]]) -> int:
+	"""
+	Writes rows straight through executemany, one transaction per chunk. Triggers keep latest_station,
+	rollups and the R*Tree up to date as for any other insert.
+	"""
+	written = 0
+	raw = adapter.engine.raw_connection()
+	try:
+		for chunk in chunks:
+			raw.executemany("""INSERT INTO measurements (key, measurement_name, unit, value, timestamp, receipt_time,
+													  latitude, longitude, hardware)
+							   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""", chunk)
+			raw.commit()
+			written += len(chunk)
+			print(f"\rloaded {written}", end = "", flush = True)
+		print()
+	finally:
+		raw.close()
+	return written
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--db", required = True)
+	parser.add_argument("--rows", type = int, default = 1000000)
+	parser.add_argument("--stations", type = int, default = 1000)
+	parser.add_argument("--interval", type = int, default = 60, help = "Seconds between two readings of a station.")
+	parser.add_argument("--seed", type = int, default = 0)
+	parser.add_argument("--end", type = int, default = None, help = "Epoch seconds of the last reading. Defaults to now.")
+	args = parser.parse_args()
+
+	t1 = time.perf_counter()
+	rows = load(MeasurementsDBAdapter(db_path = args.db, echo = False),
+				generate_chunks(args.rows, stations = args.stations, interval = args.interval, seed = args.seed,
+								end = args.end))
+	print(f"{rows} rows in {time.perf_counter() - t1:.0f} s")
@@ -0,0 +1,265 @@
+"""
+Drives the upload and download endpoints with concurrent requests and reports throughput and
+p50/p95/p99 latency per endpoint. Results are written as JSON; with `--baseline` they are compared with an
+earlier results file.
+
+"sensor"                POST /api/v0p2/sensor, one value per request
+"sensor/batch"          POST /api/v0p2/sensor/batch, `--batch` values per request
+"sensor_by_id"          GET /api/v0p2/sensor_by_id/{key}, one hour of a random station, at most 1000 rows
+"sensor_by_id/history"  The same for a whole hour 1 to 24 hours before the latest sample of one of 20
+						stations, like dashboards re-reading closed windows
+"list_stations"         GET /api/v0p2/list_stations
+
+Uploads are acknowledged once they are in the ingest queue, so their numbers are accept rates. Against a
+running server (`--url http://localhost:8080`) the server's own storage is used. Without `--url` the app
+runs in-process on `--db`, which is generated first (see benchmarks.generate) if it does not exist yet;
+`--no-range-cache` and `--no-hot-tier` leave those layers out. The range cache counters of the server's
+/metrics are reported with the results, unless the range cache was left out.
+
+Run from the repository root:
+
+	python -m benchmarks.load --db /tmp/bench.db --rows 1000000 --output results.json
+	python -m benchmarks.load --db /tmp/bench.db --output new.json --baseline results.json
+	python -m benchmarks.load --url http://localhost:8080 --requests 5000 --concurrency 32
+"""
+import argparse
+import datetime
+import json
+import pathlib
+import platform
+import random
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import requests
+
+from benchmarks.generate import CHANNELS, generate_chunks, load
+
+SCENARIOS = ["sensor", "sensor/batch", "sensor_by_id", "sensor_by_id/history", "list_stations"]
+DASHBOARD_STATIONS = 20
+
+
+def in_process_client(db:str, rows:int, stations:int,
+					  range_cache:bool = True, hot_tier:bool = True) -> Callable[[], requests.Session]:
+	"""
+	Points the server module at `db` the way its tests do and returns a factory of clients for the app.
+	"""
+	from starlette.testclient import TestClient
+
+	import server
+	from storage.hot_tier import HotTierAdapter
+	from storage.range_cache import RangeCacheAdapter
+	from storage.sqlite_api.driver import MeasurementsDBAdapter
+	from utils.station_cache import StationListCache
+	from utils.tiles import StationTileCache
+
+	existing = pathlib.Path(db).exists()
+	adapter = MeasurementsDBAdapter(db_path = db, echo = False)
+	if not existing:
+		load(adapter, generate_chunks(rows, stations = stations))
+
+	configs = server.storage_configs
+	if range_cache and configs["range_cache"]["enabled"]:
+		adapter = server.range_cache = RangeCacheAdapter(adapter, chunk_seconds = configs["range_cache"]["chunk_seconds"],
+														 max_bytes = int(configs["range_cache"]["max_mb"] * 2 ** 20))
+	if hot_tier and configs["hot_tier"]["enabled"]:
+		adapter = HotTierAdapter(adapter,
+								 samples_per_series = configs["hot_tier"]["samples_per_series"],
+								 window_seconds = configs["hot_tier"]["window_seconds"],
+								 max_bytes = int(configs["hot_tier"]["max_mb"] * 2 ** 20))
+		adapter.warm()
+	server.storage_adapter = adapter
+	server.station_cache = StationListCache(load = adapter.get_stations)
+	server.tile_cache = StationTileCache(server.station_cache)
+	return lambda: TestClient(server.app)
+
+
+class ServerSession(requests.Session):
+	def __init__(self, url:str):
+		"""
+		Session taking paths relative to `url`, like the test client does.
+		"""
+		super().__init__()
+		self.url = url.rstrip("/")
+
+	def request(self, method, path, *args, **kwargs):
+		return super().request(method, self.url + path, *args, **kwargs)
+
+
+def remote_client(url:str) -> Callable[[], requests.Session]:
+	return lambda: ServerSession(url)
+
+
+class LoadRequests:
+	def __init__(self, stations:List[Dict], batch:int):
+		"""
+		Builds the requests of every scenario. `stations` is the server's station listing; downloads pick
+		from it, uploads go to stations of their own.
+		"""
+		self.stations = stations
+		self.batch = batch
+
+	def upload_station(self, rng:random.Random) -> Dict:
+		name, unit, hardware = rng.choice(CHANNELS)[:3]
+		return dict(key = f"load station {rng.randrange(1000)}", measurement_name = name, unit = unit,
+					lat = rng.uniform(-60, 70), lon = rng.uniform(-180, 180), hardware = hardware)
+
+	def request(self, name:str, session:requests.Session, rng:random.Random) -> requests.Response:
+		now = int(time.time())
+		if name == "sensor":
+			return session.post("/api/v0p2/sensor", json = dict(self.upload_station(rng), value = rng.uniform(0, 50),
+																  timestamp = str(now)))
+		if name == "sensor/batch":
+			return session.post("/api/v0p2/sensor/batch",
+								json = dict(self.upload_station(rng), values = [rng.uniform(0, 50) for _ in range(self.batch)],
+											timestamps = list(range(now - self.batch, now))))
+		if name == "sensor_by_id":
+			station = rng.choice(self.stations)
+			latest = int(datetime.datetime.fromisoformat(station["latest_time"]).timestamp())
+			start = latest - rng.randrange(86400)
+			return session.get(f"/api/v0p2/sensor_by_id/{station['station_key']}",
+							   params = dict(min_time = start - 3600, max_time = start, limit = 1000))
+		if name == "sensor_by_id/history":
+			station = rng.choice(self.stations[:DASHBOARD_STATIONS])
+			latest = int(datetime.datetime.fromisoformat(station["latest_time"]).timestamp())
+			end = latest // 3600 * 3600 - rng.randrange(24) * 3600
+			return session.get(f"/api/v0p2/sensor_by_id/{station['station_key']}",
+							   params = dict(min_time = end - 3600 - 1, max_time = end, limit = 1000))
+		if name == "list_stations":
+			return session.get("/api/v0p2/list_stations")
+		raise ValueError(f"Unknown scenario {name}")
+
+
+def run_scenario(load_requests:LoadRequests, name:str, client:Callable[[], requests.Session],
+				 count:int, concurrency:int, seed:int) -> Dict:
+	"""
+	Sends `count` requests from `concurrency` threads, each with its own session.
+	"""
+	local = threading.local()
+	lock = threading.Lock()
+	latencies:List[float] = []
+	errors = 0
+
+	def one(i:int) -> None:
+		nonlocal errors
+		if not hasattr(local, "session"):
+			local.session = client()
+		rng = random.Random(seed * 1000003 + i)
+		t1 = time.perf_counter()
+		try:
+			ok = load_requests.request(name, local.session, rng).status_code < 400
+		except requests.RequestException:
+			ok = False
+		elapsed = time.perf_counter() - t1
+		with lock:
+			latencies.append(elapsed)
+			errors += not ok
+
+	t1 = time.perf_counter()
+	with ThreadPoolExecutor(max_workers = concurrency) as pool:
+		list(pool.map(one, range(count)))
+	wall = time.perf_counter() - t1
+
+	ms = np.array(latencies) * 1000
+	return {"requests": count,
+			"errors": errors,
+			"seconds": round(wall, 3),
+			"throughput": round(count / wall, 1),
+			"p50_ms": round(float(np.percentile(ms, 50)), 2),
+			"p95_ms": round(float(np.percentile(ms, 95)), 2),
+			"p99_ms": round(float(np.percentile(ms, 99)), 2)}
+
+
+def git_revision() -> Optional[str]:
+	try:
+		return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output = True, text = True,
+							  check = True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def compare(results:Dict, baseline:Dict) -> None:
+	"""
+	Prints the change of every metric against a baseline results file. Positive throughput and negative
+	latency changes are improvements.
+	"""
+	print(f"\nagainst {baseline['meta'].get('revision')} of {baseline['meta'].get('date')}")
+	print(f"{'endpoint':<22} {'throughput':>11} {'p50':>8} {'p95':>8} {'p99':>8}")
+	for name, current in results["scenarios"].items():
+		before = baseline["scenarios"].get(name)
+		if before is None:
+			continue
+		change = {metric: (current[metric] - before[metric]) / before[metric] * 100 if before[metric] else 0.0
+				  for metric in ("throughput", "p50_ms", "p95_ms", "p99_ms")}
+		print(f"{name:<22} {change['throughput']:>+10.1f}% {change['p50_ms']:>+7.1f}% {change['p95_ms']:>+7.1f}% {change['p99_ms']:>+7.1f}%")
+
+
+def cache_metrics(session:requests.Session) -> Dict[str, float]:
+	"""
+	The range cache lines of the server's /metrics.
+	"""
+	lines = session.get("/metrics").text.splitlines()
+	return {line.split()[0]: float(line.split()[1]) for line in lines
+			if line.startswith("range_cache_")}
+
+
+def main(args) -> Dict:
+	client = remote_client(args.url) if args.url else \
+		in_process_client(args.db, args.rows, args.stations, range_cache = args.range_cache, hot_tier = args.hot_tier)
+	stations = client().get("/api/v0p2/list_stations").json()
+	load_requests = LoadRequests(stations, args.batch)
+
+	results = {"meta": {"date": datetime.datetime.now().isoformat(timespec = "seconds"),
+						"revision": git_revision(),
+						"python": platform.python_version(),
+						"target": args.url or "in-process",
+						"stations": len(stations),
+						"requests": args.requests,
+						"concurrency": args.concurrency,
+						"batch": args.batch,
+						"seed": args.seed,
+						# Unknown for a running server
+						"range_cache": None if args.url else args.range_cache,
+						"hot_tier": None if args.url else args.hot_tier},
+			   "scenarios": {}}
+
+	print(f"{'endpoint':<22} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}")
+	for name in args.scenarios:
+		r = run_scenario(load_requests, name, client, args.requests, args.concurrency, args.seed)
+		results["scenarios"][name] = r
+		print(f"{name:<22} {r['throughput']:>9.1f} {r['p50_ms']:>8.2f} {r['p95_ms']:>8.2f} {r['p99_ms']:>8.2f} {r['errors']:>7}")
+
+	if args.url or args.range_cache:
+		# Left out in-process, the server's counters would belong to the unused cache it was started with.
+		results["cache"] = cache_metrics(client())
+		for name, value in results["cache"].items():
+			print(f"{name:<24} {value:g}")
+
+	if args.output:
+		pathlib.Path(args.output).write_text(json.dumps(results, indent = 2))
+	if args.baseline:
+		compare(results, json.loads(pathlib.Path(args.baseline).read_text()))
+	return results
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--url", default = None, help = "A running server. Runs the app in-process when omitted.")
+	parser.add_argument("--db", default = "/tmp/bench.db", help = "Database of the in-process app.")
+	parser.add_argument("--rows", type = int, default = 1000000, help = "Rows generated into a new --db.")
+	parser.add_argument("--stations", type = int, default = 1000, help = "Stations generated into a new --db.")
+	parser.add_argument("--scenarios", nargs = "+", choices = SCENARIOS, default = SCENARIOS)
+	parser.add_argument("--requests", type = int, default = 2000, help = "Requests per endpoint.")
+	parser.add_argument("--concurrency", type = int, default = 16)
+	parser.add_argument("--batch", type = int, default = 100, help = "Values per sensor/batch upload.")
+	parser.add_argument("--seed", type = int, default = 0)
+	parser.add_argument("--no-range-cache", dest = "range_cache", action = "store_false", help = "In-process only.")
+	parser.add_argument("--no-hot-tier", dest = "hot_tier", action = "store_false", help = "In-process only.")
+	parser.add_argument("--output", default = None, help = "Write the results to this JSON file.")
+	parser.add_argument("--baseline", default = None, help = "Compare with this earlier results file.")
+
+	main(parser.parse_args())
@@ -1,8 +1,20 @@
 import requests
 from pydantic import BaseModel
-from typing import Optional, Union
-import time
+from typing import Dict, List, Optional, Union
+import gzip
 import json
+import logging
+import os
+import queue
+import threading
+import time
+
+try:
+	import msgpack
+except ImportError:
+	msgpack = None
+
+logger = logging.getLogger(__name__)
 
 class SensorPayload(BaseModel):
 	key:str
@@ -14,16 +26,106 @@ class SensorPayload(BaseModel):
 	lon:Optional[float]
 	hardware:Optional[str]
 
+class ChannelPayload(BaseModel):
+	measurement_name:str
+	unit:str
+	value: Union[int, float]
+	hardware:Optional[str]
+
+class StationFramePayload(BaseModel):
+	key:str
+	timestamp: Optional[int]
+	lat:Optional[float]
+	lon:Optional[float]
+	hardware:Optional[str]
+	channels: List[ChannelPayload]
+
+class UplinkSpool:
+	def __init__(self, path:str):
+		"""
+		Append-only JSON lines file of frames that could not be sent yet.
+
+		`take` moves the spooled frames aside to `<path>.replay` so new frames can keep being appended while
+		they are sent. A replay file left behind by a crash is picked up again on the next `take`.
+		"""
+		self.path = path
+		self.replay_path = path + ".replay"
+		self._lock = threading.Lock()
+
+	def append(self, frames:List[Dict]) -> None:
+		with self._lock:
+			with open(self.path, "a") as f:
+				f.writelines(json.dumps(frame) + "\n" for frame in frames)
+				f.flush()
+				os.fsync(f.fileno())
+
+	def take(self) -> List[Dict]:
+		with self._lock:
+			if not os.path.exists(self.replay_path):
+				if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+					return []
+				os.replace(self.path, self.replay_path)
+			with open(self.replay_path) as f:
+				# A torn last line from a crash mid-append is dropped.
+				frames = []
+				for line in f:
+					try:
+						frames.append(json.loads(line))
+					except ValueError:
+						logger.warning(f"Dropping unreadable spool line: {line!r}")
+				return frames
+
+	def done(self) -> None:
+		"""
+		Called once the frames returned by `take` are sent, or appended back to the spool.
+		"""
+		with self._lock:
+			if os.path.exists(self.replay_path):
+				os.remove(self.replay_path)
+
+
 class IOTStationUplink:
 	def __init__(self,
 				key:str,
 				lat:float,
-				lon:float):
+				lon:float,
+				server:str = "http://api.is-conic.com",
+				spool_path:str = "uplink_spool.jsonl",
+				batch_size:int = 50,
+				flush_interval:float = 5.0,
+				max_pending:int = 10000,
+				retry_interval:float = 30.0,
+				timeout:float = 10.0,
+				compress:bool = False,
+				session:Optional[requests.Session] = None):
+		"""
+		Uploads station frames from a background thread, so the caller never waits on the network.
 
+		Frames are sent in batches of up to `batch_size` to /station/frame/batch over one keep-alive session,
+		at the latest `flush_interval` seconds after the first frame of a batch. A batch that can't be delivered
+		(no connection, timeout, 5xx or 429) goes to the spool file at `spool_path`. The spool is replayed
+		once the server answers again, no sooner than `retry_interval` seconds after the failure. Frames beyond
+		`max_pending` waiting in memory are spooled directly. `compress` gzips the request bodies.
+		"""
 		self.key = key
 		self.lon = lon
 		self.lat = lat
-		self.endpoint = "http://api.is-conic.com/api/v0p1/sensor"
+		self.endpoint = server + "/api/v0p1/sensor"
+		self.frame_batch_endpoint = server + "/api/v0p2/station/frame/batch"
+		self.session = session or requests.Session()
+
+		self.spool = UplinkSpool(spool_path)
+		self.batch_size = batch_size
+		self.flush_interval = flush_interval
+		self.retry_interval = retry_interval
+		self.timeout = timeout
+		self.compress = compress
+
+		self._pending:queue.Queue = queue.Queue(maxsize = max_pending)
+		self._closing = object()
+		self._retry_at = 0.0
+		self._sender = threading.Thread(target = self._run, name = "uplink-sender", daemon = True)
+		self._sender.start()
 
 	def __get_station_params__(self):
 		return dict(key = self.key, lat = self.lat, lon = self.lon)
@@ -41,11 +143,106 @@ class IOTStationUplink:
 									unit = unit,
 									**self.__get_station_params__())
 
-		response = requests.post(self.endpoint, data= json.dumps(measurement.dict()))
+		response = self.session.post(self.endpoint, data= json.dumps(measurement.dict()), timeout = self.timeout)
 
 		if response.status_code != 200:
 			raise Exception(response.content)
-		print(response.status_code)
+		logger.debug(f"Posted {measurement_name}: {response.status_code}")
+
+	def post_frame(self, channels:List[ChannelPayload], time_stamp = None, hardware:Optional[str] = None):
+		"""
+		Queues all channels of one reading for upload. Never blocks.
+		"""
+		frame = StationFramePayload(timestamp = None if time_stamp is None else int(time_stamp),
+									hardware = hardware,
+									channels = channels,
+									**self.__get_station_params__())
+		frame = frame.dict(exclude_none = True)
+
+		try:
+			self._pending.put_nowait(frame)
+		except queue.Full:
+			self.spool.append([frame])
+
+	def close(self) -> None:
+		"""
+		Sends or spools everything queued, then stops the sender thread.
+		"""
+		self._pending.put(self._closing)
+		self._sender.join()
+
+	def _encode(self, frames:List[Dict]):
+		if msgpack is not None:
+			data = msgpack.packb({"frames": frames})
+			headers = {"Content-Type": "application/msgpack"}
+		else:
+			data = json.dumps({"frames": frames}).encode("utf-8")
+			headers = {"Content-Type": "application/json"}
+		if self.compress:
+			data = gzip.compress(data)
+			headers["Content-Encoding"] = "gzip"
+		return data, headers
+
+	def _send(self, frames:List[Dict]) -> bool:
+		"""
+		Returns False if the frames should be retried later. Frames the server rejects as invalid are dropped.
+		"""
+		data, headers = self._encode(frames)
+		try:
+			response = self.session.post(self.frame_batch_endpoint, data = data, headers = headers, timeout = self.timeout)
+		except requests.RequestException as e:
+			logger.warning(f"Uplink failed, spooling {len(frames)} frames: {e}")
+			return False
+
+		if response.status_code == 429 or response.status_code >= 500:
+			logger.warning(f"Server busy ({response.status_code}), spooling {len(frames)} frames")
+			return False
+		if response.status_code != 200:
+			logger.error(f"Server rejected {len(frames)} frames ({response.status_code}): {response.text}")
+		return True
+
+	def _deliver(self, frames:List[Dict]) -> None:
+		if time.monotonic() < self._retry_at or not self._send(frames):
+			self._retry_at = max(self._retry_at, time.monotonic() + self.retry_interval)
+			self.spool.append(frames)
+
+	def _replay(self) -> None:
+		if time.monotonic() < self._retry_at:
+			return
+		frames = self.spool.take()
+		for i in range(0, len(frames), self.batch_size):
+			if not self._send(frames[i:i + self.batch_size]):
+				self._retry_at = time.monotonic() + self.retry_interval
+				self.spool.append(frames[i:])
+				break
+		self.spool.done()
+
+	def _take(self):
+		"""
+		Waits for the next batch. Returns (frames, closing).
+		"""
+		frames = []
+		deadline = time.monotonic() + self.flush_interval
+		while len(frames) < self.batch_size:
+			try:
+				frame = self._pending.get(timeout = max(deadline - time.monotonic(), 0))
+			except queue.Empty:
+				break
+			if frame is self._closing:
+				return frames, True
+			if not frames:
+				deadline = time.monotonic() + self.flush_interval
+			frames.append(frame)
+		return frames, False
+
+	def _run(self) -> None:
+		while True:
+			frames, closing = self._take()
+			if frames:
+				self._deliver(frames)
+			self._replay()
+			if closing:
+				return
 
 if __name__ == "__main__":
 	import serial
@@ -53,22 +250,29 @@ if __name__ == "__main__":
 	station_link = IOTStationUplink(key="Demo Bouy Station", lat = 0.0, lon = 0.0)
 
 
+	CHANNELS = [("Red transmittance", "ADC Value 16 bit"),
+				("Green transmittance", "ADC Value 16 bit"),
+				("Blue transmittance", "ADC Value 16 bit"),
+				("Water Temperature", "ADC Value 16 bit"),
+				("Temperature", "C"),
+				("Pressure", "hPa"),
+				("Humidity", "Percentage"),
+				("Voltage", "ADC Value 12 bit")]
+
 	def postFromCSVLine(line:str):
-		current_time = str(int(time.time()))
-		red, green, blue, water, temp, pres, hum, voltage = line.split(",")
-		station_link.post(value= red,     time_stamp = current_time, hardware="None", unit="ADC Value 16 bit", measurement_name="Red transmittance")
-		station_link.post(value= green,   time_stamp = current_time, hardware="None", unit="ADC Value 16 bit", measurement_name="Green transmittance")
-		station_link.post(value= blue,    time_stamp = current_time, hardware="None", unit="ADC Value 16 bit", measurement_name="Blue transmittance")
-		station_link.post(value= water,   time_stamp = current_time, hardware="None", unit="ADC Value 16 bit", measurement_name="Water Temperature")
-		station_link.post(value= temp,    time_stamp = current_time, hardware="None", unit="C", 			   measurement_name="Temperature")
-		station_link.post(value= pres,    time_stamp = current_time, hardware="None", unit="hPa", 		       measurement_name="Pressure")
-		station_link.post(value= hum,     time_stamp = current_time, hardware="None", unit="Percentage", 	   measurement_name="Humidity")
-		station_link.post(value= voltage, time_stamp = current_time, hardware="None", unit="ADC Value 12 bit", measurement_name="Voltage")
+		current_time = int(time.time())
+		values = line.split(",")
+		channels = [ChannelPayload(measurement_name = name, unit = unit, value = int(value))
+					for (name, unit), value in zip(CHANNELS, values)]
+		station_link.post_frame(channels, time_stamp = current_time, hardware = "None")
 
 
+	logging.basicConfig(level = logging.INFO)
 	ser = serial.Serial('/dev/ttyUSB0')  # open serial port
-	while True:
-		line = ser.readline().strip()
-		line.decode('ascii')
-		postFromCSVLine(line)
+	try:
+		while True:
+			line = ser.readline().strip()
+			postFromCSVLine(line.decode('ascii'))
+	finally:
+		station_link.close()
 
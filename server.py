@@ -1,20 +1,46 @@
 import uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.encoders import jsonable_encoder
 from fastapi.responses import HTMLResponse
 from fastapi.responses import JSONResponse
+from fastapi.responses import StreamingResponse
+from fastapi.responses import Response
+from starlette.routing import Match
 
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
 from pathlib import Path
-from typing import List, Dict, Optional, Tuple, Union
+from typing import List, Dict, Optional, Tuple, Union, Iterator, AsyncIterator
+import asyncio
 import datetime
+import gzip
+from itertools import chain
+import json
+import zlib
 import time  
 
 from utils.general import load_yaml
-from utils.fast import enable_cors
+from utils.fast import enable_cors, cached_json_response
+from utils.station_cache import StationListCache
+from utils.tiles import StationTileCache
+from utils.columnar import rows_to_npz, NPZ_MEDIA_TYPE
+from utils.record_json import records_to_json, records_to_ndjson
+from utils.metrics import MetricsRegistry, RateMeter, instrument_sqlalchemy
 from utils.geojson_models import GeoJSONFeature, GeoJSONFeatureCollection, PointGeometry
 
-from storage.sqlite_api.driver import MeasurementsDBAdapter
-from storage.models import MeasurementsQuery, Measurement
+from storage.sqlite_api.driver import MeasurementsDBAdapter, RAW_COLUMNS
+from storage.sqlite_api.partitioned import PartitionedMeasurementsDBAdapter
+from storage.models import MeasurementsQuery, Measurement, MeasurementsCursor, MeasurementRecord
+from storage.write_behind import WriteBehindQueue, QueueFullError
+from storage.executor import StorageExecutor
+from storage.hot_tier import HotTierAdapter
+from storage.range_cache import RangeCacheAdapter
+from storage.dedup import RecentSamples, SampleId, sample_id
+from utils.live import LiveHub, Subscription
+
+try:
+	import msgpack
+except ImportError:
+	msgpack = None
 
 #This is the input schema for a web request
 class SensorPayload(BaseModel):
@@ -51,11 +77,7 @@ def sensor_payload_to_measurement(payload:SensorPayload) -> Measurement:
 
 def batched_sensor_payload_to_measurements(batch: BatchedSensorPayload) -> List[Measurement]:
 	measurements = []
-
-	print(batch.timestamps)
-
 	for value, timestamp in zip(batch.values, batch.timestamps):
-		print(timestamp)
 		measurement = Measurement(key=batch.key,
 								  measurement_name=batch.measurement_name,
 								  unit=batch.unit,
@@ -69,6 +91,40 @@ def batched_sensor_payload_to_measurements(batch: BatchedSensorPayload) -> List[
 	return measurements
 
 
+class ChannelPayload(BaseModel):
+	measurement_name:str
+	unit:str
+	value: Union[float, int]
+	hardware:Optional[str]
+
+class StationFramePayload(BaseModel):
+	"""
+	Everything one station measured at one instant. The station metadata is sent once for all channels.
+	"""
+	key:str
+	timestamp: Optional[int]
+	lat:Optional[float]
+	lon:Optional[float]
+	hardware:Optional[str]
+	channels: List[ChannelPayload]
+
+class StationFrameBatchPayload(BaseModel):
+	frames: List[StationFramePayload]
+
+def station_frame_to_measurements(frame: StationFramePayload, receipt_time: datetime.datetime) -> List[Measurement]:
+	timestamp = receipt_time if frame.timestamp is None else datetime.datetime.fromtimestamp(frame.timestamp)
+	return [Measurement(key = frame.key,
+						measurement_name = channel.measurement_name,
+						unit = channel.unit,
+						timestamp = timestamp,
+						latitude = frame.lat,
+						longitude = frame.lon,
+						receipt_time = receipt_time,
+						value = channel.value,
+						hardware = channel.hardware if channel.hardware is not None else frame.hardware)
+			for channel in frame.channels]
+
+
 class BoundedQuery(BaseModel):
 	time_range: Optional[Tuple[int, int]]
 	lat_range: Optional[Tuple[float, float]]
@@ -79,11 +135,224 @@ class BoundedQuery(BaseModel):
 
 
 
-storage_adapter = MeasurementsDBAdapter()
+server_configs = load_yaml("configs/server_config.yaml")
+log_configs = load_yaml("configs/log_config.yaml")
+queue_configs = server_configs["ingest_queue"]
+dedup_configs = server_configs["ingest_dedup"]
+live_configs = server_configs["live"]
+
+storage_configs = server_configs["storage"]
+
+if storage_configs["driver"] == "postgis":
+	from storage.postgis_api.driver import MeasurementsPostGISAdapter
+	storage_adapter = MeasurementsPostGISAdapter(dsn = storage_configs["postgis"]["dsn"],
+												 pool_size = storage_configs["postgis"]["pool_size"],
+												 max_overflow = storage_configs["postgis"]["max_overflow"])
+elif storage_configs["partition"] == "none":
+	storage_adapter = MeasurementsDBAdapter()
+else:
+	storage_adapter = PartitionedMeasurementsDBAdapter(period = storage_configs["partition"],
+													   retention_days = storage_configs["retention_days"])
+range_cache = None
+if storage_configs["range_cache"]["enabled"]:
+	storage_adapter = range_cache = RangeCacheAdapter(storage_adapter,
+													  chunk_seconds = storage_configs["range_cache"]["chunk_seconds"],
+													  max_bytes = int(storage_configs["range_cache"]["max_mb"] * 2 ** 20))
+if storage_configs["hot_tier"]["enabled"]:
+	storage_adapter = HotTierAdapter(storage_adapter,
+									 samples_per_series = storage_configs["hot_tier"]["samples_per_series"],
+									 window_seconds = storage_configs["hot_tier"]["window_seconds"],
+									 max_bytes = int(storage_configs["hot_tier"]["max_mb"] * 2 ** 20))
+storage_reads = StorageExecutor(max_workers = storage_configs["read_workers"])
+station_cache = StationListCache(load = storage_adapter.get_stations)
+tile_cache = StationTileCache(station_cache)
+recent_samples = RecentSamples(capacity = dedup_configs["recent_samples"],
+							   false_positive_rate = dedup_configs["false_positive_rate"])
+live_hub = LiveHub(buffer_size = live_configs["buffer_size"], max_subscribers = live_configs["max_subscribers"])
+
+metrics = MetricsRegistry()
+request_durations = metrics.histogram("http_request_duration_seconds", "Time until the response starts, per route.",
+									  labels = ["method", "route"])
+requests_served = metrics.counter("http_requests_total", "Requests served, per route and status code.",
+								  labels = ["method", "route", "status"])
+ingested_rows = metrics.counter("ingest_rows_total", "Measurements written to storage.")
+ingest_rate = RateMeter(window = 60)
+metrics.gauge("ingest_rows_per_second", "Measurements written to storage per second over the last minute.", ingest_rate.rate)
+ingest_duplicates = metrics.counter("ingest_duplicates_total", "Uploaded measurements dropped as already stored or repeated.")
+ingest_rejected = metrics.counter("ingest_rejected_total", "Uploads turned away because the ingest queue was full.")
+metrics.gauge("ingest_queue_depth", "Measurements accepted but not yet written to storage.", lambda: ingest_queue.depth)
+metrics.gauge("ingest_flush_lag_seconds", "Age of the oldest measurement waiting in the ingest queue.", lambda: ingest_queue.flush_lag)
+metrics.gauge("ingest_dead_lettered", "Measurements storage kept rejecting, moved to the dead letter file since start.", lambda: ingest_queue.dead_lettered)
+metrics.gauge("live_subscribers", "Clients connected to the live measurement stream.", lambda: len(live_hub))
+metrics.gauge("live_subscribers_dropped", "Live clients disconnected for falling too far behind, since start.", lambda: live_hub.dropped)
+if range_cache is not None:
+	metrics.gauge("range_cache_hits", "Time chunks served from the range cache, since start.", lambda: range_cache.hits)
+	metrics.gauge("range_cache_misses", "Time chunks read from storage into the range cache, since start.", lambda: range_cache.misses)
+	metrics.gauge("range_cache_hit_ratio", "Share of range cache lookups that were hits, since start.", lambda: range_cache.hit_ratio)
+	metrics.gauge("range_cache_bytes", "Approximate memory held by the range cache.", lambda: range_cache.nbytes)
+	metrics.gauge("range_cache_entries", "Time chunks held by the range cache.", lambda: len(range_cache))
+metrics.gauge("storage_reads_in_flight", "Storage calls queued or running on the read pool.", lambda: storage_reads.in_flight)
+metrics.gauge("storage_read_workers", "Threads of the read pool.", lambda: storage_reads.max_workers)
+instrument_sqlalchemy(metrics, slow_query_seconds = log_configs["slow_queries"]["threshold_seconds"])
+
+
+def store_measurements(measurements: List[Measurement]) -> None:
+	"""
+	Writes a drained ingest batch to storage, then lets the caches and live subscribers know what changed.
+	Subscribers only get the samples storage did not have yet: storage ignores re-sent ones, so with anyone
+	subscribed those are looked up first. The flusher is the only writer, so nothing lands in between.
+	"""
+	stored = measurements
+	if len(live_hub):
+		fresh: Dict[SampleId, Measurement] = {}
+		for m in measurements:
+			fresh.setdefault(sample_id(m), m)
+		for sample in storage_adapter.existing_samples(list(fresh)):
+			del fresh[sample]
+		stored = list(fresh.values())
+
+	inserted = storage_adapter.insert_measurements(measurements)
+	ingested_rows.inc(amount = inserted)
+	ingest_rate.add(inserted)
+	# Duplicates the recent sample filter could not know about, e.g. still queued or from before a restart
+	ingest_duplicates.inc(amount = len(measurements) - inserted)
+	station_cache.notify_ingest(measurements)
+	live_hub.publish(stored)
+
+
+ingest_queue = WriteBehindQueue(sink = store_measurements,
+								max_size = queue_configs["max_size"],
+								flush_size = queue_configs["flush_size"],
+								flush_interval = queue_configs["flush_interval"],
+								max_retries = queue_configs["max_retries"],
+								dead_letter_path = queue_configs["dead_letter"])
 
 app = FastAPI()
 enable_cors(app)
 
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+	"""
+	Times every request by its route template, so /sensor_by_id/a and /sensor_by_id/b share one histogram.
+	"""
+	start = time.perf_counter()
+	status = 500
+	try:
+		response = await call_next(request)
+		status = response.status_code
+		return response
+	finally:
+		path = route_template(request)
+		request_durations.observe(time.perf_counter() - start, request.method, path)
+		requests_served.inc(request.method, path, str(status))
+
+
+def route_template(request: Request) -> str:
+	"""
+	Path template of the route `request` went to. Older Starlette versions do not record the route in the
+	request scope, so the router's routes are matched against it then.
+	"""
+	route = request.scope.get("route")
+	if route is None:
+		route = next((r for r in request.app.router.routes if r.matches(request.scope)[0] == Match.FULL), None)
+	return route.path if route is not None else "unmatched"
+
+
+async def enqueue_measurements(measurements: List[Measurement]) -> JSONResponse:
+	"""
+	Hands measurements to the write-behind queue and reports how many were accepted and how many were
+	duplicates, repeated within the upload or already stored. Only samples the recent sample filter has
+	seen are looked up in storage. Tells the client to back off when the queue is full.
+	"""
+	fresh: Dict[SampleId, Measurement] = {}
+	for m in measurements:
+		fresh.setdefault(sample_id(m), m)
+
+	suspects = [sample for sample in fresh if recent_samples.might_contain(sample)]
+	if suspects:
+		for sample in await storage_reads.run(storage_adapter.existing_samples, suspects):
+			del fresh[sample]
+
+	try:
+		ingest_queue.put(list(fresh.values()))
+	except QueueFullError:
+		ingest_rejected.inc()
+		return JSONResponse(status_code = 503,
+							content = {"status": "busy"},
+							headers = {"Retry-After": str(queue_configs["retry_after"])})
+
+	recent_samples.add_all(fresh)
+	duplicates = len(measurements) - len(fresh)
+	ingest_duplicates.inc(amount = duplicates)
+	return JSONResponse(content = {"status" :"ok", "accepted": len(fresh), "duplicates": duplicates})
+
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+def wants_ndjson(request: Request, format: Optional[str]) -> bool:
+	"""
+	Streaming is selected with `?format=ndjson` or an `Accept: application/x-ndjson` header.
+	"""
+	return format == "ndjson" or NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+def wants_npz(request: Request, format: Optional[str]) -> bool:
+	"""
+	The columnar export is selected with `?format=npz` or an `Accept: application/x-npz` header.
+	"""
+	return format == "npz" or NPZ_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+def ndjson_response(chunks: Iterator[List[MeasurementRecord]]) -> StreamingResponse:
+	"""
+	Streams measurements as newline delimited JSON, one object per line, encoding each chunk only as it is read.
+	Reading and encoding happen on the storage threads.
+	"""
+	encoded = (records_to_ndjson(chunk) for chunk in chunks)
+	return StreamingResponse(storage_reads.iterate(encoded), media_type = NDJSON_MEDIA_TYPE)
+
+
+def records_response(chunks: Iterator[List[MeasurementRecord]]) -> Response:
+	"""
+	Encodes measurements to a JSON array without building a Measurement per row. Same body as returning the models.
+	"""
+	return Response(content = records_to_json(chain.from_iterable(chunks)), media_type = "application/json")
+
+
+RETENTION_CHECK_INTERVAL = 3600
+
+async def enforce_retention():
+	"""
+	Drops expired partitions once an hour.
+	"""
+	while True:
+		if await storage_reads.run(storage_adapter.drop_expired):
+			station_cache.invalidate()
+		await asyncio.sleep(RETENTION_CHECK_INTERVAL)
+
+@app.on_event("startup")
+def start_retention():
+	if getattr(storage_adapter, "retention_days", None) is not None:
+		asyncio.get_event_loop().create_task(enforce_retention())
+
+@app.on_event("startup")
+async def warm_hot_tier():
+	"""
+	Loads the recent window into memory before the first request is served.
+	"""
+	if isinstance(storage_adapter, HotTierAdapter):
+		await storage_reads.run(storage_adapter.warm)
+
+
+@app.on_event("shutdown")
+def flush_ingest_queue():
+	"""
+	Writes out everything still buffered before the process exits.
+	"""
+	ingest_queue.close()
+	storage_reads.shutdown()
+
 ## passed
 @app.post("/api/v0p2/sensor", tags=["Upload", "V0p2"])
 async def post_sensor(payload: SensorPayload):
@@ -93,9 +362,7 @@ async def post_sensor(payload: SensorPayload):
 	measurement = sensor_payload_to_measurement(payload)
 	measurement.receipt_time = datetime.datetime.now()
 
-	storage_adapter.insert_measurement(measurement)
-
-	return JSONResponse(content = {"status" :"ok"})
+	return await enqueue_measurements([measurement])
 
 
 
@@ -113,91 +380,272 @@ async def post_sensor_batch(payload: BatchedSensorPayload):
 
 	for m in measurements:
 		m.receipt_time = request_time
-		storage_adapter.insert_measurement(m)
 
-	return {"status": "ok"}
+	return await enqueue_measurements(measurements)
+
+MSGPACK_MEDIA_TYPES = ("application/msgpack", "application/x-msgpack")
+
+async def parse_upload(request: Request, model):
+	"""
+	Parses a JSON or MessagePack (Content-Type: application/msgpack) request body into `model`.
+	The body may be gzip compressed (Content-Encoding: gzip).
+	"""
+	content_type = request.headers.get("content-type", "").split(";")[0].strip()
+	body = await request.body()
+	try:
+		if request.headers.get("content-encoding", "").strip() == "gzip":
+			body = gzip.decompress(body)
+		if content_type in MSGPACK_MEDIA_TYPES:
+			if msgpack is None:
+				raise HTTPException(status_code = 415, detail = "MessagePack is not supported by this server")
+			content = msgpack.unpackb(body, raw = False)
+		else:
+			content = json.loads(body)
+		return model.parse_obj(content)
+	except ValidationError as e:
+		raise HTTPException(status_code = 422, detail = e.errors())
+	except (ValueError, OSError, EOFError, zlib.error) as e:
+		raise HTTPException(status_code = 400, detail = f"Malformed upload: {e}")
+
+@app.post("/api/v0p2/station/frame", tags=["Upload", "V0p2"])
+async def post_station_frame(request: Request):
+	"""
+	Post all channels of one station reading at once, as JSON or as MessagePack
+	(Content-Type: application/msgpack) with the same structure. The channels are written in one transaction.
+	"""
+	frame = await parse_upload(request, StationFramePayload)
+	try:
+		measurements = station_frame_to_measurements(frame, datetime.datetime.now())
+	except ValidationError as e:
+		raise HTTPException(status_code = 422, detail = e.errors())
+	return await enqueue_measurements(measurements)
+
+@app.post("/api/v0p2/station/frame/batch", tags=["Upload", "V0p2"])
+async def post_station_frame_batch(request: Request):
+	"""
+	Post many station frames, e.g. readings buffered by a station while offline, as {"frames": [...]}.
+	Accepts the same encodings as /station/frame. Either all frames are accepted or none.
+	"""
+	batch = await parse_upload(request, StationFrameBatchPayload)
+	receipt_time = datetime.datetime.now()
+	try:
+		measurements = [m for frame in batch.frames for m in station_frame_to_measurements(frame, receipt_time)]
+	except ValidationError as e:
+		raise HTTPException(status_code = 422, detail = e.errors())
+	return await enqueue_measurements(measurements)
 
 #passed
 @app.get("/api/v0p2/list_sensors", tags = ["Download", "V0p2"])
-async def get_sensors():
+async def get_sensors(request: Request):
 	"""
 	Returns a list of ALL unique sensors(by sensor key) and their latest latitude and longitude coordinates.
 	"""
-	sensors = storage_adapter.get_stations()
-
-	response = []
-	for name, latest_time, lat,lon in sensors:
-		response.append(dict(key = name, lat = lat, lon = lon, latest = latest_time))
-
-	return response
+	cached = await storage_reads.run(station_cache.get, "list")
+	return cached_json_response(request, cached.body, cached.etag, cached.last_modified)
 
 #passed
 @app.get("/api/v0p2/list_stations", tags=["Download", "V0p2"])
-async def get_stations():
+async def get_stations(request: Request):
 	"""
 	Returns a list of ALL unique sensors(by sensor key) and their latest latitude and longitude coordinates.
 	"""
-	stations = storage_adapter.get_stations()
-
-	return list(map(lambda x: x.dict(), stations))
+	cached = await storage_reads.run(station_cache.get, "dicts")
+	return cached_json_response(request, cached.body, cached.etag, cached.last_modified)
 
 
 #passed
 @app.get("/api/v0p2/list_stations/geojson", tags = ["Download", "V0p2"])
-async def get_sensors_geojson():
+async def get_sensors_geojson(request: Request):
 	"""
 	Returns a list of ALL unique sensors(by sensor key) and their latest latitude and longitude coordinates. The returned represenation is GEOJSON 
 	"""	
-	stations = storage_adapter.get_stations()
+	cached = await storage_reads.run(station_cache.get, "geojson")
+	return cached_json_response(request, cached.body, cached.etag, cached.last_modified)
 
-	feautures:List[GeoJSONFeature] = []
 
-	for station  in stations:
-		name, latest_time, lat, lon = station
+@app.get("/api/v0p2/list_stations/geojson/tiles/{z}/{x}/{y}", tags = ["Download", "V0p2"])
+async def get_station_tile(z: int, x: int, y: int, request: Request):
+	"""
+	Returns the stations inside one z/x/y Web Mercator tile as GEOJSON, with nearby stations merged into
+	cluster features carrying a count.
+	"""
+	try:
+		body, etag, last_modified = await storage_reads.run(tile_cache.tile, z, x, y)
+	except ValueError as e:
+		raise HTTPException(status_code = 400, detail = str(e))
+	return cached_json_response(request, body, etag, last_modified)
+
+
+@app.get("/api/v0p2/list_stations/geojson/clustered", tags = ["Download", "V0p2"])
+async def get_stations_clustered(request: Request,
+								 min_lat: float,
+								 max_lat: float,
+								 min_lon: float,
+								 max_lon: float,
+								 zoom:    int):
+	"""
+	Returns the stations in the viewport as GEOJSON, clustered for the given map zoom. Built from the cached
+	tiles covering the viewport, so features just outside it may be included.
+	"""
+	try:
+		body, etag, last_modified = await storage_reads.run(tile_cache.bbox, min_lat, max_lat, min_lon, max_lon, zoom)
+	except ValueError as e:
+		raise HTTPException(status_code = 400, detail = str(e))
+	return cached_json_response(request, body, etag, last_modified)
+
+
+def bounded_query(sensor_id: str,
+				  min_time: Optional[int],
+				  max_time: Optional[int],
+				  min_lat:  Optional[float],
+				  max_lat:  Optional[float],
+				  min_lon:  Optional[float],
+				  max_lon:  Optional[float],
+				  measurement_name: Optional[str] = None) -> MeasurementsQuery:
+	"""
+	Builds the storage query for a sensor_by_id style request. Each range only applies when both ends are given.
+	"""
+	int_to_ts = lambda x: datetime.datetime.fromtimestamp(int(x))
 
-		point_geom = PointGeometry(coordinates = [station.lon,
-												  station.lat])
+	lats = None if min_lat is None or max_lat is None else (min_lat, max_lat)
+	lons = None if min_lon is None or max_lon is None else (min_lon, max_lon)
+	time_range = None if min_time is None or max_time is None else ( int_to_ts(min_time),
+																	 int_to_ts(max_time))
 
-		geo_feature = GeoJSONFeature(properties = dict(key = station.station_key),
-									geometry = point_geom)
-		feautures.append(geo_feature)
-	feature_collection = GeoJSONFeatureCollection(features = feautures)
-	return feature_collection
+	return MeasurementsQuery(key = sensor_id,
+							 lats = lats,
+							 lons = lons,
+							 time_range = time_range,
+							 measurement_name = measurement_name)
 
 
 #passed
-@app.get("/api/v0p2/sensor_by_id/{sensor_id}", tags = ["Download"])
+@app.get("/api/v0p2/sensor_by_id/{sensor_id}", tags = ["Download"], response_model = List[Measurement])
 async def get_sensor_values(sensor_id: str,
+							request:  Request,
 							min_time: Optional[int]   = None,
 							max_time: Optional[int]   = None,
 							min_lat:  Optional[float] = None,
 							max_lat:  Optional[float] = None,
 							min_lon:  Optional[float] = None,
 							max_lon:  Optional[float] = None,
-							limit  :  Optional[int]   = None):
+							limit  :  Optional[int]   = None,
+							after  :  Optional[str]   = None,
+							format :  Optional[str]   = None):
+	"""
+	Returns the sensor's measurements ordered by timestamp, at most `limit` of them. With `format=ndjson`
+	(or `Accept: application/x-ndjson`) the result is streamed as newline delimited JSON instead of one JSON array.
+	With `format=npz` (or `Accept: application/x-npz`) it is returned as columnar NumPy arrays, see utils/columnar.py.
 
+	Paging: when more results follow a `limit`ed page, the `X-Next-Cursor` response header holds an opaque cursor.
+	Pass it back as `after` to get the next page.
+	"""
+	try:
+		after_cursor = None if after is None else MeasurementsCursor.decode(after)
+	except ValueError as e:
+		raise HTTPException(status_code = 400, detail = str(e))
+
+	query = bounded_query(sensor_id, min_time, max_time, min_lat, max_lat, min_lon, max_lon)
+
+	if wants_ndjson(request, format):
+		return ndjson_response(storage_adapter.iter_bounded_records(query = query, limit = limit, after = after_cursor))
+
+	if wants_npz(request, format):
+		chunks = storage_adapter.iter_bounded_rows(query = query, limit = limit, after = after_cursor)
+		return Response(content = await storage_reads.run(rows_to_npz, RAW_COLUMNS, chunks),
+						media_type = NPZ_MEDIA_TYPE,
+						headers = {"Content-Disposition": f'attachment; filename="{sensor_id}.npz"'})
+
+	if limit is not None:
+		page, next_cursor = await storage_reads.run(storage_adapter.get_record_page, query = query, limit = limit, after = after_cursor)
+		headers = {} if next_cursor is None else {"X-Next-Cursor": next_cursor.encode()}
+		return Response(content = await storage_reads.run(records_to_json, page),
+						media_type = "application/json",
+						headers = headers)
+
+	chunks = storage_adapter.iter_bounded_records(query = query, after = after_cursor)
+	return await storage_reads.run(records_response, chunks)
+
+
+@app.get("/api/v0p2/sensor_by_id/{sensor_id}/aggregate", tags = ["Download"])
+async def get_sensor_aggregates(sensor_id: str,
+								bucket  : Optional[int]   = None,
+								points  : Optional[int]   = None,
+								measurement_name: Optional[str] = None,
+								min_time: Optional[int]   = None,
+								max_time: Optional[int]   = None,
+								min_lat:  Optional[float] = None,
+								max_lat:  Optional[float] = None,
+								min_lon:  Optional[float] = None,
+								max_lon:  Optional[float] = None):
+	"""
+	Summarizes the sensor's measurements server side, per measurement_name. Takes the same filters as sensor_by_id plus exactly one of:
 
-	int_to_ts = lambda x: datetime.datetime.fromtimestamp(int(x))
+	bucket  Width in seconds. Returns min/max/mean/count/last for every non-empty, epoch aligned bucket.
+	points  Returns at most this many samples per series, chosen by LTTB so the plotted shape is kept.
+	"""
+	if (bucket is None) == (points is None):
+		raise HTTPException(status_code = 400, detail = "Pass exactly one of 'bucket' or 'points'")
+	if (bucket is not None and bucket <= 0) or (points is not None and points <= 0):
+		raise HTTPException(status_code = 400, detail = "'bucket' and 'points' must be positive")
 
-	lats = None if min_lat is None or max_lat is None else (min_lat, max_lat)
-	lons = None if min_lon is None or max_lon is None else (min_lon, max_lon)
-	time_range = None if min_time is None or max_time is None else ( int_to_ts(min_time),
-																	 int_to_ts(max_time))
+	query = bounded_query(sensor_id, min_time, max_time, min_lat, max_lat, min_lon, max_lon, measurement_name)
+
+	if bucket is not None:
+		return await storage_reads.run(storage_adapter.get_aggregated, query = query, bucket_seconds = bucket)
+	return await storage_reads.run(storage_adapter.get_downsampled, query = query, points = points)
 
-	print(time_range)
 
-	query = MeasurementsQuery(key = sensor_id,
-						 lats = lats,
-						 lons = lons,
-						 time_range = time_range)
+async def live_events(subscription: Subscription) -> AsyncIterator[bytes]:
+	"""
+	Server-Sent Events of a live subscription: one event per stored batch, with the batch's matching
+	measurements as a JSON array. A comment line is sent when idle, and a last "dropped" event if the client
+	fell too far behind.
+	"""
+	try:
+		while True:
+			try:
+				batch = await asyncio.wait_for(subscription.get(), live_configs["keepalive_seconds"])
+			except asyncio.TimeoutError:
+				yield b": keepalive\n\n"
+				continue
+			if batch is None:
+				if subscription.overflowed:
+					yield b"event: dropped\ndata: {}\n\n"
+				return
+			yield b"data: " + records_to_json(map(MeasurementRecord.from_measurement, batch)) + b"\n\n"
+	finally:
+		live_hub.unsubscribe(subscription)
+
+
+@app.get("/api/v0p2/live", tags = ["Download", "V0p2"])
+async def get_live(key: Optional[str] = None,
+				   measurement_name: Optional[str] = None,
+				   min_lat:  Optional[float] = None,
+				   max_lat:  Optional[float] = None,
+				   min_lon:  Optional[float] = None,
+				   max_lon:  Optional[float] = None):
+	"""
+	Streams measurements as they are stored, as Server-Sent Events (`text/event-stream`), instead of polling
+	sensor_by_id. Filters by station key, measurement name and bounding box, each optional.
+	"""
+	query = bounded_query(key, None, None, min_lat, max_lat, min_lon, max_lon, measurement_name)
+	try:
+		subscription = live_hub.subscribe(key = query.key, measurement_name = query.measurement_name,
+										  lats = query.lats, lons = query.lons)
+	except ValueError as e:
+		raise HTTPException(status_code = 503, detail = str(e))
 
-	results = storage_adapter.get_bounded(query = query)
-	return  list(results)
+	return StreamingResponse(live_events(subscription),
+							 media_type = "text/event-stream",
+							 headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 class APIStatus(BaseModel):
 	up: bool
 	connected_to_storage: bool 
+	ingest_queue_depth: int
+	ingest_flush_lag: float
 
 
 
@@ -205,13 +653,24 @@ class APIStatus(BaseModel):
 def health() -> APIStatus:
 	"""
 	Returns a status of the backend. Runs connectivity test to any storage drivers or components.  
+	Also reports how many uploaded measurements are waiting to be written and how long the oldest has waited (seconds).
 	"""
 
 	# With the CSV API we're going to assume nothing is severed from local storage.
-	status = APIStatus(up = True,	connected_to_storage = True)
+	status = APIStatus(up = True,	connected_to_storage = True,
+					   ingest_queue_depth = ingest_queue.depth,
+					   ingest_flush_lag = ingest_queue.flush_lag)
 	return status
 
 
+@app.get("/metrics", tags= ["Auxilary"])
+def get_metrics():
+	"""
+	Request latencies, ingest rates, storage statement durations and queue stats in the Prometheus text format.
+	"""
+	return Response(content = metrics.render(), media_type = "text/plain; version=0.0.4; charset=utf-8")
+
+
 @app.get("/", tags= ["Auxilary"])
 def home():
 	"""
@@ -223,13 +682,15 @@ def home():
 	return HTMLResponse( content )
 
 
-@app.get("/api/v0p1/debug/get_data", tags = ["Debug"])
-async def debug_get_all_data():
+@app.get("/api/v0p1/debug/get_data", tags = ["Debug"], response_model = List[Measurement])
+async def debug_get_all_data(request: Request, format: Optional[str] = None):
 	"""
-	Returns ALL available data
+	Returns ALL available data. Supports the same ndjson streaming as sensor_by_id.
 	"""
-	data:List[Measurement] = list(storage_adapter.get_all())
-	return data
+	if wants_ndjson(request, format):
+		return ndjson_response(storage_adapter.iter_bounded_records(query = MeasurementsQuery()))
+
+	return await storage_reads.run(records_response, storage_adapter.iter_bounded_records(query = MeasurementsQuery()))
 
 import time
 @app.get("/api/v0p1/debug/get_timestamp", tags = ["Debug"])
@@ -249,7 +710,6 @@ async def debug_get_dallas():
 
 
 if __name__ == "__main__":
-	server_configs = load_yaml("configs/server_config.yaml")
 	HOST = server_configs["host"]
 	PORT = server_configs["port"]
 
@@ -0,0 +1,120 @@
+"""
+Vectorized reductions over a single measurement series, shared by the storage drivers.
+
+A series is a pair of equal-length arrays: `timestamps` (int64 epoch seconds, ascending) and `values` (float64).
+"""
+import math
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+Series = Tuple[np.ndarray, np.ndarray]
+
+
+def bucket_aggregate(timestamps:np.ndarray, values:np.ndarray, bucket_seconds:int) -> Dict[str, np.ndarray]:
+	"""
+	Reduces a series to fixed-width time buckets aligned to the epoch.
+
+	Returns arrays with one entry per non-empty bucket: bucket (start, epoch seconds), min, max, sum, count,
+	last (value of the latest sample in the bucket) and last_timestamp.
+	"""
+	if len(timestamps) == 0:
+		empty = np.empty(0)
+		return dict(bucket = empty.astype(np.int64), min = empty, max = empty, sum = empty,
+					count = empty.astype(np.int64), last = empty, last_timestamp = empty.astype(np.int64))
+
+	buckets = np.floor_divide(timestamps, bucket_seconds) * bucket_seconds
+	starts = np.concatenate(([0], np.flatnonzero(np.diff(buckets)) + 1))
+	ends = np.concatenate((starts[1:], [len(buckets)]))
+
+	return dict(bucket = buckets[starts],
+				min = np.minimum.reduceat(values, starts),
+				max = np.maximum.reduceat(values, starts),
+				sum = np.add.reduceat(values, starts),
+				count = ends - starts,
+				last = values[ends - 1],
+				last_timestamp = timestamps[ends - 1])
+
+
+PARTIAL_FIELDS = ("bucket", "min", "max", "sum", "count", "last", "last_timestamp")
+
+
+def merge_partials(partials:List[Dict[str, np.ndarray]], bucket_seconds:int) -> Dict[str, np.ndarray]:
+	"""
+	Combines partial aggregates, as returned by `bucket_aggregate` or read from a rollup table, into
+	`bucket_seconds` wide buckets. Each partial bucket must lie entirely inside one target bucket, i.e. its
+	width must divide `bucket_seconds`. The partials may come in any order.
+	"""
+	merged = {field: np.concatenate([p[field] for p in partials]) if partials else np.empty(0) for field in PARTIAL_FIELDS}
+	if len(merged["bucket"]) == 0:
+		return bucket_aggregate(np.empty(0, dtype = np.int64), np.empty(0), bucket_seconds)
+
+	targets = np.floor_divide(merged["bucket"].astype(np.int64), bucket_seconds) * bucket_seconds
+	order = np.lexsort((merged["last_timestamp"], targets))
+	targets = targets[order]
+	merged = {field: values[order] for field, values in merged.items()}
+
+	starts = np.concatenate(([0], np.flatnonzero(np.diff(targets)) + 1))
+	ends = np.concatenate((starts[1:], [len(targets)]))
+
+	return dict(bucket = targets[starts],
+				min = np.minimum.reduceat(merged["min"], starts),
+				max = np.maximum.reduceat(merged["max"], starts),
+				sum = np.add.reduceat(merged["sum"], starts),
+				count = np.add.reduceat(merged["count"], starts),
+				last = merged["last"][ends - 1],
+				last_timestamp = merged["last_timestamp"][ends - 1])
+
+
+def lttb(timestamps:np.ndarray, values:np.ndarray, points:int) -> Series:
+	"""
+	Largest-Triangle-Three-Buckets downsampling (Steinarsson, 2013). Keeps the first and last sample and,
+	from each of `points - 2` equal-count buckets in between, the sample forming the largest triangle with
+	the previously kept sample and the average of the next bucket. Preserves the visual shape of the series.
+	"""
+	n = len(timestamps)
+	if points >= n or n <= 2:
+		return timestamps, values
+	if points <= 2:
+		keep = [0, n - 1][:max(points, 0)]
+		return timestamps[keep], values[keep]
+
+	x = timestamps.astype(np.float64)
+	y = values.astype(np.float64)
+	every = (n - 2) / (points - 2)
+
+	keep = np.empty(points, dtype = np.int64)
+	keep[0] = 0
+	a = 0
+	for i in range(points - 2):
+		start = int(math.floor(i * every)) + 1
+		end = int(math.floor((i + 1) * every)) + 1
+		next_end = min(int(math.floor((i + 2) * every)) + 1, n)
+		if i == points - 3:
+			next_start, next_end = n - 1, n
+		else:
+			next_start = end
+
+		avg_x = x[next_start:next_end].mean()
+		avg_y = y[next_start:next_end].mean()
+
+		area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+		a = start + int(np.argmax(area))
+		keep[i + 1] = a
+	keep[points - 1] = n - 1
+
+	return timestamps[keep], values[keep]
+
+
+def split_series(names:List[str], timestamps:np.ndarray, values:np.ndarray) -> Dict[str, Series]:
+	"""
+	Splits rows ordered by timestamp into one series per measurement name, each still ordered by timestamp.
+	"""
+	codes:Dict[str, int] = {}
+	name_codes = np.fromiter((codes.setdefault(name, len(codes)) for name in names), dtype = np.int64, count = len(names))
+
+	series = {}
+	for name, code in codes.items():
+		mask = name_codes == code
+		series[name] = (timestamps[mask], values[mask])
+	return series
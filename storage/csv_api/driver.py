@@ -1,121 +1,285 @@
+"""
+Append-only CSV log of pydantic records with a sidecar index.
+
+`<path>` holds a header line and one CSV row per record, only ever appended to. `<path>.idx` holds one
+fixed-size entry per row: (timestamp, key hash, byte offset, byte length), so opening a log reads the index
+and nothing else, and range queries seek straight to the matching rows through a memory map.
+"""
 import csv
-import pydantic
+import io
+import mmap
+import os
 import pathlib
+import threading
+from datetime import datetime
+from hashlib import blake2b
+from typing import Iterator, List, Optional, Tuple, Type
+
+import numpy as np
 from pydantic import BaseModel
-from typing import List, Optional, Tuple
-import csv
+
+INDEX_DTYPE = np.dtype([("timestamp", "<i8"), ("key", "<i8"), ("offset", "<i8"), ("length", "<i8")])
+
+
+def key_hash(key) -> int:
+	"""
+	64 bit hash of a key as the index stores it. Rows are compared by value after reading, so a collision
+	only costs reading an extra row.
+	"""
+	if key is None:
+		return 0
+	return int.from_bytes(blake2b(str(key).encode("utf-8"), digest_size = 8).digest(), "little", signed = True)
+
+
+def to_epoch(value) -> int:
+	if isinstance(value, datetime):
+		return int(value.timestamp())
+	if isinstance(value, (int, float)):
+		return int(value)
+	return 0
 
 
 class CSVWriter:
 	def __init__(self,
 				 path: str,
-				 schema: pydantic.BaseModel):
-		self.path = path
-		first_initialization = not pathlib.Path(path).exists()
-		if first_initialization:
-			pathlib.Path(path).touch()
-
-		fr = open(path, 'r')
-		self.reader = csv.reader(fr)
-		self.cache = [row for row in self.reader]
-		fr.close()
+				 schema: Type[BaseModel],
+				 timestamp_field: Optional[str] = "timestamp",
+				 key_field: Optional[str] = "key",
+				 flush_size: int = 1000):
+		"""
+		Appends records of `schema` to the log at `path`, creating it if needed.
 
+		timestamp_field  Field indexed for time range queries. Ignored if the schema has no such field.
+		key_field        Field indexed for exact key lookups. Ignored if the schema has no such field.
+		flush_size       Rows buffered in memory before they are written out. `flush` writes them earlier.
+		"""
+		self.path = path
+		self.index_path = path + ".idx"
 		self.schema = schema
 		self.keys = list(self.schema.__fields__.keys())
+		self.timestamp_field = timestamp_field if timestamp_field in self.keys else None
+		self.key_field = key_field if key_field in self.keys else None
+		self.flush_size = flush_size
 
-		fw = open(path, 'w', newline='')
-		self.writer = csv.writer(fw)
-		self.writer.writerows(self.cache)
+		self._lock = threading.Lock()
+		self._rows: List[bytes] = []
+		self._entries: List[Tuple[int, int]] = []
+		self.__open__()
 
-		if first_initialization:
-			self.writer.writerow(self.keys)
+	def __open__(self) -> None:
+		if not pathlib.Path(self.path).exists() or os.path.getsize(self.path) == 0:
+			with open(self.path, "wb") as f:
+				f.write(self.__encode__(self.keys))
+			open(self.index_path, "wb").close()
+		else:
+			with open(self.path, "rb") as f:
+				header = next(csv.reader([f.readline().decode("utf-8")]))
+			if header != self.keys:
+				raise ValueError(f"{self.path} has columns {header}, expected {self.keys}")
 
-	def write(self, data: pydantic.BaseModel):
+		self.index = np.fromfile(self.index_path, dtype = INDEX_DTYPE) if pathlib.Path(self.index_path).exists() \
+			else np.empty(0, dtype = INDEX_DTYPE)
+		self.__recover__()
+		self.data = open(self.path, "ab")
+		self.index_file = open(self.index_path, "ab")
 
-		keys = self.keys
-		empty = ["" for x in range(len(keys))]
-		present_keys = list(dict(data).keys())
+	def __recover__(self) -> None:
+		"""
+		Brings the index in line with the log after a crash between writing rows and their index entries.
+		"""
+		size = os.path.getsize(self.path)
+		# Entries for rows that never made it to disk
+		complete = self.index["offset"] + self.index["length"] <= size
+		if not complete.all():
+			self.index = self.index[:int(np.argmin(complete))]
+			self.index.tofile(self.index_path)
 
-		for i, k in enumerate(keys):
-			if dict(data)[k] is not None:
-				empty[i] = dict(data)[k]
-		print(empty)
-		self.writer.writerow(empty)
+		if len(self.index):
+			end = int(self.index["offset"][-1] + self.index["length"][-1])
+		else:
+			with open(self.path, "rb") as f:
+				end = len(f.readline())
+		if end == size:
+			return
 
-	def delete(self):
-		self.cache = []
-		del self.writer
-		pathlib.Path(self.path).unlink()
+		# Rows that made it to disk without their index entries
+		entries = []
+		with open(self.path, "rb") as f:
+			f.seek(end)
+			for line in f:
+				if not line.endswith(b"\n"):
+					break
+				record = self.__decode__(line)
+				entries.append(self.__entry__(record, end, len(line)))
+				end += len(line)
+		# A torn last row is dropped.
+		with open(self.path, "r+b") as f:
+			f.truncate(end)
+		recovered = np.array(entries, dtype = INDEX_DTYPE)
+		with open(self.index_path, "ab") as f:
+			recovered.tofile(f)
+		self.index = np.concatenate((self.index, recovered))
+
+	def __encode__(self, values: List) -> bytes:
+		buffer = io.StringIO()
+		csv.writer(buffer, lineterminator = "\n").writerow(values)
+		return buffer.getvalue().encode("utf-8")
+
+	def __decode__(self, line: bytes) -> BaseModel:
+		values = next(csv.reader([line.decode("utf-8")]))
+		return self.schema(**{k: v for k, v in zip(self.keys, values) if v != ""})
+
+	def __entry__(self, record: BaseModel, offset: int, length: int) -> Tuple[int, int, int, int]:
+		timestamp = to_epoch(getattr(record, self.timestamp_field)) if self.timestamp_field else 0
+		key = key_hash(getattr(record, self.key_field)) if self.key_field else 0
+		return timestamp, key, offset, length
 
-		self.__init__(self.path, self.schema)
+	@property
+	def pending(self) -> int:
+		return len(self._rows)
+
+	def write(self, data: BaseModel) -> None:
+		values = ["" if getattr(data, k) is None else getattr(data, k) for k in self.keys]
+		with self._lock:
+			self._rows.append(self.__encode__(values))
+			self._entries.append(self.__entry__(data, 0, 0)[:2])
+			if len(self._rows) >= self.flush_size:
+				self.__flush__()
+
+	def flush(self) -> None:
+		with self._lock:
+			self.__flush__()
+
+	def __flush__(self) -> None:
+		if not self._rows:
+			return
+		offset = self.data.tell()
+		entries = np.empty(len(self._rows), dtype = INDEX_DTYPE)
+		for i, (row, (timestamp, key)) in enumerate(zip(self._rows, self._entries)):
+			entries[i] = (timestamp, key, offset, len(row))
+			offset += len(row)
+
+		# Rows before their index entries, so a crash leaves rows `__recover__` can index, never dangling entries.
+		self.data.write(b"".join(self._rows))
+		self.data.flush()
+		self.index_file.write(entries.tobytes())
+		self.index_file.flush()
+		self.index = np.concatenate((self.index, entries))
+		self._rows = []
+		self._entries = []
+
+	def close(self) -> None:
+		self.flush()
+		self.data.close()
+		self.index_file.close()
+
+	def delete(self):
+		with self._lock:
+			self._rows = []
+			self._entries = []
+			self.data.close()
+			self.index_file.close()
+			pathlib.Path(self.path).unlink()
+			pathlib.Path(self.index_path).unlink()
+			self.__open__()
 
 
 class CSVAPI:
 	def __init__(self,
 				 path: str,
-				 schema: BaseModel):
-
+				 schema: Type[BaseModel],
+				 timestamp_field: Optional[str] = "timestamp",
+				 key_field: Optional[str] = "key",
+				 flush_size: int = 1000):
+		"""
+		Queryable append-only log. Records are parsed only when a query reads them.
+		"""
 		self.path = path
 		self.schema = schema
-		self.writer = CSVWriter(path=path, schema=schema)
-		self.state = self.writer.cache[1:]
-
-		__keys = self.writer.keys
-		__data = []
-		for line in self.state:
-			kwargs = {__keys[i]: line[i] for i in range(len(__keys))}
-			print(f">>>{kwargs}")
-			try:
-				__data.append(self.schema(**kwargs))
-			except Exception as e:
-				print(e)
-		self.state = __data
+		self.writer = CSVWriter(path = path, schema = schema, timestamp_field = timestamp_field,
+								key_field = key_field, flush_size = flush_size)
+		self._map: Optional[mmap.mmap] = None
+		self._map_file = None
+
+	def __len__(self) -> int:
+		return len(self.writer.index) + self.writer.pending
 
 	def write(self, payload: BaseModel):
 		self.schema.validate(payload)
 		self.writer.write(payload)
-		self.state.append(payload)
-		print(self.state)
 
-	def delete_in_memory(self):
-		self.state = []
+	def flush(self) -> None:
+		self.writer.flush()
+
+	def close(self) -> None:
+		self.__unmap__()
+		self.writer.close()
+
+	def __unmap__(self) -> None:
+		if self._map is not None:
+			self._map.close()
+			self._map_file.close()
+			self._map = None
+
+	def __mapped__(self) -> mmap.mmap:
+		"""
+		A read-only map of the log, remapped when it has grown past the end of the current one.
+		"""
+		size = os.path.getsize(self.path)
+		if self._map is None or len(self._map) < size:
+			self.__unmap__()
+			self._map_file = open(self.path, "rb")
+			self._map = mmap.mmap(self._map_file.fileno(), 0, access = mmap.ACCESS_READ)
+		return self._map
+
+	def query(self, time_range: Optional[Tuple[datetime, datetime]] = None,
+			  key = None) -> Iterator[BaseModel]:
+		"""
+		Records in insertion order with `time_range[0] <= timestamp < time_range[1]` and the given key.
+		Only the matching rows are read and parsed.
+		"""
+		if time_range is not None and self.writer.timestamp_field is None:
+			raise ValueError(f"{self.schema.__name__} has no indexed timestamp field")
+		if key is not None and self.writer.key_field is None:
+			raise ValueError(f"{self.schema.__name__} has no indexed key field")
+		self.writer.flush()
+		index = self.writer.index
+		mask = np.ones(len(index), dtype = bool)
+		if time_range is not None:
+			t1, t2 = sorted(to_epoch(t) for t in time_range)
+			mask &= (index["timestamp"] >= t1) & (index["timestamp"] < t2)
+		if key is not None:
+			mask &= index["key"] == key_hash(key)
+
+		selected = index[mask]
+		if not len(selected):
+			return
+		data = self.__mapped__()
+		for offset, length in zip(selected["offset"].tolist(), selected["length"].tolist()):
+			record = self.writer.__decode__(data[offset:offset + length])
+			if key is None or getattr(record, self.writer.key_field) == key:
+				yield record
 
 	def delete_disk(self):
+		self.__unmap__()
 		self.writer.delete()
 
-	def get_data(self):
-		return self.state
+	def get_data(self) -> List[BaseModel]:
+		return list(self.query())
 
 
 if __name__ == "__main__":
 	class Test(BaseModel):
-		a: str
+		key: str
+		timestamp: int
 		b: str
-		c: str
 		d: Optional[str]
 
 
-	writer = CSVWriter(path="test.json",
-					   schema=Test
-					   )
-
-	foo = Test(a="a1",
-			   b="b1",
-			   c="c1",
-			   d="d1")
-
-	bar = Test(a="a2",
-			   b="b2",
-			   c="c2",
-			   )
-	writer.write(foo)
-	writer.write(bar)
-	writer.delete()
-	writer.write(bar)
-	writer.write(bar)
-
-	writer2 = CSVAPI(path="test2.json", schema=Test)
-	writer2.write(foo)
-	writer2.write(bar)
-	writer2.write(bar)
-	print(writer2.get_data())
+	api = CSVAPI(path = "test.csv", schema = Test, flush_size = 2)
+	api.write(Test(key = "a", timestamp = 1, b = "b1", d = "d1"))
+	api.write(Test(key = "b", timestamp = 2, b = "b2"))
+	api.write(Test(key = "a", timestamp = 3, b = "b3"))
+	print(list(api.query(key = "a")))
+	print(list(api.query(time_range = (datetime.fromtimestamp(2), datetime.fromtimestamp(4)))))
+	api.delete_disk()
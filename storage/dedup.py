@@ -0,0 +1,72 @@
+"""
+Remembers recently ingested samples so re-sent uploads can be recognised before they reach storage.
+"""
+import math
+import threading
+from hashlib import blake2b
+from typing import Iterable, List, Tuple
+
+from .models import Measurement
+
+# (key, measurement_name, epoch timestamp), what the storage unique index is on
+SampleId = Tuple[str, str, int]
+
+
+def sample_id(m:Measurement) -> SampleId:
+	return m.key, m.measurement_name, int(m.timestamp.timestamp())
+
+
+class BloomFilter:
+	def __init__(self, capacity:int, false_positive_rate:float):
+		self.capacity = capacity
+		self.bits = max(8, int(-capacity * math.log(false_positive_rate) / math.log(2) ** 2))
+		self.hashes = max(1, round(self.bits / capacity * math.log(2)))
+		self.count = 0
+		self._array = bytearray((self.bits + 7) // 8)
+
+	def __positions__(self, item:SampleId) -> List[int]:
+		# Double hashing: k positions from the two halves of one digest.
+		digest = blake2b("\x1f".join(map(str, item)).encode("utf-8"), digest_size = 16).digest()
+		h1 = int.from_bytes(digest[:8], "little")
+		h2 = int.from_bytes(digest[8:], "little") | 1
+		return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+	def add(self, item:SampleId) -> None:
+		for position in self.__positions__(item):
+			self._array[position >> 3] |= 1 << (position & 7)
+		self.count += 1
+
+	def __contains__(self, item:SampleId) -> bool:
+		return all(self._array[position >> 3] & (1 << (position & 7)) for position in self.__positions__(item))
+
+
+class RecentSamples:
+	def __init__(self, capacity:int = 1000000, false_positive_rate:float = 0.01):
+		"""
+		Probabilistic set of the last `capacity` to 2 * `capacity` samples added, in two Bloom filters of
+		`capacity` each: once the newer one is full, the older one is dropped.
+
+		A miss means the sample was not seen recently. A hit may be a false positive, at about
+		`false_positive_rate` per generation, so it has to be confirmed with storage.
+		"""
+		self.capacity = capacity
+		self.false_positive_rate = false_positive_rate
+		self._current = BloomFilter(capacity, false_positive_rate)
+		self._previous = BloomFilter(capacity, false_positive_rate)
+		self._lock = threading.Lock()
+
+	@property
+	def nbytes(self) -> int:
+		return len(self._current._array) + len(self._previous._array)
+
+	def might_contain(self, item:SampleId) -> bool:
+		with self._lock:
+			return item in self._current or item in self._previous
+
+	def add_all(self, items:Iterable[SampleId]) -> None:
+		with self._lock:
+			for item in items:
+				if self._current.count >= self.capacity:
+					self._previous = self._current
+					self._current = BloomFilter(self.capacity, self.false_positive_rate)
+				self._current.add(item)
@@ -0,0 +1,42 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Callable, Iterator, TypeVar
+
+T = TypeVar("T")
+
+_DONE = object()
+
+
+class StorageExecutor:
+	def __init__(self, max_workers:int = 4):
+		"""
+		Bounded thread pool for running blocking storage calls from async endpoints, so a slow query
+		occupies one worker instead of the event loop.
+
+		max_workers  Upper bound on concurrent storage calls. Each worker keeps its own read connection.
+		"""
+		self.max_workers = max_workers
+		self.in_flight = 0
+		self._pool = ThreadPoolExecutor(max_workers = max_workers, thread_name_prefix = "storage-read")
+
+	async def run(self, fn:Callable[..., T], *args, **kwargs) -> T:
+		loop = asyncio.get_running_loop()
+		self.in_flight += 1
+		try:
+			return await loop.run_in_executor(self._pool, functools.partial(fn, *args, **kwargs))
+		finally:
+			self.in_flight -= 1
+
+	async def iterate(self, iterator:Iterator[T]) -> AsyncIterator[T]:
+		"""
+		Pulls each item of a blocking iterator on the pool.
+		"""
+		while True:
+			item = await self.run(next, iterator, _DONE)
+			if item is _DONE:
+				return
+			yield item
+
+	def shutdown(self) -> None:
+		self._pool.shutdown(wait = True)
@@ -0,0 +1,305 @@
+"""
+In-memory tier holding the most recent samples of every (key, measurement_name) series in NumPy ring
+buffers, in front of a storage adapter.
+
+Each series knows from which timestamp on it is complete, i.e. holds every stored sample: the start of the
+window loaded at `warm` time, moved forward whenever a sample has to be evicted. Bounded reads of one
+station whose time range starts inside that window are answered from memory; everything else goes to storage.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from itertools import chain
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+
+from .models import Measurement, MeasurementsQuery, MeasurementsCursor, MeasurementRecord
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = {"seq": np.int64,
+		   "timestamp": np.int64,
+		   "receipt_time": np.int64,
+		   "value": np.float64,
+		   "latitude": np.float64,
+		   "longitude": np.float64,
+		   "unit": np.int32,
+		   "hardware": np.int32}
+BYTES_PER_SAMPLE = sum(np.dtype(dtype).itemsize for dtype in COLUMNS.values())
+INITIAL_CAPACITY = 64
+
+
+class SeriesRing:
+	def __init__(self, capacity:int):
+		"""
+		The latest `capacity` samples of one series. Storage grows by doubling until `capacity` is reached,
+		then the oldest sample is overwritten.
+		"""
+		self.capacity = capacity
+		self.latest = -2 ** 63
+		self.count = 0
+		self.head = 0
+		self.arrays = {name: np.empty(min(INITIAL_CAPACITY, capacity), dtype = dtype) for name, dtype in COLUMNS.items()}
+
+	@property
+	def nbytes(self) -> int:
+		return len(self.arrays["seq"]) * BYTES_PER_SAMPLE
+
+	def append(self, sample:Tuple) -> Optional[int]:
+		"""
+		Adds a sample given in COLUMNS order. Returns the timestamp of the sample it overwrote, if any.
+		"""
+		size = len(self.arrays["seq"])
+		if self.count == size and size < self.capacity:
+			grown = min(size * 2, self.capacity)
+			for name, array in self.arrays.items():
+				self.arrays[name] = np.concatenate((array, np.empty(grown - size, dtype = array.dtype)))
+			self.head = size
+			size = grown
+
+		evicted = None
+		if self.count == size:
+			evicted = int(self.arrays["timestamp"][self.head])
+		else:
+			self.count += 1
+		for array, value in zip(self.arrays.values(), sample):
+			array[self.head] = value
+		self.latest = max(self.latest, sample[1])
+		self.head = (self.head + 1) % size
+		return evicted
+
+	def contains(self, timestamp:int) -> bool:
+		return bool((self.arrays["timestamp"][:self.count] == timestamp).any())
+
+	def snapshot(self) -> Dict[str, np.ndarray]:
+		return {name: array[:self.count].copy() for name, array in self.arrays.items()}
+
+
+class HotTierAdapter:
+	def __init__(self, storage,
+				 samples_per_series:int = 10000,
+				 window_seconds:float = 86400,
+				 max_bytes:int = 256 * 2 ** 20):
+		"""
+		Wraps a storage adapter. Writes go to storage and then into memory; reads the tier can answer
+		completely are served from memory. Every other attribute is the wrapped adapter's.
+
+		samples_per_series  Ring size of each series.
+		window_seconds      How far back `warm` loads from storage.
+		max_bytes           Memory budget of all rings together. Least recently used series are dropped beyond it.
+		"""
+		self.storage = storage
+		self.samples_per_series = samples_per_series
+		self.window_seconds = window_seconds
+		self.max_bytes = max_bytes
+
+		self._lock = threading.Lock()
+		self._seq = 0
+		self._nbytes = 0
+		# Until warmed, nothing is known to be complete.
+		self._since = float("inf")
+		# (key, measurement_name) -> ring, least recently used first
+		self._rings:"OrderedDict[Tuple[str, str], SeriesRing]" = OrderedDict()
+		# (key, measurement_name) -> first timestamp the series is complete from, where later than `_since`
+		self._complete_since:Dict[Tuple[str, str], int] = {}
+		self._names:Dict[str, Set[str]] = {}
+		self._strings:List[str] = []
+		self._codes:Dict[str, int] = {}
+
+	def __getattr__(self, name):
+		return getattr(self.storage, name)
+
+	@property
+	def nbytes(self) -> int:
+		return self._nbytes
+
+	def warm(self) -> int:
+		"""
+		Loads the last `window_seconds` from storage. Returns the number of samples loaded.
+		"""
+		since = int(time.time() - self.window_seconds)
+		query = MeasurementsQuery(time_range = (datetime.fromtimestamp(since), datetime(9999, 1, 1)))
+		loaded = 0
+		with self._lock:
+			self._since = float("inf")
+			self._rings.clear()
+			self._complete_since.clear()
+			self._names.clear()
+			self._nbytes = 0
+			for chunk in self.storage.iter_bounded_records(query):
+				self.__ingest__(chunk)
+				loaded += len(chunk)
+			self._since = since + 1
+		logger.info(f"Hot tier warmed with {loaded} samples in {len(self._rings)} series, {self._nbytes / 2 ** 20:.1f} MiB")
+		return loaded
+
+	def insert_measurement(self, m:Measurement) -> None:
+		self.insert_measurements([m])
+
+	def insert_measurements(self, m:List[Measurement]) -> int:
+		inserted = self.storage.insert_measurements(m)
+		records = [MeasurementRecord.from_measurement(x) for x in m]
+		with self._lock:
+			self.__ingest__(records)
+		return inserted
+
+	def drop_expired(self, *args, **kwargs):
+		dropped = self.storage.drop_expired(*args, **kwargs)
+		if dropped:
+			# The rings may hold samples of what was dropped; load again what storage still has.
+			self.warm()
+		return dropped
+
+	def __string_code__(self, string:str) -> int:
+		code = self._codes.get(string)
+		if code is None:
+			code = self._codes[string] = len(self._strings)
+			self._strings.append(string)
+		return code
+
+	def __ingest__(self, records:Iterable[MeasurementRecord]) -> None:
+		for r in records:
+			series = (r.key, r.measurement_name)
+			complete_since = self._complete_since.get(series, self._since)
+			if r.timestamp < complete_since and complete_since != float("inf"):
+				# Older than what the tier covers for this series; only storage needs it.
+				continue
+
+			ring = self._rings.get(series)
+			if ring is not None and r.timestamp <= ring.latest and ring.contains(r.timestamp):
+				# Storage ignores re-sent samples, so must the tier.
+				continue
+			if ring is None:
+				ring = self._rings[series] = SeriesRing(self.samples_per_series)
+				self._names.setdefault(r.key, set()).add(r.measurement_name)
+				self._nbytes += ring.nbytes
+			self._rings.move_to_end(series)
+
+			before = ring.nbytes
+			evicted = ring.append((self._seq, r.timestamp, r.receipt_time, r.value, r.latitude, r.longitude,
+								   self.__string_code__(r.unit), self.__string_code__(r.hardware)))
+			self._seq += 1
+			self._nbytes += ring.nbytes - before
+			if evicted is not None:
+				self._complete_since[series] = max(self._complete_since.get(series, evicted + 1), evicted + 1)
+
+		while self._nbytes > self.max_bytes and len(self._rings) > 1:
+			(key, name), ring = self._rings.popitem(last = False)
+			self._nbytes -= ring.nbytes
+			if ring.count:
+				# Whatever arrives for the series from now on is all the tier will know of it.
+				last = int(ring.arrays["timestamp"][:ring.count].max())
+				self._complete_since[(key, name)] = max(self._complete_since.get((key, name), last + 1), last + 1)
+
+	def __hot_rows__(self, query:MeasurementsQuery, limit:Optional[int],
+					 after:Optional[MeasurementsCursor]) -> Optional[List[Tuple]]:
+		"""
+		The result of `query` as RAW_COLUMNS tuples if memory holds all of it, otherwise None.
+		"""
+		if query.key is None or query.time_range is None or after is not None:
+			return None
+		t1, t2 = sorted(int(t.timestamp()) for t in query.time_range)
+
+		with self._lock:
+			if query.measurement_name is not None:
+				names = {query.measurement_name}
+			elif t1 + 1 < self._since:
+				# Series of the key the tier has not seen may have data here.
+				return None
+			else:
+				names = self._names.get(query.key, set())
+			snapshots = []
+			for name in names:
+				series = (query.key, name)
+				if t1 + 1 < self._complete_since.get(series, self._since):
+					return None
+				ring = self._rings.get(series)
+				if ring is not None:
+					self._rings.move_to_end(series)
+					snapshots.append((name, ring.snapshot()))
+			strings = list(self._strings)
+
+		if not snapshots:
+			return []
+
+		columns = {column: np.concatenate([s[column] for _, s in snapshots]) for column in COLUMNS}
+		series_names = np.concatenate([np.full(len(s["seq"]), i) for i, (_, s) in enumerate(snapshots)])
+
+		mask = (columns["timestamp"] > t1) & (columns["timestamp"] < t2)
+		if query.lats is not None:
+			lat1, lat2 = sorted(query.lats)
+			mask &= (columns["latitude"] > lat1) & (columns["latitude"] < lat2)
+		if query.lons is not None:
+			lon1, lon2 = sorted(query.lons)
+			mask &= (columns["longitude"] > lon1) & (columns["longitude"] < lon2)
+		if query.receipt_time_range is not None:
+			r1, r2 = sorted(int(t.timestamp()) for t in query.receipt_time_range)
+			mask &= (columns["receipt_time"] > r1) & (columns["receipt_time"] < r2)
+		if query.unit is not None:
+			mask &= columns["unit"] == self._codes.get(query.unit, -1)
+		if query.hardware is not None:
+			mask &= columns["hardware"] == self._codes.get(query.hardware, -1)
+
+		selected = np.flatnonzero(mask)
+		# Storage orders by (timestamp, id); ids follow arrival order, as does seq.
+		selected = selected[np.lexsort((columns["seq"][selected], columns["timestamp"][selected]))]
+		if limit is not None:
+			selected = selected[:limit]
+
+		return [(query.key, snapshots[s][0], strings[u], v, t, rt, la, lo, strings[h]) for s, t, rt, v, la, lo, u, h in
+				zip(series_names[selected].tolist(), columns["timestamp"][selected].tolist(),
+					columns["receipt_time"][selected].tolist(), columns["value"][selected].tolist(),
+					columns["latitude"][selected].tolist(), columns["longitude"][selected].tolist(),
+					columns["unit"][selected].tolist(), columns["hardware"][selected].tolist())]
+
+	def iter_bounded_rows(self, query:MeasurementsQuery,
+						  limit:Optional[int] = None,
+						  chunk_size:int = 10000,
+						  after:Optional[MeasurementsCursor] = None) -> Iterator[List[Tuple]]:
+		rows = self.__hot_rows__(query, limit, after)
+		if rows is None:
+			yield from self.storage.iter_bounded_rows(query, limit = limit, chunk_size = chunk_size, after = after)
+			return
+		for i in range(0, len(rows), chunk_size):
+			yield rows[i:i + chunk_size]
+
+	def iter_bounded_records(self, query:MeasurementsQuery,
+							 limit:Optional[int] = None,
+							 chunk_size:int = 10000,
+							 after:Optional[MeasurementsCursor] = None) -> Iterator[List[MeasurementRecord]]:
+		for rows in self.iter_bounded_rows(query, limit = limit, chunk_size = chunk_size, after = after):
+			yield [MeasurementRecord._make(x) for x in rows]
+
+	def iter_bounded_chunks(self, query:MeasurementsQuery,
+							limit:Optional[int] = None,
+							chunk_size:int = 1000,
+							after:Optional[MeasurementsCursor] = None) -> Iterator[List[Measurement]]:
+		rows = self.__hot_rows__(query, limit, after)
+		if rows is None:
+			yield from self.storage.iter_bounded_chunks(query, limit = limit, chunk_size = chunk_size, after = after)
+			return
+		for i in range(0, len(rows), chunk_size):
+			yield [Measurement(key = r.key, measurement_name = r.measurement_name, unit = r.unit, value = r.value,
+							   timestamp = datetime.fromtimestamp(r.timestamp), receipt_time = datetime.fromtimestamp(r.receipt_time),
+							   latitude = r.latitude, longitude = r.longitude, hardware = r.hardware)
+				   for r in map(MeasurementRecord._make, rows[i:i + chunk_size])]
+
+	def get_record_page(self, query:MeasurementsQuery,
+						limit:int,
+						after:Optional[MeasurementsCursor] = None) -> Tuple[List[MeasurementRecord], Optional[MeasurementsCursor]]:
+		"""
+		First pages that hold the whole result come from memory. A cursor needs the row id of the page's
+		last row, which the tier does not keep, so longer results and later pages are read from storage.
+		"""
+		rows = self.__hot_rows__(query, limit + 1, after)
+		if rows is not None and len(rows) <= limit:
+			return [MeasurementRecord._make(x) for x in rows], None
+		return self.storage.get_record_page(query, limit = limit, after = after)
+
+	def get_bounded(self, query:MeasurementsQuery,
+					limit:Optional[int] = None,
+					after:Optional[MeasurementsCursor] = None) -> Iterable[Measurement]:
+		return chain.from_iterable(self.iter_bounded_chunks(query, limit = limit, after = after))
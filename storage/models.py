@@ -1,19 +1,40 @@
-from pydantic import BaseModel
-from typing import List, Tuple, Dict, Optional, Union
+from pydantic import BaseModel, StrictInt
+from typing import List, NamedTuple, Tuple, Dict, Optional, Union
 
+import base64
 from datetime import datetime
 
 class Measurement(BaseModel):
 	key: str
 	measurement_name:str
 	unit:str
-	value:Union[int, float]
+	value:Union[StrictInt, float] # StrictInt first, so a float is never truncated by int()
 	timestamp:datetime
 	receipt_time:datetime
 	latitude:float
 	longitude:float
 	hardware:str
 
+class MeasurementRecord(NamedTuple):
+	"""
+	A stored measurement as a plain tuple, for read paths that skip model construction. Same fields, in
+	the same order, as `Measurement`, but with the timestamps left as epoch seconds.
+	"""
+	key: str
+	measurement_name:str
+	unit:str
+	value:float
+	timestamp:int
+	receipt_time:int
+	latitude:float
+	longitude:float
+	hardware:str
+
+	@classmethod
+	def from_measurement(cls, m:Measurement) -> "MeasurementRecord":
+		return cls(m.key, m.measurement_name, m.unit, m.value, int(m.timestamp.timestamp()),
+				   int(m.receipt_time.timestamp()), m.latitude, m.longitude, m.hardware)
+
 class MeasurementsQuery(BaseModel):
 	lats:Optional[Tuple[float, float]]
 	lons:Optional[Tuple[float, float]]
@@ -25,6 +46,31 @@ class MeasurementsQuery(BaseModel):
 	unit:Optional[str]
 
 
+class MeasurementsCursor(BaseModel):
+	"""
+	Position after the last measurement of a page. Results are ordered by (timestamp, id), so the next
+	page starts strictly after this pair. Clients only ever see the opaque `encode()` form.
+	"""
+	timestamp:int
+	id:int
+
+	def encode(self) -> str:
+		raw = f"{self.timestamp}:{self.id}".encode("ascii")
+		return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+	@classmethod
+	def decode(cls, token:str) -> "MeasurementsCursor":
+		"""
+		Raises ValueError for anything that wasn't produced by `encode`.
+		"""
+		try:
+			raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode("ascii")
+			timestamp, id = raw.split(":")
+			return cls(timestamp = int(timestamp), id = int(id))
+		except Exception as e:
+			raise ValueError(f"Invalid cursor {token!r}") from e
+
+
 # class StationContext(BaseModel):
 # 	lat: float
 # 	lon: float
@@ -38,4 +84,19 @@ class LatestStationMeta(BaseModel):
 	lat: float
 	lon: float
 	latest_time: datetime
-	station_key: str
\ No newline at end of file
+	station_key: str
+
+class AggregateBucket(BaseModel):
+	measurement_name: str
+	bucket_start: datetime
+	min: float
+	max: float
+	mean: float
+	count: int
+	last: float
+
+
+class DownsampledSeries(BaseModel):
+	measurement_name: str
+	timestamps: List[datetime]
+	values: List[float]
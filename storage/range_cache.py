@@ -0,0 +1,282 @@
+"""
+Cache of bounded reads over historical time windows, in front of a storage adapter.
+
+Time is cut into fixed, epoch aligned chunks of `chunk_seconds`. A single station query with a time range is
+answered chunk by chunk, each chunk cached under the query's other filters, so overlapping windows (yesterday,
+the last week) share the chunks they have in common. Only chunks that have ended are cached; the part of a
+window in the current chunk always comes from storage. A late sample written into a cached chunk drops that
+chunk for its station.
+
+A window that covers only part of a chunk fills that chunk on its second miss: a one-off window reads just its
+own rows, while a window that comes back pays for the whole chunk once.
+"""
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from itertools import chain
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from .models import Measurement, MeasurementsQuery, MeasurementsCursor, MeasurementRecord
+
+TIMESTAMP = MeasurementRecord._fields.index("timestamp")
+# Rough size of one cached row tuple with its strings and floats, for the memory budget.
+ROW_BYTES = 400
+# Partially read chunks remembered for admission.
+MAX_MISSED = 8192
+
+# (key, measurement_name, lats, lons, receipt_time_range, unit, hardware)
+Filters = Tuple
+CacheKey = Tuple[Filters, int]
+
+
+def query_filters(query:MeasurementsQuery) -> Filters:
+	"""
+	Everything but the time range of `query`, normalized so equal filters compare equal.
+	"""
+	receipt_time_range = None if query.receipt_time_range is None else \
+		tuple(sorted(int(t.timestamp()) for t in query.receipt_time_range))
+	return (query.key,
+			query.measurement_name,
+			None if query.lats is None else tuple(sorted(query.lats)),
+			None if query.lons is None else tuple(sorted(query.lons)),
+			receipt_time_range,
+			query.unit,
+			query.hardware)
+
+
+class RangeCacheAdapter:
+	def __init__(self, storage,
+				 chunk_seconds:int = 3600,
+				 max_bytes:int = 64 * 2 ** 20,
+				 max_chunks_per_query:int = 24 * 366):
+		"""
+		Wraps a storage adapter. Bounded reads of one station over a time range are served from cached chunks
+		where possible; every other call, and every other attribute, is the wrapped adapter's.
+
+		chunk_seconds         Width of the cached time chunks.
+		max_bytes             Approximate memory budget. Least recently used chunks are dropped beyond it.
+		max_chunks_per_query  Longer windows go straight to storage.
+		"""
+		self.storage = storage
+		self.chunk_seconds = chunk_seconds
+		self.max_bytes = max_bytes
+		self.max_chunks_per_query = max_chunks_per_query
+
+		self.hits = 0
+		self.misses = 0
+		self._nbytes = 0
+		self._lock = threading.Lock()
+		# least recently used first
+		self._entries:"OrderedDict[CacheKey, List[Tuple]]" = OrderedDict()
+		# chunk start -> cache keys of that chunk
+		self._by_chunk:Dict[int, Set[CacheKey]] = {}
+		# Writes into ended chunks so far. A fill that overlapped one is not kept, it may predate the write.
+		self._late_writes = 0
+		# Chunks missed once by a window covering only part of them, least recently missed first.
+		self._missed:"OrderedDict[CacheKey, None]" = OrderedDict()
+
+	def __getattr__(self, name):
+		return getattr(self.storage, name)
+
+	def __len__(self) -> int:
+		return len(self._entries)
+
+	@property
+	def nbytes(self) -> int:
+		return self._nbytes
+
+	@property
+	def hit_ratio(self) -> float:
+		lookups = self.hits + self.misses
+		return self.hits / lookups if lookups else 0.0
+
+	def clear(self) -> None:
+		with self._lock:
+			self._entries.clear()
+			self._by_chunk.clear()
+			self._missed.clear()
+			self._nbytes = 0
+			self._late_writes += 1
+
+	def insert_measurement(self, m:Measurement) -> None:
+		self.insert_measurements([m])
+
+	def insert_measurements(self, m:List[Measurement]) -> int:
+		inserted = self.storage.insert_measurements(m)
+		# Taken after the write, so a chunk that ends after this point is read with the write in it.
+		current = self.__chunk_start__(int(time.time()))
+		late:Dict[int, Set[str]] = {}
+		for x in m:
+			start = self.__chunk_start__(int(x.timestamp.timestamp()))
+			if start < current:
+				late.setdefault(start, set()).add(x.key)
+		if late:
+			with self._lock:
+				self._late_writes += 1
+				for start, keys in late.items():
+					for cache_key in [k for k in self._by_chunk.get(start, ()) if k[0][0] in keys]:
+						self.__evict__(cache_key)
+		return inserted
+
+	def drop_expired(self, *args, **kwargs):
+		dropped = self.storage.drop_expired(*args, **kwargs)
+		if dropped:
+			self.clear()
+		return dropped
+
+	def __chunk_start__(self, timestamp:int) -> int:
+		return timestamp // self.chunk_seconds * self.chunk_seconds
+
+	def __evict__(self, cache_key:CacheKey) -> None:
+		rows = self._entries.pop(cache_key)
+		self._nbytes -= len(rows) * ROW_BYTES
+		keys = self._by_chunk[cache_key[1]]
+		keys.discard(cache_key)
+		if not keys:
+			del self._by_chunk[cache_key[1]]
+
+	def __store__(self, cache_key:CacheKey, rows:List[Tuple], late_writes:int) -> None:
+		size = len(rows) * ROW_BYTES
+		with self._lock:
+			if late_writes != self._late_writes or size > self.max_bytes // 8 or cache_key in self._entries:
+				return
+			self._entries[cache_key] = rows
+			self._by_chunk.setdefault(cache_key[1], set()).add(cache_key)
+			self._nbytes += size
+			while self._nbytes > self.max_bytes:
+				self.__evict__(next(iter(self._entries)))
+
+	def __missed__(self, cache_key:CacheKey) -> bool:
+		"""
+		Whether a partial read of `cache_key` missed before, remembering this miss if not. Called with the lock held.
+		"""
+		if cache_key in self._missed:
+			del self._missed[cache_key]
+			return True
+		self._missed[cache_key] = None
+		if len(self._missed) > MAX_MISSED:
+			self._missed.popitem(last = False)
+		return False
+
+	def __fetch__(self, query:MeasurementsQuery, t1:int, t2:int) -> List[Tuple]:
+		"""
+		Rows of `query` with t1 < timestamp < t2, from storage.
+		"""
+		bounded = query.copy(update = dict(time_range = (datetime.fromtimestamp(t1), datetime.fromtimestamp(t2))))
+		return [row for rows in self.storage.iter_bounded_rows(bounded) for row in rows]
+
+	def __cached_rows__(self, query:MeasurementsQuery,
+						after:Optional[MeasurementsCursor]) -> Optional[Iterator[List[Tuple]]]:
+		"""
+		The rows of `query`, one list per chunk in timestamp order, or None if the query is not cacheable.
+		"""
+		if query.key is None or query.time_range is None or after is not None:
+			return None
+		t1, t2 = sorted(int(t.timestamp()) for t in query.time_range)
+		# Storage returns t1 < timestamp < t2; whole chunks are cached only before the current one.
+		current = self.__chunk_start__(int(time.time()))
+		first = self.__chunk_start__(t1 + 1)
+		end = min(self.__chunk_start__(t2 - 1) + self.chunk_seconds, current)
+		if end <= first or (end - first) // self.chunk_seconds > self.max_chunks_per_query:
+			return None
+		return self.__iter_chunks__(query, t1, t2, first, end)
+
+	def __iter_chunks__(self, query:MeasurementsQuery, t1:int, t2:int, first:int, end:int) -> Iterator[List[Tuple]]:
+		filters = query_filters(query)
+		trim = lambda rows: [r for r in rows if t1 < r[TIMESTAMP] < t2]
+		whole = lambda chunk: t1 < chunk and chunk + self.chunk_seconds <= t2
+
+		start = first
+		while start < end:
+			cache_key = (filters, start)
+			with self._lock:
+				rows = self._entries.get(cache_key)
+				if rows is not None:
+					self._entries.move_to_end(cache_key)
+					self.hits += 1
+			if rows is not None:
+				yield rows if whole(start) else trim(rows)
+				start += self.chunk_seconds
+				continue
+
+			# One storage read for the whole run of missing chunks. Only its first and last chunk can be partial.
+			with self._lock:
+				late_writes = self._late_writes
+				run_end = start
+				while run_end < end and (filters, run_end) not in self._entries:
+					run_end += self.chunk_seconds
+					self.misses += 1
+				last = run_end - self.chunk_seconds
+				fill = {chunk: whole(chunk) or self.__missed__((filters, chunk)) for chunk in {start, last}}
+			fetched = self.__fetch__(query, start - 1 if fill[start] else t1, run_end if fill[last] else t2)
+			i = 0
+			for chunk in range(start, run_end, self.chunk_seconds):
+				j = i
+				while j < len(fetched) and fetched[j][TIMESTAMP] < chunk + self.chunk_seconds:
+					j += 1
+				rows = fetched[i:j]
+				if fill.get(chunk, True):
+					self.__store__((filters, chunk), rows, late_writes)
+				yield rows if whole(chunk) else trim(rows)
+				i = j
+			start = run_end
+
+		if end < t2:
+			yield self.__fetch__(query, max(t1, end - 1), t2)
+
+	def iter_bounded_rows(self, query:MeasurementsQuery,
+						  limit:Optional[int] = None,
+						  chunk_size:int = 10000,
+						  after:Optional[MeasurementsCursor] = None) -> Iterator[List[Tuple]]:
+		chunks = self.__cached_rows__(query, after)
+		if chunks is None:
+			yield from self.storage.iter_bounded_rows(query, limit = limit, chunk_size = chunk_size, after = after)
+			return
+
+		remaining = limit
+		for rows in chunks:
+			if remaining is not None:
+				rows = rows[:remaining]
+				remaining -= len(rows)
+			for i in range(0, len(rows), chunk_size):
+				yield rows[i:i + chunk_size]
+			if remaining == 0:
+				return
+
+	def iter_bounded_records(self, query:MeasurementsQuery,
+							 limit:Optional[int] = None,
+							 chunk_size:int = 10000,
+							 after:Optional[MeasurementsCursor] = None) -> Iterator[List[MeasurementRecord]]:
+		for rows in self.iter_bounded_rows(query, limit = limit, chunk_size = chunk_size, after = after):
+			yield [MeasurementRecord._make(x) for x in rows]
+
+	def iter_bounded_chunks(self, query:MeasurementsQuery,
+							limit:Optional[int] = None,
+							chunk_size:int = 1000,
+							after:Optional[MeasurementsCursor] = None) -> Iterator[List[Measurement]]:
+		if self.__cached_rows__(query, after) is None:
+			yield from self.storage.iter_bounded_chunks(query, limit = limit, chunk_size = chunk_size, after = after)
+			return
+		for records in self.iter_bounded_records(query, limit = limit, chunk_size = chunk_size, after = after):
+			yield [Measurement(key = r.key, measurement_name = r.measurement_name, unit = r.unit, value = r.value,
+							   timestamp = datetime.fromtimestamp(r.timestamp), receipt_time = datetime.fromtimestamp(r.receipt_time),
+							   latitude = r.latitude, longitude = r.longitude, hardware = r.hardware) for r in records]
+
+	def get_record_page(self, query:MeasurementsQuery,
+						limit:int,
+						after:Optional[MeasurementsCursor] = None) -> Tuple[List[MeasurementRecord], Optional[MeasurementsCursor]]:
+		"""
+		First pages that hold the whole result come from the cache. A cursor needs the row id of the page's
+		last row, which cached rows do not carry, so longer results and later pages are read from storage.
+		"""
+		if self.__cached_rows__(query, after) is not None:
+			records = [r for rows in self.iter_bounded_records(query, limit = limit + 1) for r in rows]
+			if len(records) <= limit:
+				return records, None
+		return self.storage.get_record_page(query, limit = limit, after = after)
+
+	def get_bounded(self, query:MeasurementsQuery,
+					limit:Optional[int] = None,
+					after:Optional[MeasurementsCursor] = None) -> Iterable[Measurement]:
+		return chain.from_iterable(self.iter_bounded_chunks(query, limit = limit, after = after))
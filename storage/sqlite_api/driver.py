@@ -1,25 +1,172 @@
-from sqlalchemy import Table, Column, Integer, String, MetaData, Numeric, DateTime, Float
-from sqlalchemy import or_, and_
+from sqlalchemy import Table, Column, Integer, String, MetaData, Numeric, DateTime, Float, Index
+from sqlalchemy import or_, and_, tuple_, literal, type_coerce
 from sqlalchemy import select, text
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.schema import CreateTable, CreateIndex
+from sqlalchemy.types import TypeDecorator
 from datetime import datetime
 from sqlalchemy import bindparam
 
 from pydantic import BaseModel
-from typing import List, Dict, Tuple, Union, Iterable, Optional
+from typing import List, Dict, Set, Tuple, Union, Iterable, Iterator, Optional
+from itertools import chain
 from sqlalchemy.orm import sessionmaker
 
 import sys
 sys.path.append("../")
-from ..models import Measurement, MeasurementsQuery, LatestStationMeta #StationContext, StationMeta
+from ..models import Measurement, MeasurementsQuery, MeasurementsCursor, LatestStationMeta #StationContext, StationMeta
+from ..models import AggregateBucket, DownsampledSeries, MeasurementRecord
+from ..aggregation import Series, bucket_aggregate, merge_partials, lttb, split_series
+from collections import defaultdict
+import numpy as np
 import pathlib
 import os
+import threading
 
 CURRENT_DIR = pathlib.Path(os.path.dirname(os.path.abspath(__file__)))
 
+# Stored in `PRAGMA user_version`. Databases created before versioning report 0.
+#   0: timestamp/receipt_time as DateTime text, no secondary indexes
+#   1: timestamp/receipt_time as integer epoch seconds, indexed
+#   2: latest_station table, kept current by a trigger on measurements
+#   3: rollups table, kept current by a trigger on measurements
+#   4: measurements_rtree spatial index over (latitude, longitude, timestamp)
+#   5: unique (key, measurement_name, timestamp), duplicates removed
+SCHEMA_VERSION = 5
+
+# Run on every new connection. WAL lets readers work alongside the writer; with it, synchronous = NORMAL
+# only risks the last commits on power loss, never corruption.
+CONNECTION_PRAGMAS = ("PRAGMA journal_mode = WAL",
+					  "PRAGMA synchronous = NORMAL",
+					  "PRAGMA busy_timeout = 5000",
+					  "PRAGMA temp_store = MEMORY",
+					  "PRAGMA cache_size = -65536",
+					  "PRAGMA mmap_size = 268435456")
+
+# Column order of the tuples returned by `iter_bounded_rows`.
+RAW_COLUMNS = ("key", "measurement_name", "unit", "value", "timestamp", "receipt_time", "latitude", "longitude", "hardware")
+
+# Upserts the station's latest position on every insert. The WHERE clause keeps late, out-of-order
+# samples from overwriting a newer position; on equal timestamps the later arrival wins.
+LATEST_STATION_TRIGGER = """
+CREATE TRIGGER IF NOT EXISTS measurements_latest_station AFTER INSERT ON measurements
+BEGIN
+	INSERT INTO latest_station (key, timestamp, latitude, longitude)
+	VALUES (NEW.key, NEW.timestamp, NEW.latitude, NEW.longitude)
+	ON CONFLICT (key) DO UPDATE SET timestamp = excluded.timestamp,
+									latitude = excluded.latitude,
+									longitude = excluded.longitude
+	WHERE excluded.timestamp >= latest_station.timestamp;
+END
+"""
+
+# Bucket widths, in seconds, of the pre-aggregated series in the rollups table: 1 minute, 1 hour, 1 day.
+ROLLUP_RESOLUTIONS = (60, 3600, 86400)
+
+# Folds every inserted sample into its bucket at each resolution. min/max/sum/count merge in any order,
+# and `last` only moves forward in time, so late and out-of-order samples land in the right state.
+ROLLUPS_TRIGGER = """
+CREATE TRIGGER IF NOT EXISTS measurements_rollups AFTER INSERT ON measurements
+BEGIN
+""" + "".join(f"""
+	INSERT INTO rollups (resolution, key, measurement_name, bucket, min, max, sum, count, last, last_timestamp)
+	VALUES ({resolution}, NEW.key, NEW.measurement_name, (NEW.timestamp / {resolution}) * {resolution},
+			NEW.value, NEW.value, NEW.value, 1, NEW.value, NEW.timestamp)
+	ON CONFLICT (resolution, key, measurement_name, bucket) DO UPDATE SET
+		min = min(rollups.min, excluded.min),
+		max = max(rollups.max, excluded.max),
+		sum = rollups.sum + excluded.sum,
+		count = rollups.count + excluded.count,
+		last = CASE WHEN excluded.last_timestamp >= rollups.last_timestamp THEN excluded.last ELSE rollups.last END,
+		last_timestamp = max(rollups.last_timestamp, excluded.last_timestamp);
+""" for resolution in ROLLUP_RESOLUTIONS) + """
+END
+"""
+
+# R*Tree over each measurement's position and time. Its 32 bit float boxes are rounded outwards, so it
+# yields a superset of the matching ids that the exact column predicates then narrow down.
+RTREE_TABLE = """
+CREATE VIRTUAL TABLE IF NOT EXISTS measurements_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon, min_timestamp, max_timestamp)
+"""
+
+RTREE_TRIGGERS = ["""
+CREATE TRIGGER IF NOT EXISTS measurements_rtree_insert AFTER INSERT ON measurements
+WHEN NEW.latitude IS NOT NULL AND NEW.longitude IS NOT NULL AND NEW.timestamp IS NOT NULL
+BEGIN
+	INSERT INTO measurements_rtree VALUES (NEW.id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude, NEW.timestamp, NEW.timestamp);
+END
+""", """
+CREATE TRIGGER IF NOT EXISTS measurements_rtree_delete AFTER DELETE ON measurements
+BEGIN
+	DELETE FROM measurements_rtree WHERE id = OLD.id;
+END
+"""]
+
+
+def rollup_rebuild_statements() -> List[str]:
+	"""
+	Recomputes the rollups table from the raw measurements. `last` is the latest sample of each bucket,
+	ties broken by insertion order like the trigger does.
+	"""
+	statements = ["DELETE FROM rollups"]
+	for resolution in ROLLUP_RESOLUTIONS:
+		statements.append(f"""
+		INSERT INTO rollups (resolution, key, measurement_name, bucket, min, max, sum, count, last, last_timestamp)
+		SELECT {resolution}, key, measurement_name, bucket, min(value), max(value), sum(value), count(*),
+			   max(CASE WHEN recency = 1 THEN value END), max(timestamp)
+		FROM (SELECT key, measurement_name, value, timestamp, (timestamp / {resolution}) * {resolution} AS bucket,
+					 row_number() OVER (PARTITION BY key, measurement_name, timestamp / {resolution}
+										ORDER BY timestamp DESC, id DESC) AS recency
+			  FROM measurements)
+		GROUP BY key, measurement_name, bucket""")
+	return statements
+
+
+class EpochDateTime(TypeDecorator):
+	"""
+	Stores datetimes as integer epoch seconds, so range filters compare integers and can use an index.
+	Naive datetimes are interpreted as local time, same as `datetime.fromtimestamp`.
+	"""
+	impl = Integer
+
+	def process_bind_param(self, value, dialect):
+		if value is None or isinstance(value, int):
+			return value
+		return int(value.timestamp())
+
+	def process_result_value(self, value, dialect):
+		if value is None:
+			return value
+		return datetime.fromtimestamp(value)
+
+
+def partials_to_buckets(partials:Dict[str, List[Dict[str, np.ndarray]]], bucket_seconds:int) -> List[AggregateBucket]:
+	aggregates = []
+	for name in sorted(partials):
+		buckets = merge_partials(partials[name], bucket_seconds)
+		for i in range(len(buckets["bucket"])):
+			aggregates.append(AggregateBucket(measurement_name = name,
+											  bucket_start = datetime.fromtimestamp(int(buckets["bucket"][i])),
+											  min = buckets["min"][i],
+											  max = buckets["max"][i],
+											  mean = buckets["sum"][i] / buckets["count"][i],
+											  count = buckets["count"][i],
+											  last = buckets["last"][i]))
+	return aggregates
+
+
+def series_to_downsampled(series:Dict[str, Series], points:int) -> List[DownsampledSeries]:
+	downsampled = []
+	for name, (timestamps, values) in series.items():
+		timestamps, values = lttb(timestamps, values, points)
+		downsampled.append(DownsampledSeries(measurement_name = name,
+											 timestamps = [datetime.fromtimestamp(t) for t in timestamps.tolist()],
+											 values = values.tolist()))
+	return downsampled
+
 
 class MeasurementsDBAdapter:
-	def __init__(self):
+	def __init__(self, db_path:Optional[str] = None, echo:bool = False):
 		"""
 		  Measurements:
 		  key                 [String]    A name for the sensor. Like "Otto's sensor".
@@ -33,10 +180,28 @@ class MeasurementsDBAdapter:
 		  hardware            [String]    Hardware name. Like sensor type.
 		"""
 
-		DB_PATH = f"{str(CURRENT_DIR)}/data"
-		pathlib.Path(DB_PATH).mkdir(parents=True, exist_ok=True)
-
-		engine = create_engine(f'sqlite:///{DB_PATH}/measurements.db', echo=True)
+		if db_path is None:
+			DB_PATH = f"{str(CURRENT_DIR)}/data"
+			pathlib.Path(DB_PATH).mkdir(parents=True, exist_ok=True)
+			db_path = f"{DB_PATH}/measurements.db"
+
+		# The adapter is usually built on the main thread and then used from the server's worker threads.
+		engine = create_engine(f'sqlite:///{db_path}', echo=echo, connect_args = {"check_same_thread": False})
+
+		@event.listens_for(engine, "connect")
+		def set_pragmas(dbapi_connection, connection_record):
+			cursor = dbapi_connection.cursor()
+			for pragma in CONNECTION_PRAGMAS:
+				cursor.execute(pragma)
+			cursor.close()
+
+		self.engine = engine
+		# Reads go through one connection per thread, writes through a fresh connection under this lock.
+		self._local = threading.local()
+		# Every thread's read connection, for close().
+		self._read_conns = []
+		self._read_conns_lock = threading.Lock()
+		self._write_lock = threading.Lock()
 		meta = MetaData()
 
 		self.measurements = Table(
@@ -46,30 +211,233 @@ class MeasurementsDBAdapter:
             Column('measurement_name', String),
             Column('unit', String),
             Column('value', Numeric),
-            Column('timestamp', DateTime),
-            Column('receipt_time', DateTime),
+            Column('timestamp', EpochDateTime),
+            Column('receipt_time', EpochDateTime),
             Column('latitude', Float),
             Column('longitude', Float),
-            Column('hardware',  String)
+            Column('hardware',  String),
+            Index('ix_measurements_key_timestamp', 'key', 'timestamp'),
+            Index('ix_measurements_measurement_name_timestamp', 'measurement_name', 'timestamp'),
+            Index('ix_measurements_timestamp', 'timestamp'),
+            Index('ix_measurements_receipt_time', 'receipt_time'),
+            # One sample per series and instant: re-sent uploads are ignored on insert.
+            Index('ux_measurements_sample', 'key', 'measurement_name', 'timestamp', unique = True)
+         )
+
+		# One row per station key holding its most recent position.
+		self.latest_station = Table(
+            'latest_station', meta,
+            Column('key', String, primary_key = True),
+            Column('timestamp', EpochDateTime),
+            Column('latitude', Float),
+            Column('longitude', Float)
+         )
+
+		# Pre-aggregated series: one row per (resolution, key, measurement_name, bucket start).
+		self.rollups = Table(
+            'rollups', meta,
+            Column('resolution', Integer, primary_key = True),
+            Column('key', String, primary_key = True),
+            Column('measurement_name', String, primary_key = True),
+            Column('bucket', Integer, primary_key = True),
+            Column('min', Float),
+            Column('max', Float),
+            Column('sum', Float),
+            Column('count', Integer),
+            Column('last', Float),
+            Column('last_timestamp', Integer)
          )
 
+		# Maintained by SQLite (see RTREE_TABLE), so it lives outside `meta` and is only ever queried.
+		self.measurements_rtree = Table(
+            'measurements_rtree', MetaData(),
+            Column('id', Integer, primary_key = True),
+            Column('min_lat', Float),
+            Column('max_lat', Float),
+            Column('min_lon', Float),
+            Column('max_lon', Float),
+            Column('min_timestamp', Integer),
+            Column('max_timestamp', Integer)
+         )
+
+		self.__migrate__()
 		meta.create_all(engine)
-		self.conn = engine.connect()
+		with engine.connect() as conn:
+			conn.execute(text(LATEST_STATION_TRIGGER))
+			conn.execute(text(ROLLUPS_TRIGGER))
+			conn.execute(text(RTREE_TABLE))
+			for trigger in RTREE_TRIGGERS:
+				conn.execute(text(trigger))
+			conn.execute(text(f"PRAGMA user_version = {SCHEMA_VERSION}"))
 
 		Session = sessionmaker(bind = engine)
 		self.session = Session()
 
-	def __internal_datestring_to_datetime__(self, date_string:str) -> datetime:
-		return datetime.strptime(date_string,  '%Y-%m-%d %H:%M:%S.%f')
+	@property
+	def conn(self):
+		"""
+		The calling thread's read connection, opened on first use.
+		"""
+		conn = getattr(self._local, "conn", None)
+		if conn is None:
+			conn = self._local.conn = self.engine.connect()
+			with self._read_conns_lock:
+				self._read_conns.append(conn)
+		return conn
+
+	def close(self) -> None:
+		"""
+		Closes the read connections of every thread, the session and the engine's pooled connections.
+		"""
+		with self._read_conns_lock:
+			conns, self._read_conns = self._read_conns, []
+		for conn in conns:
+			conn.close()
+		self.session.close()
+		self.engine.dispose()
+
+	def __schema_version__(self) -> Optional[int]:
+		"""
+		Returns the schema version of the database file, or None when it has no measurements table yet.
+		"""
+		with self.engine.connect() as conn:
+			exists = conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'measurements'")).first()
+			if exists is None:
+				return None
+			return conn.execute(text("PRAGMA user_version")).scalar()
+
+	def __migrate__(self) -> None:
+		"""
+		Upgrades an existing measurements.db in place to SCHEMA_VERSION. Each step runs in its own
+		transaction, so an interrupted migration leaves the file at the last completed version.
+		"""
+		version = self.__schema_version__()
+		if version is None:
+			return
+
+		steps = {1: self.__migration_to_epoch__,
+				 2: self.__migration_to_latest_station__,
+				 3: self.__migration_to_rollups__,
+				 4: self.__migration_to_rtree__,
+				 5: self.__migration_to_unique_samples__}
+
+		for target in range(version + 1, SCHEMA_VERSION + 1):
+			self.__run_script__(steps[target]() + [f"PRAGMA user_version = {target}"])
+
+	def __run_script__(self, statements:List[str]) -> None:
+		"""
+		Runs `statements` as a single transaction on a dedicated connection.
+		"""
+		script = ";\n".join(["BEGIN"] + statements + ["COMMIT"]) + ";"
+
+		raw = self.engine.raw_connection()
+		try:
+			raw.connection.executescript(script)
+		finally:
+			raw.close()
+
+	def __migration_to_epoch__(self) -> List[str]:
+		"""
+		0 -> 1: DateTime text columns are rewritten as integer epoch seconds and the indexes are built.
+		The stored text is local time, hence the 'utc' modifier.
+		"""
+		columns = [c.name for c in self.measurements.columns]
+		copied = ", ".join(f"CAST(strftime('%s', {c}, 'utc') AS INTEGER)" if c in ("timestamp", "receipt_time") else f'"{c}"'
+						   for c in columns)
+		statements = ["ALTER TABLE measurements RENAME TO measurements_v0",
+					  str(CreateTable(self.measurements).compile(self.engine)),
+					  f"""INSERT INTO measurements ({", ".join(f'"{c}"' for c in columns)}) SELECT {copied} FROM measurements_v0""",
+					  "DROP TABLE measurements_v0"]
+		# The unique index waits for 4 -> 5, which first removes duplicates.
+		statements += [str(CreateIndex(index).compile(self.engine)) for index in self.measurements.indexes if not index.unique]
+		return statements
+
+	def __migration_to_latest_station__(self) -> List[str]:
+		"""
+		1 -> 2: latest_station is filled from the existing history, then kept current by the trigger.
+		With a single max() aggregate SQLite takes the bare columns from the row holding the maximum.
+		"""
+		return [str(CreateTable(self.latest_station).compile(self.engine)),
+				"""INSERT INTO latest_station (key, timestamp, latitude, longitude)
+				   SELECT key, max(timestamp), latitude, longitude FROM measurements GROUP BY key""",
+				LATEST_STATION_TRIGGER]
+
+	def __migration_to_rollups__(self) -> List[str]:
+		"""
+		2 -> 3: rollups are computed from the existing history, then kept current by the trigger.
+		"""
+		return [str(CreateTable(self.rollups).compile(self.engine))] + rollup_rebuild_statements() + [ROLLUPS_TRIGGER]
+
+	def __migration_to_rtree__(self) -> List[str]:
+		"""
+		3 -> 4: the spatial index is filled from the existing history, then kept current by triggers.
+		"""
+		return [RTREE_TABLE,
+				"""INSERT INTO measurements_rtree
+				   SELECT id, latitude, latitude, longitude, longitude, timestamp, timestamp FROM measurements
+				   WHERE latitude IS NOT NULL AND longitude IS NOT NULL AND timestamp IS NOT NULL"""] + RTREE_TRIGGERS
+
+	def __migration_to_unique_samples__(self) -> List[str]:
+		"""
+		4 -> 5: all but the first copy of each (key, measurement_name, timestamp) are deleted before the
+		unique index is built. The derived tables are recomputed only if there was anything to delete.
+		"""
+		unique_index = [index for index in self.measurements.indexes if index.name == "ux_measurements_sample"][0]
+		statements = [str(CreateIndex(unique_index).compile(self.engine))]
+
+		with self.engine.connect() as conn:
+			duplicated = conn.execute(text("""SELECT 1 FROM measurements GROUP BY key, measurement_name, timestamp
+											  HAVING count(*) > 1 LIMIT 1""")).first()
+		if duplicated is None:
+			return statements
+
+		# The R*Tree follows through its delete trigger.
+		return ["""DELETE FROM measurements WHERE id NOT IN (SELECT min(id) FROM measurements
+														   GROUP BY key, measurement_name, timestamp)""",
+				"DELETE FROM latest_station",
+				"""INSERT INTO latest_station (key, timestamp, latitude, longitude)
+				   SELECT key, max(timestamp), latitude, longitude FROM measurements GROUP BY key"""] \
+			+ rollup_rebuild_statements() + statements
+
+	def rebuild_rollups(self) -> None:
+		"""
+		Regenerates every rollup from the raw measurements, in one transaction.
+		"""
+		with self._write_lock:
+			self.__run_script__(rollup_rebuild_statements())
 
 	def insert_measurement(self, m:Measurement) -> None:
-		insert = self.measurements.insert().values(**m.dict())
-		result = self.conn.execute(insert)
+		self.insert_measurements([m])
+
+	def insert_measurements(self, m:List[Measurement]) -> int:
+		"""
+		Inserts a batch of measurements in a single transaction. The rows are bound to one
+		prepared INSERT through executemany, so a batch costs one commit rather than one per row.
+		Samples already stored for the same (key, measurement_name, timestamp) are skipped. Returns the
+		number of rows inserted.
+
+		Writes are serialized: SQLite has a single writer anyway, and waiting on the lock is cheaper than
+		on busy_timeout. Readers are not blocked, the database is in WAL mode.
+		"""
+		if len(m) == 0:
+			return 0
 
-	def insert_measurements(self, m:List[Measurement]) -> None:
 		measurements_as_dicts = [x.dict() for x in m]
-		insert = self.measurements.insert().values(measurements_as_dicts)
-		result = self.conn.execute(insert)
+		with self._write_lock, self.engine.begin() as conn:
+			return conn.execute(self.measurements.insert().prefix_with("OR IGNORE"), measurements_as_dicts).rowcount
+
+	def existing_samples(self, samples:List[Tuple[str, str, int]], chunk_size:int = 300) -> Set[Tuple[str, str, int]]:
+		"""
+		The (key, measurement_name, epoch timestamp) triples of `samples` that are already stored.
+		"""
+		m = self.measurements.c
+		timestamp = type_coerce(m.timestamp, Integer)
+		found = set()
+		for i in range(0, len(samples), chunk_size):
+			statement = select([m.key, m.measurement_name, timestamp]) \
+				.where(tuple_(m.key, m.measurement_name, timestamp).in_(samples[i:i + chunk_size]))
+			found.update(tuple(row) for row in self.conn.execute(statement))
+		return found
 
 
 	def get_all(self) -> Iterable[Measurement]:
@@ -78,13 +446,14 @@ class MeasurementsDBAdapter:
 		return map(lambda x: Measurement(**x), result)
 
 	def get_stations(self) -> Iterable[LatestStationMeta]:
-		statement = """
-		SELECT * FROM (SELECT key, timestamp, latitude, longitude FROM measurements ORDER BY timestamp DESC) GROUP BY key;	
 		"""
-		result = self.conn.execute(text(statement))
+		Returns every station's latest position. Reads latest_station, so the cost is one row per station.
+		"""
+		statement = self.latest_station.select().order_by(self.latest_station.c.key)
+		result = self.conn.execute(statement)
 
 		for station in result:
-			latest_timestamp = self.__internal_datestring_to_datetime__(station.timestamp)
+			latest_timestamp = station.timestamp
 			station_metadata = LatestStationMeta(station_key = station.key,
 												 lon = float(station.longitude),
 												 lat = float(station.latitude),
@@ -92,7 +461,11 @@ class MeasurementsDBAdapter:
 			yield station_metadata
 
 
-	def get_bounded(self, query:MeasurementsQuery) -> Iterable[Measurement]:
+	def __bounded_selection__(self, query:MeasurementsQuery, after:Optional[MeasurementsCursor] = None):
+		"""
+		Results are ordered by (timestamp, id). The key/measurement_name/timestamp indexes end in the rowid,
+		so this order comes straight off the index and `after` is a seek rather than an OFFSET scan.
+		"""
 		selection_criteria = []
 
 		#### Ranged
@@ -129,157 +502,284 @@ class MeasurementsDBAdapter:
 		if query.hardware is not None:
 			selection_criteria.append(self.measurements.c.hardware == query.hardware)
 
-		sel = self.measurements.select().where(and_(*selection_criteria))
+		### Spatial index
+		# A bounding box is answered by the R*Tree, which also takes the time range when there is one.
+		if query.lats is not None or query.lons is not None:
+			rtree = self.measurements_rtree.c
+			box = []
+			if query.lats is not None:
+				lat1, lat2 = sorted(query.lats)
+				box += [rtree.max_lat >= lat1, rtree.min_lat <= lat2]
+			if query.lons is not None:
+				lons1, lons2 = sorted(query.lons)
+				box += [rtree.max_lon >= lons1, rtree.min_lon <= lons2]
+			if query.time_range is not None:
+				t1, t2 = sorted(query.time_range)
+				box += [rtree.max_timestamp >= int(t1.timestamp()), rtree.min_timestamp <= int(t2.timestamp())]
+			selection_criteria.append(self.measurements.c.id.in_(select([rtree.id]).where(and_(*box))))
+
+		### Keyset pagination
+		if after is not None:
+			selection_criteria.append(tuple_(self.measurements.c.timestamp, self.measurements.c.id) >
+									  tuple_(literal(after.timestamp), literal(after.id)))
+
+		return self.measurements.select().where(and_(*selection_criteria)).order_by(self.measurements.c.timestamp,
+																				 self.measurements.c.id)
+
+	def get_bounded(self, query:MeasurementsQuery,
+					limit:Optional[int] = None,
+					after:Optional[MeasurementsCursor] = None) -> Iterable[Measurement]:
+		return chain.from_iterable(self.iter_bounded_chunks(query, limit = limit, after = after))
+
+	def get_page(self, query:MeasurementsQuery,
+				 limit:int,
+				 after:Optional[MeasurementsCursor] = None) -> Tuple[List[Measurement], Optional[MeasurementsCursor]]:
+		"""
+		Returns up to `limit` measurements following `after`, and the cursor for the next page.
+		The cursor is None on the last page.
+		"""
+		sel = self.__bounded_selection__(query, after = after).limit(limit + 1)
+		rows = self.conn.execute(sel).fetchall()
 
-		result = self.conn.execute(sel)
-		return map(lambda x: Measurement(**x), result)
+		next_cursor = None
+		if len(rows) > limit:
+			rows = rows[:limit]
+			last = rows[-1]
+			next_cursor = MeasurementsCursor(timestamp = int(last.timestamp.timestamp()), id = last.id)
+
+		return [Measurement(**x) for x in rows], next_cursor
+
+	def iter_bounded_chunks(self, query:MeasurementsQuery,
+							limit:Optional[int] = None,
+							chunk_size:int = 1000,
+							after:Optional[MeasurementsCursor] = None) -> Iterator[List[Measurement]]:
+		"""
+		Yields the result of `query` in lists of at most `chunk_size` measurements, fetching each chunk from
+		the cursor only when it is asked for. Memory stays bounded by `chunk_size` whatever the result size.
+		"""
+		sel = self.__bounded_selection__(query, after = after)
+		if limit is not None:
+			sel = sel.limit(limit)
+
+		for rows in self.__fetch_chunks__(sel, chunk_size):
+			yield [Measurement(**x) for x in rows]
+
+	def iter_bounded_rows(self, query:MeasurementsQuery,
+						  limit:Optional[int] = None,
+						  chunk_size:int = 10000,
+						  after:Optional[MeasurementsCursor] = None) -> Iterator[List[Tuple]]:
+		"""
+		Same result as `iter_bounded_chunks`, but as raw row tuples in RAW_COLUMNS order with timestamps
+		left as epoch seconds and values as plain numbers. Nothing is converted per row, for exports that
+		go straight to arrays.
+		"""
+		sel = self.__bounded_selection__(query, after = after).with_only_columns(self.__raw_columns__())
+		if limit is not None:
+			sel = sel.limit(limit)
+
+		for rows in self.__fetch_chunks__(sel, chunk_size):
+			yield [tuple(x) for x in rows]
+
+	def iter_bounded_records(self, query:MeasurementsQuery,
+							 limit:Optional[int] = None,
+							 chunk_size:int = 10000,
+							 after:Optional[MeasurementsCursor] = None) -> Iterator[List[MeasurementRecord]]:
+		"""
+		Same result as `iter_bounded_chunks` as MeasurementRecord tuples, for serializing without building models.
+		"""
+		for rows in self.iter_bounded_rows(query, limit = limit, chunk_size = chunk_size, after = after):
+			yield [MeasurementRecord._make(x) for x in rows]
+
+	def get_record_page(self, query:MeasurementsQuery,
+						limit:int,
+						after:Optional[MeasurementsCursor] = None) -> Tuple[List[MeasurementRecord], Optional[MeasurementsCursor]]:
+		"""
+		`get_page`, returning MeasurementRecord tuples.
+		"""
+		sel = self.__bounded_selection__(query, after = after).with_only_columns(self.__raw_columns__() + [self.measurements.c.id])
+		rows = self.conn.execute(sel.limit(limit + 1)).fetchall()
+
+		next_cursor = None
+		if len(rows) > limit:
+			rows = rows[:limit]
+			next_cursor = MeasurementsCursor(timestamp = rows[-1].timestamp, id = rows[-1].id)
+
+		return [MeasurementRecord._make(tuple(x)[:-1]) for x in rows], next_cursor
+
+	def __raw_columns__(self) -> List:
+		"""
+		RAW_COLUMNS of measurements, with timestamps read as epoch seconds and values as plain numbers.
+		"""
+		coerced = {"timestamp": Integer, "receipt_time": Integer, "value": Float}
+		return [type_coerce(self.measurements.c[name], coerced[name]).label(name) if name in coerced
+				else self.measurements.c[name] for name in RAW_COLUMNS]
+
+	def get_aggregated(self, query:MeasurementsQuery, bucket_seconds:int) -> List[AggregateBucket]:
+		"""
+		Reduces each measurement_name matched by `query` to `bucket_seconds` wide, epoch aligned buckets.
+		Empty buckets are left out.
+
+		When the query only filters on key, measurement_name and time, the coarsest rollup whose resolution
+		divides `bucket_seconds` answers every bucket lying fully inside the time range. Only the partial
+		buckets at the edges of the range are read from the raw measurements.
+		"""
+		return partials_to_buckets(self.aggregate_partials(query, bucket_seconds), bucket_seconds)
+
+	def aggregate_partials(self, query:MeasurementsQuery, bucket_seconds:int) -> Dict[str, List[Dict[str, np.ndarray]]]:
+		"""
+		The partial aggregates `get_aggregated` merges, per measurement_name. Partials from several
+		databases can be merged the same way.
+		"""
+		partials:Dict[str, List[Dict[str, np.ndarray]]] = defaultdict(list)
+
+		resolution = self.__rollup_resolution__(query, bucket_seconds)
+		if resolution is None:
+			raw_queries = [query]
+		else:
+			covered, raw_queries = self.__split_for_rollup__(query, resolution)
+			if covered is not None:
+				for name, partial in self.__rollup_partials__(query, resolution, covered).items():
+					partials[name].append(partial)
+
+		for raw_query in raw_queries:
+			for name, (timestamps, values) in self.__series__(raw_query).items():
+				partials[name].append(bucket_aggregate(timestamps, values, bucket_seconds))
+		return partials
+
+	def __rollup_resolution__(self, query:MeasurementsQuery, bucket_seconds:int) -> Optional[int]:
+		"""
+		Returns the coarsest rollup resolution usable for `query`, or None when it has to be answered from raw rows.
+		"""
+		if any(f is not None for f in (query.lats, query.lons, query.receipt_time_range, query.unit, query.hardware)):
+			return None
+
+		usable = [r for r in ROLLUP_RESOLUTIONS if bucket_seconds % r == 0]
+		return max(usable) if usable else None
+
+	def __split_for_rollup__(self, query:MeasurementsQuery,
+							 resolution:int) -> Tuple[Optional[Tuple[Optional[int], Optional[int]]], List[MeasurementsQuery]]:
+		"""
+		Splits the time range of `query` into the rollup buckets it fully covers, as [first, end) bucket starts
+		(None for an open end), and queries for the partially covered edges.
+		"""
+		if query.time_range is None:
+			return (None, None), []
+
+		t1, t2 = sorted(query.time_range)
+		after, before = int(t1.timestamp()), int(t2.timestamp())
+		# Bounds are exclusive and timestamps whole seconds.
+		first = -(-(after + 1) // resolution) * resolution
+		end = (before // resolution) * resolution
+		if first >= end:
+			return None, [query]
+
+		edge = lambda a, b: query.copy(update = {"time_range": (datetime.fromtimestamp(a), datetime.fromtimestamp(b))})
+		edges = []
+		if first > after + 1:
+			edges.append(edge(after, first))
+		if end < before:
+			edges.append(edge(end - 1, before))
+		return (first, end), edges
+
+	def __rollup_partials__(self, query:MeasurementsQuery, resolution:int,
+							covered:Tuple[Optional[int], Optional[int]]) -> Dict[str, Dict[str, np.ndarray]]:
+		r = self.rollups.c
+		criteria = [r.resolution == resolution]
+		if query.key is not None:
+			criteria.append(r.key == query.key)
+		if query.measurement_name is not None:
+			criteria.append(r.measurement_name == query.measurement_name)
+		first, end = covered
+		if first is not None:
+			criteria.append(r.bucket >= first)
+		if end is not None:
+			criteria.append(r.bucket < end)
+
+		sel = select([r.measurement_name, r.bucket, r.min, r.max, r.sum, r.count, r.last, r.last_timestamp]).where(and_(*criteria))
+
+		rows_by_name:Dict[str, List] = defaultdict(list)
+		for row in self.conn.execute(sel):
+			rows_by_name[row.measurement_name].append(tuple(row)[1:])
+
+		partials = {}
+		for name, rows in rows_by_name.items():
+			bucket, min_, max_, sum_, count, last, last_timestamp = zip(*rows)
+			partials[name] = dict(bucket = np.array(bucket, dtype = np.int64),
+								  min = np.array(min_, dtype = np.float64),
+								  max = np.array(max_, dtype = np.float64),
+								  sum = np.array(sum_, dtype = np.float64),
+								  count = np.array(count, dtype = np.int64),
+								  last = np.array(last, dtype = np.float64),
+								  last_timestamp = np.array(last_timestamp, dtype = np.int64))
+		return partials
+
+	def get_downsampled(self, query:MeasurementsQuery, points:int) -> List[DownsampledSeries]:
+		"""
+		Returns at most `points` samples per measurement_name, chosen by LTTB to keep the shape of the series for charting.
+		"""
+		return series_to_downsampled(self.__series__(query), points)
+
+	def __series__(self, query:MeasurementsQuery, chunk_size:int = 100000) -> Dict[str, Series]:
+		"""
+		Loads (timestamp, value) arrays for every measurement_name matched by `query`, ordered by timestamp.
+		"""
+		columns = [self.measurements.c.measurement_name,
+				   type_coerce(self.measurements.c.timestamp, Integer).label("timestamp"),
+				   type_coerce(self.measurements.c.value, Float).label("value")]
+		sel = self.__bounded_selection__(query).with_only_columns(columns)
+
+		names:List[str] = []
+		timestamps:List[np.ndarray] = []
+		values:List[np.ndarray] = []
+		for rows in self.__fetch_chunks__(sel, chunk_size):
+			chunk_names, chunk_timestamps, chunk_values = zip(*rows)
+			names.extend(chunk_names)
+			timestamps.append(np.array(chunk_timestamps, dtype = np.int64))
+			values.append(np.array(chunk_values, dtype = np.float64))
+
+		if not names:
+			return {}
+		return split_series(names, np.concatenate(timestamps), np.concatenate(values))
+
+	def __fetch_chunks__(self, sel, chunk_size:int) -> Iterator[List]:
+		"""
+		Streams on a connection of its own, so the chunks may be pulled from any thread and the
+		whole result reads from one snapshot.
+		"""
+		with self.engine.connect() as conn:
+			result = conn.execute(sel)
+			try:
+				while True:
+					rows = result.fetchmany(chunk_size)
+					if not rows:
+						return
+					yield rows
+			finally:
+				result.close()
+
+	def explain_bounded(self, query:MeasurementsQuery, after:Optional[MeasurementsCursor] = None) -> str:
+		"""
+		Returns SQLite's query plan for `get_bounded(query, after = after)`, one step per line.
+		"""
+		sel = self.__bounded_selection__(query, after = after)
+		compiled = sel.compile(self.engine, compile_kwargs = {"literal_binds": True})
+		plan = self.conn.execute(text(f"EXPLAIN QUERY PLAN {compiled}"))
+		return "\n".join(step.detail for step in plan)
 
 
 
 
 if __name__ == "__main__":
-	adapter = MeasurementsDBAdapter()
-	from sqlalchemy.sql import text
+	# python -m storage.sqlite_api.driver [--db PATH] [rebuild-rollups]
+	# Opening the database migrates it to the current schema.
+	import argparse
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--db", default = None, help = "Path to measurements.db. Defaults to the server's database.")
+	parser.add_argument("command", nargs = "?", choices = ["migrate", "rebuild-rollups"], default = "migrate")
+	args = parser.parse_args()
+
+	adapter = MeasurementsDBAdapter(db_path = args.db, echo = False)
+	if args.command == "rebuild-rollups":
+		adapter.rebuild_rollups()
 
 	print(list(adapter.get_stations()))
-
-	# print(list(adapter.get_all()), sep = '\n')
-
-	#
-	# statement = """
-	#  SELECT key, latitude, longitude, timestamp FROM  measurements GROUP BY key ORDER BY timestamp DESC LIMIT 10;
-	# """
-	#
-	#
-	# # statement2 = """SELECT key, latitude, longitude, timestamp FROM measurements WHERE key LIKE '%1' ORDER BY timestamp DESC LIMIT 10;"""
-	#
-	# # ORDER BY timestamp DESC
-	# statement2 = """ SELECT key, latitude, longitude, timestamp FROM  measurements WHERE key LIKE "%0"ORDER BY timestamp DESC LIMIT 10;"""
-	#
-	#
-	# def try_it(s):
-	# 	print("__ __ __ __ __ __ __ ")
-	# 	result = adapter.conn.execute(text(s))
-	# 	for x in result:
-	# 		print(x)
-	#
-	# statement3 = """
-	# SELECT * FROM (SELECT latitude, longitude, key, timestamp FROM measurements ORDER BY timestamp DESC) GROUP BY key;
-	# """
-	#
-	# try_it(statement3)
-	# print(list(result))
-	# statement = text("""INSERT INTO book(id, title, primary_author) VALUES(:id, :title, :primary_author)""")
-	#
-	# for line in data:
-	# 	con.execute(statement, **line)
-
-	import random
-	import time
-	from datetime import  datetime, timedelta
-	#
-	# def __generate_random_measurement() -> Measurement:
-	# 	measurement =  Measurement(key = f"Otto's station No. {int((random.random() *2 )//1)}", measurement_name = "Temperature",
-    #                               unit = "C",
-    #                               value = random.random()*50,
-    #                               timestamp = datetime.now(),
-    #                               receipt_time = datetime.now(),
-    #                               latitude = 0.0 + (random.random()-.5) * 10,
-    #                               longitude = 0.0 + (random.random()-.5) * 10,
-    #                               hardware = f"Thermometer {(random.random() *3)//1}"
-    #                               )
-	# 	return measurement
-	# adapter.insert_measurement(__generate_random_measurement())
-	#
-	# for x in range(10000):
-	# 	adapter.insert_measurement(__generate_random_measurement())
-
-	# def time_and_print(name, query:MeasurementsQuery):
-	# 	t1 = time.time()
-	# 	x = adapter.get_bounded(query)
-	# 	xx = list(x)
-	# 	t2 = time.time()
-	# 	print(f"{name}:::")
-	# 	print(t2 - t1)
-	# 	print(f"Len: {len(xx)}")
-	# 	#print(*xx[:10], sep = "\n")
-	# 	print()
-	#
-	#
-	# z = select(adapter.measurements.lat)
-	#
-	# print(f"$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$${z}")
-	#
-	# time_and_print(name="Normal", query=MeasurementsQuery())
-	# time_and_print(name="Lat Bounded", query= MeasurementsQuery(lats = (0,10)))
-	# time_and_print(name="Hardware Bounded", query=MeasurementsQuery(hardware = "Thermometer 3"))
-	# time_and_print(name="Key check", query=MeasurementsQuery(key = "Otto's station"))
-	#
-	#
-	# insert = __generate_random_measurement()
-	# print(insert)
-	# adapter.insert_measurement(insert)
-	#
-	# print("sleeping")
-	# time.sleep(3)
-	# print(f"::::{insert.receipt_time}")
-	# now = datetime.now()
-	# before = now - timedelta(minutes = 10)
-	# print(f"--{before}")
-	# print(f"--{now}")
-	#
-	# time_and_print(name="Date check", query=MeasurementsQuery(receipt_time_range = (before, now)))
-	#
-
-
-# tf_1 = time.time()
-	# foo = adapter.get_all()
-	# l_foo = list(foo)
-	# tf_2 = time.time()
-	#
-	#
-	# tb_1 = time.time()
-	# bar = adapter.get_bounded(MeasurementsQuery(lats = (0,10)))
-	# l_bar = list(bar)
-	# tb_2 = time.time()
-	#
-	# print("All")
-	# print(tf_2 - tf_1)
-	# print(f"Len: {len(l_foo)}")
-	# print(*l_foo[:10], sep = "\n")
-	#
-	# print()
-	# print("Select")
-	# print(tb_2 - tb_1)
-	# print(f"Len: {len(l_bar)}")
-	# print(*l_bar[:10], sep="\n")
-
-#
-		#
-		# print("Bounded")
-
-
-#         return measurement
-#
-#     import 		pandas as pd
-#
-# 		results = []
-# 		for _ in range(10000):
-#
-# 			for x in range(10):
-# 				measurement = __generate_random_measurement()
-# 				adapter.insert_measurement(measurement)
-#
-# 			import time
-#
-# 			t1 = time.time()
-# 			stuff = list(adapter.get_all())
-# 			t2 = time.time()
-#
-# 			# print("------")
-# 			# print(f"dict(length = {len(stuff)}, time={t2 - t1}),")
-#
-# 			results.append(dict(length=len(stuff), time=t2 - t1))
-#
-# df = pd.DataFrame(results)
-#     df.to_csv("yoink.csv")
\ No newline at end of file
@@ -0,0 +1,352 @@
+"""
+Time partitioned measurements: one MeasurementsDBAdapter database per day, month or year of measurement
+timestamp (UTC), e.g. `data/measurements_2021_03.db`. Queries only open the partitions overlapping their
+time range, and retention deletes whole partition files instead of running DELETE and VACUUM.
+"""
+import glob
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from itertools import chain
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+
+from ..models import Measurement, MeasurementsQuery, MeasurementsCursor, LatestStationMeta, MeasurementRecord
+from ..models import AggregateBucket, DownsampledSeries
+from .driver import MeasurementsDBAdapter, CURRENT_DIR, partials_to_buckets, series_to_downsampled
+
+logger = logging.getLogger(__name__)
+
+PARTITION_FORMATS = {"day": "%Y_%m_%d", "month": "%Y_%m", "year": "%Y"}
+
+# Cursor id meaning "past every row of this timestamp", used when a page ends exactly at a partition's end.
+LAST_ID = 2 ** 63 - 1
+
+
+def partition_start(epoch:int, period:str) -> datetime:
+	t = datetime.fromtimestamp(epoch, tz = timezone.utc)
+	if period == "day":
+		return t.replace(hour = 0, minute = 0, second = 0, microsecond = 0)
+	if period == "month":
+		return t.replace(day = 1, hour = 0, minute = 0, second = 0, microsecond = 0)
+	return t.replace(month = 1, day = 1, hour = 0, minute = 0, second = 0, microsecond = 0)
+
+
+def next_partition_start(start:datetime, period:str) -> datetime:
+	if period == "day":
+		return start + timedelta(days = 1)
+	if period == "month":
+		return start.replace(year = start.year + start.month // 12, month = start.month % 12 + 1)
+	return start.replace(year = start.year + 1)
+
+
+class Partition:
+	def __init__(self, path:str, start:datetime, end:datetime):
+		"""
+		One partition database, covering timestamps in [start, end). The database is opened on first use.
+		"""
+		self.path = path
+		self.start = int(start.timestamp())
+		self.end = int(end.timestamp())
+		self._adapter:Optional[MeasurementsDBAdapter] = None
+		self._lock = threading.Lock()
+		self.closed = False
+
+	@property
+	def adapter(self) -> MeasurementsDBAdapter:
+		with self._lock:
+			if self.closed:
+				# Opening it again would create an empty database where the dropped file was.
+				raise RuntimeError(f"Partition {self.path} was dropped")
+			if self._adapter is None:
+				self._adapter = MeasurementsDBAdapter(db_path = self.path, echo = False)
+			return self._adapter
+
+	def close(self) -> None:
+		"""
+		Closes the database for good, before its file is deleted.
+		"""
+		with self._lock:
+			self.closed = True
+			if self._adapter is not None:
+				self._adapter.close()
+				self._adapter = None
+
+
+class PartitionedMeasurementsDBAdapter:
+	def __init__(self, data_dir:Optional[str] = None, period:str = "month", retention_days:Optional[float] = None,
+				 import_legacy:bool = True):
+		"""
+		Same interface as MeasurementsDBAdapter, spread over one database file per `period`.
+
+		data_dir        Directory of the partition files. Defaults to the SQLite driver's data directory.
+		period          "day", "month" or "year", in UTC.
+		retention_days  `drop_expired` deletes partitions that ended longer ago than this. None keeps everything.
+		import_legacy   A single-file `measurements.db` in `data_dir` is imported when no partition exists yet,
+						and moved aside to `measurements.db.imported`. With partitions already there it is an error,
+						since its measurements would silently be missing from every read.
+		"""
+		if period not in PARTITION_FORMATS:
+			raise ValueError(f"Unknown partition period {period!r}, expected one of {sorted(PARTITION_FORMATS)}")
+		self.data_dir = data_dir or f"{str(CURRENT_DIR)}/data"
+		self.period = period
+		self.retention_days = retention_days
+		os.makedirs(self.data_dir, exist_ok = True)
+
+		self._lock = threading.Lock()
+		# start epoch -> partition, for every partition file on disk
+		self._partitions:Dict[int, Partition] = {}
+		for path in glob.glob(os.path.join(self.data_dir, "measurements_*.db")):
+			name = os.path.basename(path)[len("measurements_"):-len(".db")]
+			try:
+				start = datetime.strptime(name, PARTITION_FORMATS[period]).replace(tzinfo = timezone.utc)
+			except ValueError:
+				continue
+			self._partitions[int(start.timestamp())] = Partition(path, start, next_partition_start(start, period))
+
+		legacy = os.path.join(self.data_dir, "measurements.db")
+		if import_legacy and os.path.exists(legacy):
+			if self._partitions:
+				raise RuntimeError(f"{legacy} is not read by the partitioned storage and partitions already exist. "
+								   f"Import it with `python -m storage.sqlite_api.partitioned import {legacy}`, "
+								   f"or set `partition: none` to keep using it")
+			# First start after switching to partitions: bring the history along instead of hiding it.
+			logger.warning(f"Importing {legacy} into {period} partitions")
+			logger.warning(f"Imported {self.import_database(legacy)} measurements, {legacy} moved to {legacy}.imported")
+
+	def __partition__(self, epoch:int) -> Partition:
+		"""
+		The partition holding `epoch`, created if needed.
+		"""
+		start = partition_start(epoch, self.period)
+		key = int(start.timestamp())
+		with self._lock:
+			partition = self._partitions.get(key)
+			if partition is None:
+				name = f"measurements_{start.strftime(PARTITION_FORMATS[self.period])}.db"
+				partition = Partition(os.path.join(self.data_dir, name), start, next_partition_start(start, self.period))
+				self._partitions[key] = partition
+			return partition
+
+	def __partitions_for__(self, query:MeasurementsQuery, after:Optional[MeasurementsCursor] = None) -> List[Partition]:
+		"""
+		The partitions that can hold results of `query`, oldest first.
+		"""
+		with self._lock:
+			partitions = [self._partitions[key] for key in sorted(self._partitions)]
+
+		if query.time_range is not None:
+			# Both bounds are exclusive.
+			t1, t2 = sorted(int(t.timestamp()) for t in query.time_range)
+			partitions = [p for p in partitions if p.start < t2 and p.end > t1 + 1]
+		if after is not None:
+			partitions = [p for p in partitions if p.end > after.timestamp]
+		return partitions
+
+	@property
+	def partitions(self) -> List[Partition]:
+		return self.__partitions_for__(MeasurementsQuery())
+
+	def insert_measurement(self, m:Measurement) -> None:
+		self.insert_measurements([m])
+
+	def insert_measurements(self, m:List[Measurement]) -> int:
+		"""
+		Inserts a batch with one transaction per partition it touches. A batch spanning partitions is
+		therefore not atomic as a whole. Returns the number of rows inserted, duplicates not counted.
+		"""
+		by_partition:Dict[int, Tuple[Partition, List[Measurement]]] = {}
+		partition = None
+		for measurement in m:
+			epoch = int(measurement.timestamp.timestamp())
+			if partition is None or not partition.start <= epoch < partition.end:
+				partition = self.__partition__(epoch)
+			by_partition.setdefault(partition.start, (partition, []))[1].append(measurement)
+
+		inserted = 0
+		for partition, batch in sorted(by_partition.values(), key = lambda x: x[0].start):
+			inserted += partition.adapter.insert_measurements(batch)
+		return inserted
+
+	def existing_samples(self, samples:List[Tuple[str, str, int]]) -> Set[Tuple[str, str, int]]:
+		"""
+		Looks each sample up in the partition of its timestamp, which is the only one that can hold it.
+		"""
+		with self._lock:
+			partitions = dict(self._partitions)
+		by_partition:Dict[int, List[Tuple[str, str, int]]] = defaultdict(list)
+		for sample in samples:
+			by_partition[int(partition_start(sample[2], self.period).timestamp())].append(sample)
+
+		found = set()
+		for start, batch in by_partition.items():
+			if start in partitions:
+				found |= partitions[start].adapter.existing_samples(batch)
+		return found
+
+	def drop_expired(self, now:Optional[float] = None) -> List[str]:
+		"""
+		Deletes the partitions that ended more than `retention_days` before `now`. Returns their paths.
+		"""
+		if self.retention_days is None:
+			return []
+		cutoff = (time.time() if now is None else now) - self.retention_days * 86400
+
+		with self._lock:
+			expired = [key for key, p in self._partitions.items() if p.end <= cutoff]
+			dropped = [self._partitions.pop(key) for key in expired]
+			# Closed under the lock, so nobody can open a dropped partition again before its file is gone.
+			for partition in dropped:
+				partition.close()
+
+		for partition in dropped:
+			for path in (partition.path, partition.path + "-wal", partition.path + "-shm"):
+				if os.path.exists(path):
+					os.remove(path)
+			logger.info(f"Dropped expired partition {partition.path}")
+		return [p.path for p in dropped]
+
+	def rebuild_rollups(self) -> None:
+		for partition in self.partitions:
+			partition.adapter.rebuild_rollups()
+
+	def get_all(self) -> Iterable[Measurement]:
+		return chain.from_iterable(p.adapter.get_all() for p in self.partitions)
+
+	def get_stations(self) -> Iterable[LatestStationMeta]:
+		"""
+		Every station's latest position, merged from the latest_station table of each partition.
+		"""
+		latest:Dict[str, LatestStationMeta] = {}
+		for partition in self.partitions:
+			for station in partition.adapter.get_stations():
+				current = latest.get(station.station_key)
+				if current is None or station.latest_time >= current.latest_time:
+					latest[station.station_key] = station
+		return [latest[key] for key in sorted(latest)]
+
+	def __chunks__(self, method:str, query:MeasurementsQuery, limit:Optional[int],
+				   after:Optional[MeasurementsCursor], **kwargs) -> Iterator[List]:
+		"""
+		Chains the chunks of `method` over the partitions in time order, which keeps the results ordered
+		by timestamp: partitions cover disjoint time ranges.
+		"""
+		remaining = limit
+		for partition in self.__partitions_for__(query, after):
+			if remaining is not None and remaining <= 0:
+				return
+			for chunk in getattr(partition.adapter, method)(query, limit = remaining, after = after, **kwargs):
+				if remaining is not None:
+					remaining -= len(chunk)
+				yield chunk
+
+	def get_bounded(self, query:MeasurementsQuery,
+					limit:Optional[int] = None,
+					after:Optional[MeasurementsCursor] = None) -> Iterable[Measurement]:
+		return chain.from_iterable(self.iter_bounded_chunks(query, limit = limit, after = after))
+
+	def iter_bounded_chunks(self, query:MeasurementsQuery,
+							limit:Optional[int] = None,
+							chunk_size:int = 1000,
+							after:Optional[MeasurementsCursor] = None) -> Iterator[List[Measurement]]:
+		return self.__chunks__("iter_bounded_chunks", query, limit, after, chunk_size = chunk_size)
+
+	def iter_bounded_rows(self, query:MeasurementsQuery,
+						  limit:Optional[int] = None,
+						  chunk_size:int = 10000,
+						  after:Optional[MeasurementsCursor] = None) -> Iterator[List[Tuple]]:
+		return self.__chunks__("iter_bounded_rows", query, limit, after, chunk_size = chunk_size)
+
+	def iter_bounded_records(self, query:MeasurementsQuery,
+							 limit:Optional[int] = None,
+							 chunk_size:int = 10000,
+							 after:Optional[MeasurementsCursor] = None) -> Iterator[List[MeasurementRecord]]:
+		return self.__chunks__("iter_bounded_records", query, limit, after, chunk_size = chunk_size)
+
+	def __page__(self, method:str, query:MeasurementsQuery, limit:int,
+				 after:Optional[MeasurementsCursor]) -> Tuple[List, Optional[MeasurementsCursor]]:
+		page:List = []
+		partitions = self.__partitions_for__(query, after)
+		for i, partition in enumerate(partitions):
+			rows, cursor = getattr(partition.adapter, method)(query, limit = limit - len(page), after = after)
+			page.extend(rows)
+			if cursor is not None:
+				return page, cursor
+			if len(page) == limit:
+				more = any(getattr(p.adapter, method)(query, limit = 1, after = after)[0] for p in partitions[i + 1:])
+				return page, MeasurementsCursor(timestamp = partition.end - 1, id = LAST_ID) if more else None
+		return page, None
+
+	def get_page(self, query:MeasurementsQuery,
+				 limit:int,
+				 after:Optional[MeasurementsCursor] = None) -> Tuple[List[Measurement], Optional[MeasurementsCursor]]:
+		return self.__page__("get_page", query, limit, after)
+
+	def get_record_page(self, query:MeasurementsQuery,
+						limit:int,
+						after:Optional[MeasurementsCursor] = None) -> Tuple[List[MeasurementRecord], Optional[MeasurementsCursor]]:
+		return self.__page__("get_record_page", query, limit, after)
+
+	def get_aggregated(self, query:MeasurementsQuery, bucket_seconds:int) -> List[AggregateBucket]:
+		"""
+		Buckets that straddle a partition boundary are merged from the partials of both partitions.
+		"""
+		partials:Dict[str, List[Dict[str, np.ndarray]]] = defaultdict(list)
+		for partition in self.__partitions_for__(query):
+			for name, parts in partition.adapter.aggregate_partials(query, bucket_seconds).items():
+				partials[name].extend(parts)
+		return partials_to_buckets(partials, bucket_seconds)
+
+	def get_downsampled(self, query:MeasurementsQuery, points:int) -> List[DownsampledSeries]:
+		pieces:Dict[str, List[Tuple[np.ndarray, np.ndarray]]] = defaultdict(list)
+		for partition in self.__partitions_for__(query):
+			for name, series in partition.adapter.__series__(query).items():
+				pieces[name].append(series)
+
+		series = {name: (np.concatenate([t for t, _ in parts]), np.concatenate([v for _, v in parts]))
+				  for name, parts in pieces.items()}
+		return series_to_downsampled(series, points)
+
+	def import_database(self, db_path:str, batch_size:int = 10000) -> int:
+		"""
+		Copies every measurement of a single-file database into the partitions. Returns the number copied.
+		The `measurements.db` of `data_dir` is moved aside afterwards, so it is not imported again.
+		"""
+		source = MeasurementsDBAdapter(db_path = db_path, echo = False)
+		copied = 0
+		for chunk in source.iter_bounded_chunks(MeasurementsQuery(), chunk_size = batch_size):
+			self.insert_measurements(chunk)
+			copied += len(chunk)
+		source.engine.dispose()
+		if os.path.abspath(db_path) == os.path.abspath(os.path.join(self.data_dir, "measurements.db")):
+			for suffix in ("", "-wal", "-shm"):
+				if os.path.exists(db_path + suffix):
+					os.replace(db_path + suffix, db_path + ".imported" + suffix)
+		return copied
+
+
+if __name__ == "__main__":
+	# python -m storage.sqlite_api.partitioned [--data-dir DIR] [--period month] import PATH
+	# python -m storage.sqlite_api.partitioned [--data-dir DIR] [--period month] --retention-days N drop-expired
+	import argparse
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--data-dir", default = None, help = "Directory of the partition files. Defaults to the server's.")
+	parser.add_argument("--period", default = "month", choices = sorted(PARTITION_FORMATS))
+	parser.add_argument("--retention-days", type = float, default = None)
+	parser.add_argument("command", choices = ["import", "drop-expired", "rebuild-rollups"])
+	parser.add_argument("path", nargs = "?", help = "Single-file measurements.db to import.")
+	args = parser.parse_args()
+
+	logging.basicConfig(level = logging.INFO)
+	adapter = PartitionedMeasurementsDBAdapter(data_dir = args.data_dir, period = args.period,
+											   retention_days = args.retention_days, import_legacy = False)
+	if args.command == "import":
+		print(f"Imported {adapter.import_database(args.path)} measurements")
+	elif args.command == "drop-expired":
+		print("\n".join(adapter.drop_expired()))
+	else:
+		adapter.rebuild_rollups()
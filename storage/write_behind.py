@@ -0,0 +1,173 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, List, Optional, Tuple
+
+from .models import Measurement
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+	"""
+	Raised when a write would push the ingest queue past its configured capacity.
+	"""
+
+
+class WriteBehindQueue:
+	def __init__(self,
+				 sink: Callable[[List[Measurement]], None],
+				 max_size:int = 100000,
+				 flush_size:int = 1000,
+				 flush_interval:float = 1.0,
+				 retry_interval:float = 1.0,
+				 max_retries:int = 5,
+				 dead_letter_path:Optional[str] = None):
+		"""
+		Bounded in-process buffer between the upload endpoints and the storage adapter.
+
+		sink            Called from the flusher thread with each drained batch, e.g. `insert_measurements`.
+		max_size        Maximum number of pending measurements. `put` raises QueueFullError beyond it.
+		flush_size      Flush as soon as this many measurements are pending.
+		flush_interval  Flush once the oldest pending measurement has waited this many seconds.
+		retry_interval  Seconds to wait before retrying a batch the sink failed to write.
+		max_retries     Retries of a failing batch. After that each upload in it is tried once on its own, and
+						the ones still failing are logged and appended to `dead_letter_path`, so one bad batch
+						cannot hold up the writes queued behind it or `close`.
+		dead_letter_path  File of measurements that could not be written, one JSON object per line. None only logs them.
+		"""
+		self.sink = sink
+		self.max_size = max_size
+		self.flush_size = flush_size
+		self.flush_interval = flush_interval
+		self.retry_interval = retry_interval
+		self.max_retries = max_retries
+		self.dead_letter_path = dead_letter_path
+		self.dead_lettered = 0
+
+		# (enqueue time, measurements) in arrival order
+		self._pending: Deque[Tuple[float, List[Measurement]]] = deque()
+		self._depth = 0
+		self._closed = False
+		self._condition = threading.Condition()
+
+		self._flusher = threading.Thread(target = self._run, name = "write-behind-flusher", daemon = True)
+		self._flusher.start()
+
+	@property
+	def depth(self) -> int:
+		"""
+		Number of measurements accepted but not yet written to storage.
+		"""
+		return self._depth
+
+	@property
+	def flush_lag(self) -> float:
+		"""
+		Seconds the oldest pending measurement has been waiting. 0 when the queue is empty.
+		"""
+		with self._condition:
+			if not self._pending:
+				return 0.0
+			return time.monotonic() - self._pending[0][0]
+
+	def put(self, measurements:List[Measurement]) -> None:
+		"""
+		Accepts all of `measurements` or none of them.
+		"""
+		if len(measurements) == 0:
+			return
+
+		with self._condition:
+			if self._closed:
+				raise QueueFullError("Ingest queue is closed")
+			if self._depth + len(measurements) > self.max_size:
+				raise QueueFullError(f"Ingest queue is full ({self._depth}/{self.max_size})")
+
+			was_empty = not self._pending
+			self._pending.append((time.monotonic(), measurements))
+			self._depth += len(measurements)
+
+			# Wake the flusher to flush now, or to start timing the oldest measurement.
+			if was_empty or self._depth >= self.flush_size:
+				self._condition.notify()
+
+	def close(self) -> None:
+		"""
+		Stops accepting writes and blocks until everything pending has been written.
+		"""
+		with self._condition:
+			self._closed = True
+			self._condition.notify()
+		self._flusher.join()
+
+	def _due(self) -> bool:
+		if not self._pending:
+			return False
+		if self._closed or self._depth >= self.flush_size:
+			return True
+		return time.monotonic() - self._pending[0][0] >= self.flush_interval
+
+	def _take(self) -> List[Tuple[float, List[Measurement]]]:
+		with self._condition:
+			while not self._due():
+				if self._closed:
+					return []
+				timeout = None
+				if self._pending:
+					timeout = self.flush_interval - (time.monotonic() - self._pending[0][0])
+				self._condition.wait(timeout)
+
+			taken = list(self._pending)
+			self._pending.clear()
+			return taken
+
+	def _run(self) -> None:
+		while True:
+			taken = self._take()
+			if not taken:
+				return
+
+			self._write(taken)
+			with self._condition:
+				self._depth -= sum(len(measurements) for _, measurements in taken)
+
+	def _write(self, taken:List[Tuple[float, List[Measurement]]]) -> None:
+		batch = [m for _, measurements in taken for m in measurements]
+		for attempt in range(self.max_retries + 1):
+			try:
+				self.sink(batch)
+				return
+			except Exception:
+				if attempt < self.max_retries:
+					logger.exception(f"Failed to flush {len(batch)} measurements, retrying in {self.retry_interval}s")
+					time.sleep(self.retry_interval)
+
+		logger.error(f"Giving up on a batch of {len(batch)} measurements after {self.max_retries} retries")
+		uploads = [measurements for _, measurements in taken]
+		if len(uploads) == 1:
+			self._dead_letter(batch)
+			return
+		# Keep what can be written; only the uploads that fail on their own are set aside.
+		for measurements in uploads:
+			try:
+				self.sink(measurements)
+			except Exception:
+				logger.exception(f"Failed to flush an upload of {len(measurements)} measurements")
+				self._dead_letter(measurements)
+
+	def _dead_letter(self, measurements:List[Measurement]) -> None:
+		self.dead_lettered += len(measurements)
+		lines = "".join(m.json() + "\n" for m in measurements)
+		if self.dead_letter_path is not None:
+			try:
+				os.makedirs(os.path.dirname(self.dead_letter_path) or ".", exist_ok = True)
+				with open(self.dead_letter_path, "a") as f:
+					f.write(lines)
+				logger.error(f"Moved {len(measurements)} unwritable measurements to {self.dead_letter_path}")
+				return
+			except OSError:
+				logger.exception(f"Could not append to {self.dead_letter_path}")
+		logger.error(f"Dropped {len(measurements)} unwritable measurements:\n{lines}")
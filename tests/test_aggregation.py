@@ -0,0 +1,46 @@
+import numpy as np
+
+from storage.aggregation import bucket_aggregate, lttb, split_series
+
+
+def test_bucket_aggregate():
+	timestamps = np.array([0, 10, 59, 60, 61, 180], dtype = np.int64)
+	values = np.array([1.0, 5.0, 3.0, 2.0, 4.0, 7.0])
+
+	buckets = bucket_aggregate(timestamps, values, 60)
+
+	assert buckets["bucket"].tolist() == [0, 60, 180]
+	assert buckets["min"].tolist() == [1.0, 2.0, 7.0]
+	assert buckets["max"].tolist() == [5.0, 4.0, 7.0]
+	assert buckets["sum"].tolist() == [9.0, 6.0, 7.0]
+	assert buckets["count"].tolist() == [3, 2, 1]
+	assert buckets["last"].tolist() == [3.0, 4.0, 7.0]
+
+
+def test_bucket_aggregate_empty():
+	assert len(bucket_aggregate(np.empty(0, dtype = np.int64), np.empty(0), 60)["bucket"]) == 0
+
+
+def test_lttb_keeps_endpoints_and_peaks():
+	timestamps = np.arange(1000, dtype = np.int64)
+	values = np.zeros(1000)
+	values[500] = 100.0
+
+	t, v = lttb(timestamps, values, 20)
+
+	assert len(t) == 20
+	assert t[0] == 0 and t[-1] == 999
+	assert 500 in t.tolist()
+	assert np.all(np.diff(t) > 0)
+
+
+def test_lttb_short_series_untouched():
+	timestamps = np.arange(5, dtype = np.int64)
+	t, v = lttb(timestamps, timestamps.astype(float), 10)
+	assert t.tolist() == [0, 1, 2, 3, 4]
+
+
+def test_split_series():
+	series = split_series(["a", "b", "a"], np.array([1, 2, 3]), np.array([1.0, 2.0, 3.0]))
+	assert series["a"][0].tolist() == [1, 3]
+	assert series["b"][1].tolist() == [2.0]
@@ -0,0 +1,12 @@
+from benchmarks.generate import CHANNELS, generate_chunks, station_keys
+
+
+def test_generator_is_reproducible_and_exact():
+	first = [row for chunk in generate_chunks(12345, stations = 7, seed = 3, end = 1600000000, chunk_size = 1000) for row in chunk]
+	second = [row for chunk in generate_chunks(12345, stations = 7, seed = 3, end = 1600000000, chunk_size = 5000) for row in chunk]
+
+	assert first == second
+	assert len(first) == 12345
+	assert {row[0] for row in first} == set(station_keys(7))
+	assert {row[1] for row in first} == {c[0] for c in CHANNELS}
+	assert max(row[4] for row in first) < 1600000000
@@ -0,0 +1,220 @@
+import gzip
+import io
+import json
+
+import numpy as np
+import pytest
+from fastapi.encoders import jsonable_encoder
+from starlette.testclient import TestClient
+
+import server
+from storage.dedup import RecentSamples
+from storage.sqlite_api.driver import MeasurementsDBAdapter
+from storage.models import MeasurementsQuery
+from storage.write_behind import WriteBehindQueue
+from utils import record_json
+from utils.station_cache import StationListCache
+from utils.tiles import StationTileCache
+from test_sqlite_storage_adapter import make_measurement
+
+
+@pytest.fixture
+def adapter(tmp_path, monkeypatch) -> MeasurementsDBAdapter:
+	adapter = MeasurementsDBAdapter(db_path = str(tmp_path / "measurements.db"), echo = False)
+	monkeypatch.setattr(server, "storage_adapter", adapter)
+	station_cache = StationListCache(load = adapter.get_stations)
+	monkeypatch.setattr(server, "station_cache", station_cache)
+	monkeypatch.setattr(server, "tile_cache", StationTileCache(station_cache))
+	monkeypatch.setattr(server, "recent_samples", RecentSamples(capacity = 1000))
+	return adapter
+
+
+@pytest.fixture
+def client(adapter) -> TestClient:
+	return TestClient(server.app)
+
+
+def test_sensor_by_id_honors_limit(adapter, client):
+	adapter.insert_measurements([make_measurement(key = "a", timestamp = 1600000000 + i) for i in range(20)])
+
+	assert len(client.get("/api/v0p2/sensor_by_id/a").json()) == 20
+	assert len(client.get("/api/v0p2/sensor_by_id/a", params = {"limit": 5}).json()) == 5
+
+
+def test_sensor_by_id_streams_ndjson(adapter, client):
+	adapter.insert_measurements([make_measurement(key = "a", timestamp = 1600000000 + i, value = i) for i in range(3)])
+	expected = client.get("/api/v0p2/sensor_by_id/a").json()
+
+	by_header = client.get("/api/v0p2/sensor_by_id/a", headers = {"Accept": "application/x-ndjson"})
+	assert by_header.headers["content-type"].startswith("application/x-ndjson")
+	assert [json.loads(line) for line in by_header.text.splitlines()] == expected
+
+	by_flag = client.get("/api/v0p2/sensor_by_id/a", params = {"format": "ndjson", "limit": 2})
+	assert [json.loads(line) for line in by_flag.text.splitlines()] == expected[:2]
+
+
+def test_sensor_by_id_pages_with_cursor(adapter, client):
+	adapter.insert_measurements([make_measurement(key = "a", timestamp = 1600000000 + i, value = i) for i in range(5)])
+
+	first = client.get("/api/v0p2/sensor_by_id/a", params = {"limit": 3})
+	assert [m["value"] for m in first.json()] == [0, 1, 2]
+
+	second = client.get("/api/v0p2/sensor_by_id/a", params = {"limit": 3, "after": first.headers["x-next-cursor"]})
+	assert [m["value"] for m in second.json()] == [3, 4]
+	assert "x-next-cursor" not in second.headers
+
+	assert client.get("/api/v0p2/sensor_by_id/a", params = {"after": "garbage"}).status_code == 400
+
+
+def test_sensor_by_id_columnar_export(adapter, client):
+	adapter.insert_measurements([make_measurement(key = "a", timestamp = 1600000000 + i, value = i + 0.5,
+												  measurement_name = "Temperature" if i % 2 else "Pressure") for i in range(6)])
+	expected = client.get("/api/v0p2/sensor_by_id/a").json()
+
+	response = client.get("/api/v0p2/sensor_by_id/a", params = {"format": "npz"})
+	assert response.headers["content-type"] == "application/x-npz"
+
+	data = np.load(io.BytesIO(response.content))
+	assert int(data["format_version"]) == 1
+	assert data["timestamp"].dtype == np.int64
+	assert data["timestamp"].tolist() == list(range(1600000000, 1600000006))
+	assert data["value"].tolist() == [i + 0.5 for i in range(6)]
+	assert data["measurement_name_dictionary"].tolist() == ["Pressure", "Temperature"]
+	names = data["measurement_name_dictionary"][data["measurement_name_codes"]].tolist()
+	assert names == [m["measurement_name"] for m in expected]
+	assert data["key_dictionary"][data["key_codes"]].tolist() == ["a"] * 6
+
+	limited = np.load(io.BytesIO(client.get("/api/v0p2/sensor_by_id/a", headers = {"Accept": "application/x-npz"},
+											params = {"limit": 2}).content))
+	assert len(limited["value"]) == 2
+
+
+def test_sensor_aggregates(adapter, client):
+	adapter.insert_measurements([make_measurement(key = "a", timestamp = 1600000050 + i * 30, value = i) for i in range(8)])
+
+	buckets = client.get("/api/v0p2/sensor_by_id/a/aggregate", params = {"bucket": 60}).json()
+	assert [(b["min"], b["max"], b["count"], b["last"]) for b in buckets] == [(0, 0, 1, 0), (1, 2, 2, 2), (3, 4, 2, 4),
+																			(5, 6, 2, 6), (7, 7, 1, 7)]
+	assert buckets[1]["mean"] == 1.5
+
+	series, = client.get("/api/v0p2/sensor_by_id/a/aggregate", params = {"points": 3}).json()
+	assert series["measurement_name"] == "Temperature"
+	assert len(series["values"]) == 3
+
+	assert client.get("/api/v0p2/sensor_by_id/a/aggregate").status_code == 400
+
+
+def test_clustered_station_geojson(adapter, client):
+	adapter.insert_measurements([make_measurement(key = f"buoy {i}", lat = 10 + i * 0.001, lon = 20) for i in range(3)] +
+								[make_measurement(key = "far", lat = -30, lon = -60)])
+
+	viewport = {"min_lat": 0, "max_lat": 20, "min_lon": 10, "max_lon": 30, "zoom": 3}
+	response = client.get("/api/v0p2/list_stations/geojson/clustered", params = viewport)
+	assert response.status_code == 200
+	features = response.json()["features"]
+	assert [f["properties"] for f in features] == [{"cluster": True, "count": 3}]
+
+	assert client.get("/api/v0p2/list_stations/geojson/clustered",
+					  params = {**viewport, "zoom": 12}).status_code == 400
+	assert client.get("/api/v0p2/list_stations/geojson/tiles/1/2/0").status_code == 400
+
+	world = client.get("/api/v0p2/list_stations/geojson/tiles/0/0/0")
+	assert sum(f["properties"]["count"] for f in world.json()["features"]) == 4
+	assert client.get("/api/v0p2/list_stations/geojson/tiles/0/0/0",
+					  headers = {"If-None-Match": world.headers["etag"]}).status_code == 304
+
+
+def test_station_frame_upload(adapter, client, monkeypatch):
+	msgpack = pytest.importorskip("msgpack")
+	queue = WriteBehindQueue(sink = server.store_measurements, flush_interval = 0.01)
+	monkeypatch.setattr(server, "ingest_queue", queue)
+
+	frame = {"key": "buoy", "timestamp": 1600000000, "lat": 1.5, "lon": 2.5, "hardware": "Arduino",
+			 "channels": [{"measurement_name": "Temperature", "unit": "C", "value": 21.5},
+						  {"measurement_name": "Pressure", "unit": "hPa", "value": 1013, "hardware": "BMP280"}]}
+	assert client.post("/api/v0p2/station/frame", json = frame).status_code == 200
+	packed = msgpack.packb({**frame, "timestamp": 1600000001})
+	assert client.post("/api/v0p2/station/frame", data = packed,
+					   headers = {"Content-Type": "application/msgpack"}).status_code == 200
+	queue.close()
+
+	stored = client.get("/api/v0p2/sensor_by_id/buoy").json()
+	assert [(m["measurement_name"], m["value"], m["hardware"]) for m in stored] == \
+		   [("Temperature", 21.5, "Arduino"), ("Pressure", 1013, "BMP280")] * 2
+	assert all(m["latitude"] == 1.5 and m["longitude"] == 2.5 for m in stored)
+
+	assert client.post("/api/v0p2/station/frame", json = {"key": "buoy"}).status_code == 422
+	assert client.post("/api/v0p2/station/frame", data = b"\xc1",
+					   headers = {"Content-Type": "application/msgpack"}).status_code == 400
+
+
+def test_gzipped_station_frame_batch(adapter, client, monkeypatch):
+	queue = WriteBehindQueue(sink = server.store_measurements, flush_interval = 0.01)
+	monkeypatch.setattr(server, "ingest_queue", queue)
+
+	frames = [{"key": "buoy", "timestamp": 1600000000 + i, "lat": 1.0, "lon": 2.0, "hardware": "Arduino",
+			   "channels": [{"measurement_name": "Temperature", "unit": "C", "value": i}]} for i in range(5)]
+	body = gzip.compress(json.dumps({"frames": frames}).encode("utf-8"))
+	response = client.post("/api/v0p2/station/frame/batch", data = body,
+						   headers = {"Content-Type": "application/json", "Content-Encoding": "gzip"})
+	assert response.status_code == 200
+	queue.close()
+
+	assert [m["value"] for m in client.get("/api/v0p2/sensor_by_id/buoy").json()] == list(range(5))
+
+	del frames[0]["lat"]
+	assert client.post("/api/v0p2/station/frame/batch", json = {"frames": frames}).status_code == 422
+
+
+def test_resent_uploads_are_stored_once(adapter, client, monkeypatch):
+	monkeypatch.setattr(server, "ingest_queue", WriteBehindQueue(sink = server.store_measurements, flush_interval = 0.01))
+	batch = {"key": "buoy", "measurement_name": "Temperature", "unit": "C", "lat": 1.0, "lon": 2.0,
+			 "hardware": "Arduino", "values": [1, 2, 2, 3], "timestamps": [1600000000, 1600000001, 1600000001, 1600000002]}
+	assert client.post("/api/v0p2/sensor/batch", json = batch).json() == {"status": "ok", "accepted": 3, "duplicates": 1}
+	server.ingest_queue.close()
+
+	queue = WriteBehindQueue(sink = server.store_measurements, flush_interval = 0.01)
+	monkeypatch.setattr(server, "ingest_queue", queue)
+	resent = client.post("/api/v0p2/sensor/batch", json = {**batch, "values": [3, 4], "timestamps": [1600000002, 1600000003]})
+	assert resent.json() == {"status": "ok", "accepted": 1, "duplicates": 1}
+	queue.close()
+
+	assert [m["value"] for m in client.get("/api/v0p2/sensor_by_id/buoy").json()] == [1, 2, 3, 4]
+
+	# Already stored but unknown to the filter, e.g. after a restart: the unique index drops it
+	monkeypatch.setattr(server, "recent_samples", RecentSamples(capacity = 1000))
+	server.store_measurements(list(adapter.get_bounded(MeasurementsQuery(key = "buoy"))))
+	assert len(list(adapter.get_bounded(MeasurementsQuery(key = "buoy")))) == 4
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_fast_serialization_keeps_the_measurement_schema(adapter, client, monkeypatch, use_orjson):
+	if not use_orjson:
+		monkeypatch.setattr(record_json, "orjson", None)
+	adapter.insert_measurements([make_measurement(key = "a", timestamp = 1600000000 + i, value = v, lat = 1.25, lon = -3.5)
+								 for i, v in enumerate([3, 2.5, -0.125, 1e6])])
+
+	expected = jsonable_encoder(list(adapter.get_bounded(MeasurementsQuery(key = "a"))))
+	assert client.get("/api/v0p2/sensor_by_id/a").json() == expected
+	assert client.get("/api/v0p2/sensor_by_id/a", params = {"limit": 3}).json() == expected[:3]
+	ndjson = client.get("/api/v0p2/sensor_by_id/a", params = {"format": "ndjson"})
+	assert [json.loads(line) for line in ndjson.text.splitlines()] == expected
+	assert client.get("/api/v0p1/debug/get_data").json() == expected
+
+
+def test_metrics_report_routes_ingest_and_storage(adapter, client):
+	adapter.insert_measurements([make_measurement(key = "a", timestamp = 1600000000 + i) for i in range(3)])
+	client.get("/api/v0p2/sensor_by_id/a")
+	client.get("/api/v0p2/sensor_by_id/b")
+	client.get("/no/such/route")
+	server.store_measurements([make_measurement(key = "c")])
+
+	response = client.get("/metrics")
+	assert response.headers["content-type"].startswith("text/plain")
+	lines = response.text.splitlines()
+	count = 'http_request_duration_seconds_count{method="GET",route="/api/v0p2/sensor_by_id/{sensor_id}"}'
+	assert any(line.startswith(count) and int(line.split()[-1]) >= 2 for line in lines)
+	assert any(line.startswith('http_requests_total{method="GET",route="unmatched",status="404"}') for line in lines)
+	assert any(line.startswith("ingest_rows_total ") and float(line.split()[-1]) >= 1 for line in lines)
+	assert any(line.startswith('storage_query_duration_seconds_count{statement="SELECT"}') for line in lines)
+	assert any(line.startswith("ingest_queue_depth ") for line in lines)
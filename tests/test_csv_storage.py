@@ -0,0 +1,72 @@
+import os
+from datetime import datetime
+from typing import Optional
+
+import pytest
+from pydantic import BaseModel
+
+from storage.csv_api.driver import CSVAPI
+
+
+class Reading(BaseModel):
+	key: str
+	timestamp: datetime
+	value: float
+	note: Optional[str]
+
+
+def reading(key:str, timestamp:int, note:Optional[str] = None) -> Reading:
+	return Reading(key = key, timestamp = datetime.fromtimestamp(timestamp), value = timestamp / 10, note = note)
+
+
+@pytest.fixture
+def path(tmp_path) -> str:
+	return str(tmp_path / "readings.csv")
+
+
+def test_query_by_time_range_and_key(path):
+	api = CSVAPI(path = path, schema = Reading, flush_size = 3)
+	written = [reading("ab"[i % 2], 1600000000 + i, note = "x,\"y\"" if i == 4 else None) for i in range(10)]
+	for r in written:
+		api.write(r)
+
+	assert api.get_data() == written
+	assert list(api.query(key = "a")) == written[::2]
+	assert list(api.query(time_range = (datetime.fromtimestamp(1600000003), datetime.fromtimestamp(1600000006)),
+						  key = "b")) == [written[3], written[5]]
+	assert list(api.query(key = "c")) == []
+
+
+def test_reopening_reads_only_the_index(path, monkeypatch):
+	api = CSVAPI(path = path, schema = Reading)
+	written = [reading("a", 1600000000 + i) for i in range(5)]
+	for r in written:
+		api.write(r)
+	api.close()
+
+	parsed = []
+	decode = Reading.__init__
+	monkeypatch.setattr(Reading, "__init__", lambda self, **kw: parsed.append(kw) or decode(self, **kw))
+	reopened = CSVAPI(path = path, schema = Reading)
+	assert len(reopened) == 5
+	assert parsed == []
+
+	assert list(reopened.query(time_range = (datetime.fromtimestamp(1600000004), datetime.fromtimestamp(1600000010)))) == written[4:]
+	assert len(parsed) == 1
+
+
+def test_rows_without_index_entries_are_recovered(path):
+	api = CSVAPI(path = path, schema = Reading)
+	for i in range(4):
+		api.write(reading("a", 1600000000 + i))
+	api.close()
+
+	# Last index entry lost and a torn row at the end, as after a crash mid-flush
+	os.truncate(path + ".idx", os.path.getsize(path + ".idx") - 32)
+	with open(path, "ab") as f:
+		f.write(b"a,2020-09-13 12:26:44,1.0")
+
+	reopened = CSVAPI(path = path, schema = Reading)
+	assert [r.timestamp for r in reopened.get_data()] == [datetime.fromtimestamp(1600000000 + i) for i in range(4)]
+	reopened.write(reading("a", 1600000009))
+	assert len(reopened.get_data()) == 5
@@ -0,0 +1,14 @@
+from storage.dedup import RecentSamples
+
+
+def test_recent_samples_forget_old_generations():
+	recent = RecentSamples(capacity = 100, false_positive_rate = 0.01)
+	samples = [("a", "Temperature", 1600000000 + i) for i in range(300)]
+
+	recent.add_all(samples[:100])
+	assert all(recent.might_contain(s) for s in samples[:100])
+	assert sum(recent.might_contain(s) for s in samples[100:]) < 10
+
+	recent.add_all(samples[100:300])
+	assert all(recent.might_contain(s) for s in samples[200:])
+	assert sum(recent.might_contain(s) for s in samples[:100]) < 10
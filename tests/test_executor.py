@@ -0,0 +1,28 @@
+import asyncio
+import threading
+import time
+
+from storage.executor import StorageExecutor
+
+
+def test_blocking_calls_leave_the_event_loop_free():
+	executor = StorageExecutor(max_workers = 2)
+	release = threading.Event()
+
+	async def scenario():
+		slow = asyncio.ensure_future(executor.run(release.wait, 5))
+		# The loop keeps serving while a worker is blocked.
+		assert await executor.run(lambda: threading.current_thread().name.startswith("storage-read"))
+		await asyncio.sleep(0.01)
+		assert not slow.done()
+		release.set()
+		assert await slow
+
+		def chunks():
+			for i in range(3):
+				time.sleep(0.001)
+				yield [i]
+		return [chunk async for chunk in executor.iterate(chunks())]
+
+	assert asyncio.run(scenario()) == [[0], [1], [2]]
+	executor.shutdown()
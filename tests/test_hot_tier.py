@@ -0,0 +1,136 @@
+import os
+import random
+import time
+from datetime import datetime
+
+import pytest
+
+from storage.hot_tier import HotTierAdapter
+from storage.models import MeasurementsQuery
+from storage.sqlite_api.driver import MeasurementsDBAdapter
+from storage.sqlite_api.partitioned import PartitionedMeasurementsDBAdapter
+from test_sqlite_storage_adapter import make_measurement
+
+NOW = int(time.time())
+
+
+def storage_only(*args, **kwargs):
+	raise AssertionError("query should have been answered from memory")
+
+
+@pytest.fixture
+def adapter(tmp_path) -> MeasurementsDBAdapter:
+	return MeasurementsDBAdapter(db_path = str(tmp_path / "measurements.db"), echo = False)
+
+
+def rows(adapter, query:MeasurementsQuery, **kwargs):
+	return [row for chunk in adapter.iter_bounded_rows(query, **kwargs) for row in chunk]
+
+
+def since(seconds:int) -> MeasurementsQuery:
+	return MeasurementsQuery(key = "a", time_range = (datetime.fromtimestamp(NOW - seconds), datetime.fromtimestamp(NOW + 10)))
+
+
+def test_recent_reads_come_from_memory_and_match_storage(adapter, monkeypatch):
+	rng = random.Random(5)
+	old = [make_measurement(key = rng.choice("ab"), timestamp = NOW - 7200 - rng.randrange(3600), value = rng.uniform(0, 9),
+							measurement_name = rng.choice(["Temperature", "Pressure"])) for _ in range(50)]
+	recent = [make_measurement(key = rng.choice("ab"), timestamp = NOW - rng.randrange(3600), value = rng.uniform(0, 9),
+							   measurement_name = rng.choice(["Temperature", "Pressure"])) for _ in range(50)]
+	adapter.insert_measurements(old + recent[:25])
+
+	hot = HotTierAdapter(adapter, window_seconds = 3600)
+	assert hot.warm() == len([m for m in recent[:25] if m.timestamp.timestamp() > NOW - 3600])
+	hot.insert_measurements(recent[25:])
+
+	queries = [since(1800), since(3500), since(1800).copy(update = {"measurement_name": "Pressure"}),
+			   since(3500).copy(update = {"lats": (-1, 1), "hardware": "Thermometer"})]
+	expected = [rows(adapter, q) for q in queries]
+	limited = rows(adapter, queries[0], limit = 7)
+
+	monkeypatch.setattr(adapter, "iter_bounded_rows", storage_only)
+	for query, result in zip(queries, expected):
+		assert [tuple(r) for r in rows(hot, query)] == [tuple(r) for r in result]
+	assert [tuple(r) for r in rows(hot, queries[0], limit = 7)] == [tuple(r) for r in limited]
+	assert [m.value for m in hot.get_bounded(queries[0])] == [r[3] for r in expected[0]]
+
+
+def test_first_pages_that_fit_come_from_memory(adapter, monkeypatch):
+	adapter.insert_measurements([make_measurement(key = "a", timestamp = NOW - 60 * i, value = i) for i in range(1, 20)])
+	hot = HotTierAdapter(adapter, window_seconds = 3600)
+	hot.warm()
+	expected, _ = adapter.get_record_page(since(1800), limit = 100)
+
+	monkeypatch.setattr(adapter, "get_record_page", storage_only)
+	assert hot.get_record_page(since(1800), limit = 100) == (expected, None)
+	with pytest.raises(AssertionError):
+		hot.get_record_page(since(1800), limit = 5)
+
+
+def test_reads_snapshot_the_rings_once(adapter, monkeypatch):
+	adapter.insert_measurements([make_measurement(key = "a", timestamp = NOW - 60 * i, value = i) for i in range(1, 20)])
+	hot = HotTierAdapter(adapter, window_seconds = 3600)
+	hot.warm()
+
+	snapshots = []
+	hot_rows = hot.__hot_rows__
+	monkeypatch.setattr(hot, "__hot_rows__", lambda *args: snapshots.append(args) or hot_rows(*args))
+	assert sorted(m.value for m in hot.get_bounded(since(1800))) == list(range(1, 20))
+	assert len(snapshots) == 1
+
+
+def test_retention_reloads_the_tier(tmp_path):
+	partitioned = PartitionedMeasurementsDBAdapter(data_dir = str(tmp_path), period = "day", retention_days = 1)
+	partitioned.insert_measurements([make_measurement(key = "a", timestamp = NOW - 60)])
+	hot = HotTierAdapter(partitioned, window_seconds = 3600)
+	hot.warm()
+	assert len(list(hot.get_bounded(since(1800)))) == 1
+
+	assert hot.drop_expired(now = NOW + 3 * 86400)
+	assert list(hot.get_bounded(since(1800))) == []
+	assert os.listdir(tmp_path) == []
+
+
+def test_reads_before_the_window_go_to_storage(adapter):
+	adapter.insert_measurements([make_measurement(key = "a", timestamp = NOW - 7200), make_measurement(key = "a", timestamp = NOW - 60)])
+	hot = HotTierAdapter(adapter, window_seconds = 3600)
+
+	# Not warmed yet, so nothing is known to be complete.
+	assert len(rows(hot, since(600))) == 1
+	hot.warm()
+	assert len(rows(hot, since(10000))) == 2
+	assert len(rows(hot, MeasurementsQuery(key = "a"))) == 2
+
+
+def test_overwritten_samples_move_coverage_forward(adapter, monkeypatch):
+	hot = HotTierAdapter(adapter, samples_per_series = 10, window_seconds = 3600)
+	hot.warm()
+	hot.insert_measurements([make_measurement(key = "a", timestamp = NOW - 100 + i) for i in range(30)])
+
+	assert len(rows(hot, since(101))) == 30
+	monkeypatch.setattr(adapter, "iter_bounded_rows", storage_only)
+	assert len(rows(hot, since(81))) == 10
+
+
+def test_memory_budget_drops_least_recently_used_series(adapter):
+	hot = HotTierAdapter(adapter, samples_per_series = 64, window_seconds = 3600, max_bytes = 3 * 64 * 52)
+	hot.warm()
+	for key in "abcd":
+		hot.insert_measurements([make_measurement(key = key, timestamp = NOW - 100 + i) for i in range(10)])
+
+	assert hot.nbytes <= hot.max_bytes
+	# "a" was dropped, so its reads fall back to storage and still see everything.
+	assert len(rows(hot, since(1000))) == 10
+	hot.insert_measurement(make_measurement(key = "a", timestamp = NOW))
+	assert len(rows(hot, since(1000))) == 11
+
+
+def test_resent_samples_are_kept_once(adapter, monkeypatch):
+	hot = HotTierAdapter(adapter, window_seconds = 3600)
+	hot.warm()
+	batch = [make_measurement(key = "a", timestamp = NOW - 10 + i, value = i) for i in range(3)]
+	assert hot.insert_measurements(batch) == 3
+	assert hot.insert_measurements(batch[1:] + [batch[2]]) == 0
+
+	monkeypatch.setattr(adapter, "iter_bounded_rows", storage_only)
+	assert [m.value for m in hot.get_bounded(since(60))] == [0, 1, 2]
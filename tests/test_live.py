@@ -0,0 +1,97 @@
+import asyncio
+import json
+import threading
+
+import server
+from storage.models import MeasurementsQuery
+from storage.sqlite_api.driver import MeasurementsDBAdapter
+from utils.live import LiveHub
+from utils.station_cache import StationListCache
+from test_sqlite_storage_adapter import make_measurement
+
+
+def test_subscribers_get_matching_measurements_published_from_another_thread():
+	hub = LiveHub(buffer_size = 10)
+
+	async def scenario():
+		by_key = hub.subscribe(key = "a")
+		by_box = hub.subscribe(measurement_name = "Pressure", lats = (0, 10), lons = (0, 10))
+		batch = [make_measurement(key = "a", lat = 20), make_measurement(key = "b", lat = 5, lon = 5, measurement_name = "Pressure"),
+				 make_measurement(key = "b", lat = 50, measurement_name = "Pressure")]
+		publisher = threading.Thread(target = hub.publish, args = (batch,))
+		publisher.start()
+		received = [await asyncio.wait_for(by_key.get(), 1), await asyncio.wait_for(by_box.get(), 1)]
+		publisher.join()
+		return received
+
+	by_key, by_box = asyncio.run(scenario())
+	assert [(m.key, m.latitude) for m in by_key] == [("a", 20)]
+	assert [(m.key, m.latitude) for m in by_box] == [("b", 5)]
+
+
+def test_slow_subscribers_are_dropped_without_blocking_publish():
+	hub = LiveHub(buffer_size = 5)
+
+	async def scenario():
+		slow = hub.subscribe()
+		fast = hub.subscribe()
+		for i in range(3):
+			hub.publish([make_measurement(timestamp = 1600000000 + 2 * i + j) for j in range(2)])
+			assert len(await fast.get()) == 2
+		await asyncio.sleep(0)
+		return slow, await slow.get()
+
+	slow, batch = asyncio.run(scenario())
+	assert batch is None and slow.overflowed
+	assert len(hub) == 1 and hub.dropped == 1
+
+
+def test_live_events_stream_batches_as_server_sent_events(monkeypatch):
+	hub = LiveHub(buffer_size = 3)
+	monkeypatch.setattr(server, "live_hub", hub)
+
+	async def scenario():
+		subscription = hub.subscribe(key = "a")
+		events = server.live_events(subscription)
+		hub.publish([make_measurement(key = "a", value = 2.5), make_measurement(key = "b")])
+		first = await events.__anext__()
+		hub.publish([make_measurement(key = "a", timestamp = 1600000001 + i) for i in range(4)])
+		return first, [event async for event in events]
+
+	first, rest = asyncio.run(scenario())
+	assert first.startswith(b"data: ") and first.endswith(b"\n\n")
+	assert [(m["key"], m["value"]) for m in json.loads(first[len(b"data: "):])] == [("a", 2.5)]
+	assert rest == [b"event: dropped\ndata: {}\n\n"]
+	assert len(hub) == 0
+
+
+def test_bounding_box_matches_like_a_storage_query(tmp_path):
+	adapter = MeasurementsDBAdapter(db_path = str(tmp_path / "measurements.db"), echo = False)
+	batch = [make_measurement(timestamp = 1600000000 + i, lat = lat, lon = 5) for i, lat in enumerate([0, 5, 10, 11])]
+	adapter.insert_measurements(batch)
+	stored = [m.latitude for m in adapter.get_bounded(MeasurementsQuery(lats = (10, 0), lons = (10, 0)))]
+
+	async def scenario():
+		reversed_box = LiveHub().subscribe(lats = (10, 0), lons = (10, 0))
+		return [m.latitude for m in batch if reversed_box.matches(m)]
+
+	assert asyncio.run(scenario()) == stored == [5]
+
+
+def test_only_newly_stored_measurements_are_published(tmp_path, monkeypatch):
+	adapter = MeasurementsDBAdapter(db_path = str(tmp_path / "measurements.db"), echo = False)
+	monkeypatch.setattr(server, "storage_adapter", adapter)
+	monkeypatch.setattr(server, "station_cache", StationListCache(load = adapter.get_stations))
+	hub = LiveHub()
+	monkeypatch.setattr(server, "live_hub", hub)
+	server.store_measurements([make_measurement(timestamp = 1600000000, value = 1)])
+
+	async def scenario():
+		subscription = hub.subscribe()
+		# A retried sample, one repeated within the batch and one new one.
+		server.store_measurements([make_measurement(timestamp = 1600000000, value = 1),
+								   make_measurement(timestamp = 1600000001, value = 2),
+								   make_measurement(timestamp = 1600000001, value = 3)])
+		return await asyncio.wait_for(subscription.get(), 1)
+
+	assert [m.value for m in asyncio.run(scenario())] == [2]
@@ -0,0 +1,31 @@
+import logging
+
+from sqlalchemy import create_engine
+
+from utils.metrics import MetricsRegistry, instrument_sqlalchemy
+
+
+def test_histogram_renders_cumulative_buckets():
+	registry = MetricsRegistry()
+	histogram = registry.histogram("latency_seconds", "Latency.", labels = ["route"], buckets = [.1, 1])
+	for value in (.05, .5, .5, 5):
+		histogram.observe(value, 'a"b')
+
+	lines = registry.render().splitlines()
+	assert lines[:2] == ["# HELP latency_seconds Latency.", "# TYPE latency_seconds histogram"]
+	assert lines[2:] == ['latency_seconds_bucket{route="a\\"b",le="0.1"} 1',
+						 'latency_seconds_bucket{route="a\\"b",le="1"} 3',
+						 'latency_seconds_bucket{route="a\\"b",le="+Inf"} 4',
+						 'latency_seconds_sum{route="a\\"b"} 6.05',
+						 'latency_seconds_count{route="a\\"b"} 4']
+
+
+def test_slow_statements_are_logged(caplog):
+	registry = MetricsRegistry()
+	engine = create_engine("sqlite://")
+	instrument_sqlalchemy(registry, slow_query_seconds = 0, engine = engine)
+
+	with caplog.at_level(logging.WARNING, logger = "storage.slow_queries"):
+		engine.execute("SELECT 1")
+	assert any("SELECT 1" in record.getMessage() for record in caplog.records)
+	assert 'storage_query_duration_seconds_count{statement="SELECT"} 1' in registry.render()
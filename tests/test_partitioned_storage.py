@@ -0,0 +1,131 @@
+import os
+import random
+import threading
+from datetime import datetime
+
+import pytest
+
+from storage.models import MeasurementsQuery
+from storage.sqlite_api.driver import MeasurementsDBAdapter
+from storage.sqlite_api.partitioned import PartitionedMeasurementsDBAdapter
+from test_sqlite_storage_adapter import make_measurement, aggregates_as_tuples
+
+# 2020-08-15 .. 2020-11-15 UTC: four monthly partitions
+START = 1597449600
+SPAN = 92 * 86400
+
+
+@pytest.fixture
+def history():
+	rng = random.Random(3)
+	return [make_measurement(key = rng.choice("ab"), timestamp = START + rng.randrange(SPAN), value = rng.uniform(-10, 40),
+							 measurement_name = rng.choice(["Temperature", "Pressure"])) for _ in range(3000)]
+
+
+@pytest.fixture
+def single(tmp_path, history) -> MeasurementsDBAdapter:
+	adapter = MeasurementsDBAdapter(db_path = str(tmp_path / "single.db"), echo = False)
+	adapter.insert_measurements(history)
+	return adapter
+
+
+@pytest.fixture
+def partitioned(tmp_path, history) -> PartitionedMeasurementsDBAdapter:
+	adapter = PartitionedMeasurementsDBAdapter(data_dir = str(tmp_path / "partitions"), retention_days = 30)
+	for i in range(0, len(history), 500):
+		adapter.insert_measurements(history[i:i + 500])
+	return adapter
+
+
+def window(t1, t2):
+	return (datetime.fromtimestamp(t1), datetime.fromtimestamp(t2))
+
+
+def test_one_file_per_month(partitioned):
+	assert sorted(os.listdir(partitioned.data_dir)) == [f"measurements_2020_{m:02}.db" for m in (8, 9, 10, 11)]
+
+
+@pytest.mark.parametrize("query", [MeasurementsQuery(key = "a"),
+								   MeasurementsQuery(time_range = window(START + 20 * 86400, START + 50 * 86400)),
+								   MeasurementsQuery(key = "b", lats = (-1, 1), lons = (-1, 1))])
+def test_queries_match_a_single_database(single, partitioned, query):
+	as_tuples = lambda ms: [(m.key, m.timestamp, m.value) for m in ms]
+	expected = as_tuples(single.get_bounded(query))
+	assert as_tuples(partitioned.get_bounded(query)) == expected
+	assert as_tuples(partitioned.get_bounded(query, limit = 700)) == expected[:700]
+
+	seen, cursor = [], None
+	while True:
+		page, cursor = partitioned.get_page(query, limit = 250, after = cursor)
+		seen.extend(page)
+		if cursor is None:
+			break
+	assert as_tuples(seen) == expected
+
+	assert aggregates_as_tuples(partitioned.get_aggregated(query, 7 * 86400)) == \
+		   aggregates_as_tuples(single.get_aggregated(query, 7 * 86400))
+	assert partitioned.get_downsampled(query, 50) == single.get_downsampled(query, 50)
+
+
+def test_only_overlapping_partitions_are_opened(tmp_path, partitioned):
+	reopened = PartitionedMeasurementsDBAdapter(data_dir = partitioned.data_dir)
+	september = window(1598918400 + 86400, 1601510400 - 86400)
+	assert len(list(reopened.get_bounded(MeasurementsQuery(time_range = september)))) > 0
+	opened = [os.path.basename(p.path) for p in reopened.partitions if p._adapter is not None]
+	assert opened == ["measurements_2020_09.db"]
+
+
+def test_stations_are_merged_across_partitions(single, partitioned):
+	assert list(partitioned.get_stations()) == list(single.get_stations())
+
+
+def test_retention_drops_whole_partitions(partitioned):
+	# Thirty days after the end of September: August and September are past retention.
+	dropped = partitioned.drop_expired(now = 1601510400 + 30 * 86400)
+	assert sorted(os.path.basename(p) for p in dropped) == ["measurements_2020_08.db", "measurements_2020_09.db"]
+	assert sorted(os.listdir(partitioned.data_dir)) == ["measurements_2020_10.db", "measurements_2020_11.db"]
+	assert min(m.timestamp for m in partitioned.get_bounded(MeasurementsQuery())) >= datetime.fromtimestamp(1601510400)
+
+
+def test_dropped_partitions_are_not_reopened(partitioned):
+	august = partitioned.partitions[0]
+	adapter = august.adapter
+	conns = []
+	reader = threading.Thread(target = lambda: conns.append(adapter.conn))
+	reader.start()
+	reader.join()
+
+	partitioned.drop_expired(now = 1601510400 + 30 * 86400)
+	assert conns[0].closed
+	with pytest.raises(RuntimeError):
+		august.adapter
+	assert not os.path.exists(august.path)
+
+
+def test_page_ending_at_a_partition_boundary(tmp_path):
+	adapter = PartitionedMeasurementsDBAdapter(data_dir = str(tmp_path))
+	end_of_august = 1598918400
+	adapter.insert_measurements([make_measurement(timestamp = end_of_august - 4 + i, value = i) for i in range(8)])
+
+	first, cursor = adapter.get_page(MeasurementsQuery(), limit = 4)
+	assert [m.value for m in first] == [0, 1, 2, 3]
+	second, last = adapter.get_page(MeasurementsQuery(), limit = 4, after = cursor)
+	assert [m.value for m in second] == [4, 5, 6, 7]
+	assert last is None
+
+
+def test_existing_single_database_is_imported_on_first_start(tmp_path, history):
+	data_dir = tmp_path / "data"
+	data_dir.mkdir()
+	legacy = MeasurementsDBAdapter(db_path = str(data_dir / "measurements.db"), echo = False)
+	legacy.insert_measurements(history[:200])
+	legacy.engine.dispose()
+
+	adapter = PartitionedMeasurementsDBAdapter(data_dir = str(data_dir))
+	assert len(list(adapter.get_bounded(MeasurementsQuery()))) == 200
+	assert not (data_dir / "measurements.db").exists() and (data_dir / "measurements.db.imported").exists()
+
+	# A single database showing up next to partitions would be hidden from every read.
+	os.replace(data_dir / "measurements.db.imported", data_dir / "measurements.db")
+	with pytest.raises(RuntimeError):
+		PartitionedMeasurementsDBAdapter(data_dir = str(data_dir))
@@ -0,0 +1,95 @@
+import random
+import time
+from datetime import datetime
+
+import pytest
+
+from storage.models import MeasurementsQuery
+from storage.range_cache import RangeCacheAdapter
+from storage.sqlite_api.driver import MeasurementsDBAdapter
+from test_sqlite_storage_adapter import make_measurement
+
+HOUR = 3600
+# Start of an hour two days ago, so every chunk below has ended.
+T0 = int(time.time()) // HOUR * HOUR - 48 * HOUR
+
+
+def storage_only(*args, **kwargs):
+	raise AssertionError("query should have been answered from the cache")
+
+
+@pytest.fixture
+def adapter(tmp_path) -> MeasurementsDBAdapter:
+	adapter = MeasurementsDBAdapter(db_path = str(tmp_path / "measurements.db"), echo = False)
+	rng = random.Random(3)
+	adapter.insert_measurements([make_measurement(key = rng.choice("ab"), timestamp = T0 + i * 60, value = i,
+												  measurement_name = rng.choice(["Temperature", "Pressure"]))
+								 for i in range(24 * 60)])
+	return adapter
+
+
+def window(t1:int, t2:int, **filters) -> MeasurementsQuery:
+	return MeasurementsQuery(key = "a", time_range = (datetime.fromtimestamp(t1), datetime.fromtimestamp(t2)), **filters)
+
+
+def test_overlapping_windows_share_chunks_and_match_storage(adapter, monkeypatch):
+	cache = RangeCacheAdapter(adapter, chunk_seconds = HOUR)
+	queries = [window(T0 - 10, T0 + 6 * HOUR), window(T0 + 90, T0 + 3 * HOUR + 30),
+			   window(T0 + HOUR, T0 + 5 * HOUR, measurement_name = "Pressure")]
+	expected = [list(adapter.iter_bounded_records(q)) for q in queries]
+	expected = [[r for rows in e for r in rows] for e in expected]
+
+	assert [[r for rows in cache.iter_bounded_records(q) for r in rows] for q in queries] == expected
+	assert cache.misses == 7 + 4 and cache.hits == 4
+	# The first hours of the first and third window were only partly read, they are filled on their second miss.
+	assert len(cache) == 6 + 3
+	assert [[r for rows in cache.iter_bounded_records(q) for r in rows] for q in queries] == expected
+	assert len(cache) == 7 + 4
+
+	monkeypatch.setattr(adapter, "iter_bounded_rows", storage_only)
+	assert [[r for rows in cache.iter_bounded_records(q) for r in rows] for q in queries] == expected
+	assert [m.value for m in cache.get_bounded(queries[1], limit = 3)] == [r.value for r in expected[1][:3]]
+	assert cache.hit_ratio > 0.5
+
+
+def test_first_pages_that_fit_come_from_the_cache(adapter, monkeypatch):
+	cache = RangeCacheAdapter(adapter, chunk_seconds = HOUR)
+	query = window(T0 - 1, T0 + 2 * HOUR)
+	expected, _ = adapter.get_record_page(query, limit = 1000)
+	list(cache.get_bounded(query))
+
+	monkeypatch.setattr(adapter, "iter_bounded_rows", storage_only)
+	monkeypatch.setattr(adapter, "get_record_page", storage_only)
+	assert cache.get_record_page(query, limit = 1000) == (expected, None)
+	with pytest.raises(AssertionError):
+		cache.get_record_page(query, limit = 10)
+
+
+def test_late_writes_drop_their_chunk(adapter):
+	cache = RangeCacheAdapter(adapter, chunk_seconds = HOUR)
+	query = window(T0 - 1, T0 + 3 * HOUR)
+	before = len(list(cache.get_bounded(query)))
+	assert len(cache) == 3
+
+	cache.insert_measurements([make_measurement(key = "a", timestamp = T0 + HOUR + 1, measurement_name = "Humidity"),
+							   make_measurement(key = "b", timestamp = T0 + 2 * HOUR + 1, measurement_name = "Humidity")])
+	assert len(cache) == 2
+	assert len(list(cache.get_bounded(query))) == before + 1
+
+
+def test_recent_and_unkeyed_reads_go_to_storage(adapter):
+	cache = RangeCacheAdapter(adapter, chunk_seconds = HOUR)
+	now = int(time.time())
+	cache.insert_measurements([make_measurement(key = "a", timestamp = now - 1)])
+
+	assert len(list(cache.get_bounded(window(now - 10, now + 10)))) == 1
+	assert len(list(cache.get_bounded(MeasurementsQuery(time_range = (datetime.fromtimestamp(T0 - 1),
+																	  datetime.fromtimestamp(T0 + HOUR)))))) == 60
+	assert len(cache) == 0
+
+
+def test_memory_budget_drops_least_recently_used_chunks(adapter):
+	cache = RangeCacheAdapter(adapter, chunk_seconds = HOUR, max_bytes = 400 * 60 * 8)
+	list(cache.get_bounded(window(T0 - 1, T0 + 24 * HOUR)))
+	assert cache.nbytes <= cache.max_bytes
+	assert 0 < len(cache) < 24
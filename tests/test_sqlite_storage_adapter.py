@@ -0,0 +1,270 @@
+import random
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from datetime import datetime
+from typing import List
+
+from sqlalchemy import create_engine, text, MetaData, Table, Column, Integer, String, Numeric, DateTime, Float
+
+from storage.models import Measurement, MeasurementsQuery, MeasurementsCursor
+from storage.sqlite_api.driver import MeasurementsDBAdapter, SCHEMA_VERSION
+
+
+def make_measurement(key:str = "Otto's station", timestamp:int = 1600000000, value:float = 1.0,
+					 lat:float = 0.0, lon:float = 0.0, measurement_name:str = "Temperature") -> Measurement:
+	return Measurement(key = key,
+					   measurement_name = measurement_name,
+					   unit = "C",
+					   value = value,
+					   timestamp = datetime.fromtimestamp(timestamp),
+					   receipt_time = datetime.fromtimestamp(timestamp + 1),
+					   latitude = lat,
+					   longitude = lon,
+					   hardware = "Thermometer")
+
+
+@pytest.fixture
+def adapter(tmp_path) -> MeasurementsDBAdapter:
+	return MeasurementsDBAdapter(db_path = str(tmp_path / "measurements.db"), echo = False)
+
+
+def test_insert_measurements_stores_whole_batch(adapter):
+	batch:List[Measurement] = [make_measurement(timestamp = 1600000000 + i) for i in range(500)]
+	adapter.insert_measurements(batch)
+
+	stored = list(adapter.get_bounded(MeasurementsQuery(key = "Otto's station")))
+	assert len(stored) == 500
+	assert sorted(m.timestamp for m in stored) == [m.timestamp for m in batch]
+
+
+def test_insert_measurements_empty_batch_is_noop(adapter):
+	adapter.insert_measurements([])
+	assert list(adapter.get_all()) == []
+
+
+def test_timestamps_are_stored_as_integer_epoch(adapter):
+	adapter.insert_measurements([make_measurement(timestamp = 1600000000)])
+
+	raw = adapter.conn.execute(text("SELECT timestamp, receipt_time, typeof(timestamp) FROM measurements")).first()
+	assert tuple(raw) == (1600000000, 1600000001, "integer")
+	assert list(adapter.get_all())[0].timestamp == datetime.fromtimestamp(1600000000)
+
+
+def test_migrates_datetime_text_schema_in_place(tmp_path):
+	db_path = str(tmp_path / "measurements.db")
+
+	# The unversioned schema, as created before timestamps were stored as epoch integers.
+	engine = create_engine(f"sqlite:///{db_path}")
+	meta = MetaData()
+	legacy = Table("measurements", meta,
+				   Column("id", Integer, primary_key = True),
+				   Column("key", String),
+				   Column("measurement_name", String),
+				   Column("unit", String),
+				   Column("value", Numeric),
+				   Column("timestamp", DateTime),
+				   Column("receipt_time", DateTime),
+				   Column("latitude", Float),
+				   Column("longitude", Float),
+				   Column("hardware", String))
+	meta.create_all(engine)
+	legacy_rows = [make_measurement(timestamp = 1600000000 + i, value = i).dict() for i in range(3)]
+	engine.execute(legacy.insert(), legacy_rows)
+	engine.dispose()
+
+	adapter = MeasurementsDBAdapter(db_path = db_path, echo = False)
+
+	assert adapter.conn.execute(text("PRAGMA user_version")).scalar() == SCHEMA_VERSION
+	assert adapter.conn.execute(text("SELECT count(*) FROM sqlite_master WHERE name = 'measurements_v0'")).scalar() == 0
+	migrated = sorted(adapter.get_all(), key = lambda m: m.timestamp)
+	assert [m.dict() for m in migrated] == legacy_rows
+
+	window = (datetime.fromtimestamp(1600000000), datetime.fromtimestamp(1600000002))
+	assert len(list(adapter.get_bounded(MeasurementsQuery(key = "Otto's station", time_range = window)))) == 1
+
+	stations = list(adapter.get_stations())
+	assert [(s.station_key, s.latest_time) for s in stations] == [("Otto's station", datetime.fromtimestamp(1600000002))]
+
+
+@pytest.mark.parametrize("query", [
+	MeasurementsQuery(key = "a"),
+	MeasurementsQuery(key = "a", time_range = (datetime.fromtimestamp(0), datetime.fromtimestamp(10))),
+	MeasurementsQuery(key = "a", measurement_name = "Temperature", unit = "C", hardware = "Thermometer"),
+	MeasurementsQuery(key = "a", lats = (0, 1), lons = (0, 1)),
+	MeasurementsQuery(measurement_name = "Temperature"),
+	MeasurementsQuery(measurement_name = "Temperature", time_range = (datetime.fromtimestamp(0), datetime.fromtimestamp(10))),
+	MeasurementsQuery(time_range = (datetime.fromtimestamp(0), datetime.fromtimestamp(10)), unit = "C"),
+	MeasurementsQuery(receipt_time_range = (datetime.fromtimestamp(0), datetime.fromtimestamp(10)), hardware = "Thermometer"),
+])
+def test_bounded_queries_use_an_index(adapter, query):
+	plan = adapter.explain_bounded(query)
+	# "SCAN measurements USING INDEX ..." walks the whole table in index order; only a SEARCH narrows it.
+	assert re.search(r"^SEARCH measurements\b", plan, re.M) and not re.search(r"^SCAN measurements\b", plan, re.M), plan
+
+
+def test_stations_track_latest_position(adapter):
+	adapter.insert_measurements([make_measurement(key = "a", timestamp = 100, lat = 1, lon = 1),
+								 make_measurement(key = "b", timestamp = 100, lat = 5, lon = 5)])
+	adapter.insert_measurement(make_measurement(key = "a", timestamp = 200, lat = 2, lon = 2))
+
+	stations = {s.station_key: s for s in adapter.get_stations()}
+	assert (stations["a"].lat, stations["a"].lon, stations["a"].latest_time) == (2, 2, datetime.fromtimestamp(200))
+	assert (stations["b"].lat, stations["b"].lon) == (5, 5)
+
+
+def test_late_samples_do_not_move_station(adapter):
+	adapter.insert_measurements([make_measurement(key = "a", timestamp = 200, lat = 2, lon = 2)])
+	adapter.insert_measurements([make_measurement(key = "a", timestamp = 150, lat = 9, lon = 9)])
+
+	station, = adapter.get_stations()
+	assert (station.lat, station.lon, station.latest_time) == (2, 2, datetime.fromtimestamp(200))
+
+
+def test_bounded_limit_and_chunks(adapter):
+	adapter.insert_measurements([make_measurement(timestamp = 1600000000 + i) for i in range(25)])
+	query = MeasurementsQuery(key = "Otto's station")
+
+	assert len(list(adapter.get_bounded(query, limit = 10))) == 10
+	assert [len(chunk) for chunk in adapter.iter_bounded_chunks(query, chunk_size = 10)] == [10, 10, 5]
+	assert [len(chunk) for chunk in adapter.iter_bounded_chunks(query, limit = 12, chunk_size = 10)] == [10, 2]
+
+
+def test_pages_cover_result_exactly_once(adapter):
+	# Several channels share each timestamp, so the cursor has to break ties on id.
+	adapter.insert_measurements([make_measurement(key = "a", timestamp = 1600000000 + i // 3, value = i,
+												  measurement_name = f"channel {i % 3}") for i in range(20)])
+	adapter.insert_measurements([make_measurement(key = "b", timestamp = 1600000000)])
+	query = MeasurementsQuery(key = "a")
+
+	seen = []
+	cursor = None
+	while True:
+		page, cursor = adapter.get_page(query, limit = 4, after = cursor)
+		seen.extend(m.value for m in page)
+		if cursor is None:
+			break
+		cursor = MeasurementsCursor.decode(cursor.encode())
+
+	assert seen == list(range(20))
+	assert list(adapter.get_bounded(query, after = MeasurementsCursor(timestamp = 1600000005, id = 16)))[0].value == 16
+	assert "TEMP B-TREE" not in adapter.explain_bounded(query, after = MeasurementsCursor(timestamp = 0, id = 0))
+
+
+def test_last_page_has_no_cursor(adapter):
+	adapter.insert_measurements([make_measurement(timestamp = 1600000000 + i) for i in range(4)])
+	page, cursor = adapter.get_page(MeasurementsQuery(), limit = 4)
+	assert len(page) == 4
+	assert cursor is None
+
+
+def test_cursor_decoding_rejects_garbage():
+	with pytest.raises(ValueError):
+		MeasurementsCursor.decode("not a cursor")
+
+
+def random_history(adapter, rows:int = 2000, seed:int = 7) -> None:
+	rng = random.Random(seed)
+	# Shuffled so samples arrive out of order, across several stations and channels.
+	batch = [make_measurement(key = rng.choice("ab"),
+							  measurement_name = rng.choice(["Temperature", "Pressure"]),
+							  timestamp = 1600000000 + rng.randrange(3 * 86400),
+							  value = rng.uniform(-10, 40)) for _ in range(rows)]
+	for i in range(0, rows, 300):
+		adapter.insert_measurements(batch[i:i + 300])
+
+
+def aggregates_as_tuples(aggregates):
+	return [(a.measurement_name, a.bucket_start, a.min, a.max, pytest.approx(a.mean), a.count, a.last) for a in aggregates]
+
+
+@pytest.mark.parametrize("bucket_seconds", [60, 600, 3600, 7200, 86400, 90])
+@pytest.mark.parametrize("time_range", [None, (1600000123, 1600170000), (1600000000, 1600000100)])
+def test_rollup_aggregates_match_raw(adapter, bucket_seconds, time_range):
+	random_history(adapter)
+	if time_range is not None:
+		time_range = tuple(datetime.fromtimestamp(t) for t in time_range)
+
+	from_rollups = adapter.get_aggregated(MeasurementsQuery(key = "a", time_range = time_range), bucket_seconds)
+	# Filtering on unit forces the raw path without changing the result.
+	from_raw = adapter.get_aggregated(MeasurementsQuery(key = "a", time_range = time_range, unit = "C"), bucket_seconds)
+
+	assert aggregates_as_tuples(from_rollups) == aggregates_as_tuples(from_raw)
+
+
+def test_rebuild_rollups(adapter):
+	random_history(adapter, rows = 500)
+	query = MeasurementsQuery(measurement_name = "Temperature")
+	before = aggregates_as_tuples(adapter.get_aggregated(query, 3600))
+
+	adapter.conn.execute(text("DELETE FROM rollups"))
+	assert adapter.get_aggregated(query, 3600) == []
+
+	adapter.rebuild_rollups()
+	assert aggregates_as_tuples(adapter.get_aggregated(query, 3600)) == before
+
+
+def test_bounding_box_uses_rtree_and_matches_exact_filter(adapter):
+	rng = random.Random(3)
+	batch = [make_measurement(key = rng.choice("ab"), timestamp = 1600000000 + t,
+							  lat = rng.uniform(-5, 5), lon = rng.uniform(-5, 5)) for t in rng.sample(range(1000), 1000)]
+	# Exactly on the box edge, which the strict bounds exclude.
+	batch.append(make_measurement(key = "a", timestamp = 1600000500, lat = 1.0, lon = 0.5, measurement_name = "Edge"))
+	adapter.insert_measurements(batch)
+
+	window = (datetime.fromtimestamp(1600000100), datetime.fromtimestamp(1600000600))
+	query = MeasurementsQuery(key = "a", lats = (2.0, -1.0), lons = (-1.5, 1.0), time_range = window)
+	expected = sorted((m.timestamp, m.latitude, m.longitude) for m in batch
+					  if m.key == "a" and -1.0 < m.latitude < 2.0 and -1.5 < m.longitude < 1.0 and window[0] < m.timestamp < window[1])
+
+	found = [(m.timestamp, m.latitude, m.longitude) for m in adapter.get_bounded(query)]
+	assert sorted(found) == expected
+	assert len(expected) > 0
+	assert "measurements_rtree" in adapter.explain_bounded(MeasurementsQuery(lats = (0, 1), lons = (0, 1)))
+
+
+def test_reads_are_not_blocked_by_an_open_write(adapter):
+	adapter.insert_measurements([make_measurement(key = "a", timestamp = 1600000000)])
+	assert adapter.conn.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+
+	with adapter.engine.connect() as writer:
+		transaction = writer.begin()
+		writer.execute(adapter.measurements.insert(), [make_measurement(key = "b", timestamp = 1600000001).dict()])
+
+		# Another thread's read connection sees the last committed state without waiting on the writer.
+		pool = ThreadPoolExecutor(max_workers = 1)
+		keys = pool.submit(lambda: [s.station_key for s in adapter.get_stations()]).result(timeout = 1)
+		assert keys == ["a"]
+
+		transaction.commit()
+	assert pool.submit(lambda: [s.station_key for s in adapter.get_stations()]).result() == ["a", "b"]
+	pool.shutdown()
+
+
+def test_resent_samples_are_ignored(adapter):
+	first = [make_measurement(timestamp = 1600000000 + i, value = i) for i in range(3)]
+	assert adapter.insert_measurements(first) == 3
+	assert adapter.insert_measurements([make_measurement(timestamp = 1600000002, value = 9),
+										make_measurement(timestamp = 1600000003, value = 3)]) == 1
+
+	assert [m.value for m in adapter.get_bounded(MeasurementsQuery(key = "Otto's station"))] == [0, 1, 2, 3]
+	samples = [("Otto's station", "Temperature", 1600000002), ("Otto's station", "Temperature", 1600000009)]
+	assert adapter.existing_samples(samples) == {samples[0]}
+
+
+def test_migration_removes_stored_duplicates(tmp_path):
+	db_path = str(tmp_path / "measurements.db")
+	adapter = MeasurementsDBAdapter(db_path = db_path, echo = False)
+	adapter.insert_measurements([make_measurement(timestamp = 1600000000 + i) for i in range(3)])
+
+	# A version 4 database, which had no unique index and so could hold re-sent samples.
+	adapter.conn.execute(text("DROP INDEX ux_measurements_sample"))
+	adapter.conn.execute(text("PRAGMA user_version = 4"))
+	adapter.conn.execute(adapter.measurements.insert(), [make_measurement(timestamp = 1600000001, value = 5).dict()])
+	adapter.engine.dispose()
+
+	migrated = MeasurementsDBAdapter(db_path = db_path, echo = False)
+	assert migrated.conn.execute(text("PRAGMA user_version")).scalar() == SCHEMA_VERSION
+	assert [m.value for m in migrated.get_bounded(MeasurementsQuery(key = "Otto's station"))] == [1, 1, 1]
+	assert migrated.insert_measurements([make_measurement(timestamp = 1600000001)]) == 0
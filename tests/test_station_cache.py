@@ -0,0 +1,93 @@
+import json
+from datetime import datetime
+
+from fastapi import FastAPI, Request
+from starlette.testclient import TestClient
+
+from storage.models import LatestStationMeta
+from utils.fast import cached_json_response
+from utils.station_cache import StationListCache
+from test_sqlite_storage_adapter import make_measurement
+
+
+class CountingLoader:
+	def __init__(self, stations):
+		self.stations = stations
+		self.calls = 0
+
+	def __call__(self):
+		self.calls += 1
+		return list(self.stations)
+
+
+def station(key = "a", timestamp = 100, lat = 1.0, lon = 2.0) -> LatestStationMeta:
+	return LatestStationMeta(station_key = key, latest_time = datetime.fromtimestamp(timestamp), lat = lat, lon = lon)
+
+
+def test_representations_are_encoded_once():
+	loader = CountingLoader([station()])
+	cache = StationListCache(load = loader)
+
+	geojson = json.loads(cache.get("geojson").body)
+	assert geojson["features"][0]["geometry"]["coordinates"] == [2.0, 1.0]
+	assert json.loads(cache.get("list").body)[0]["key"] == "a"
+	assert json.loads(cache.get("dicts").body)[0]["station_key"] == "a"
+
+	assert cache.get("geojson") is cache.get("geojson")
+	assert loader.calls == 1
+
+
+def test_ingest_that_does_not_move_a_station_keeps_cache():
+	loader = CountingLoader([station(timestamp = 100, lat = 1.0, lon = 2.0)])
+	cache = StationListCache(load = loader)
+	before = cache.get("dicts")
+
+	cache.notify_ingest([make_measurement(key = "a", timestamp = 50, lat = 9, lon = 9),
+						 make_measurement(key = "a", timestamp = 100, lat = 1.0, lon = 2.0)])
+	assert cache.get("dicts") is before
+
+
+def test_ingest_that_moves_a_station_invalidates():
+	loader = CountingLoader([station(timestamp = 100)])
+	cache = StationListCache(load = loader)
+	before = cache.get("dicts")
+
+	loader.stations = [station(timestamp = 200)]
+	cache.notify_ingest([make_measurement(key = "a", timestamp = 200, lat = 1.0, lon = 2.0)])
+
+	after = cache.get("dicts")
+	assert after.etag != before.etag
+	assert loader.calls == 2
+
+
+def test_new_station_invalidates():
+	cache = StationListCache(load = CountingLoader([station()]))
+	before = cache.get("list")
+	cache.notify_ingest([make_measurement(key = "b")])
+	assert cache.get("list") is not before
+
+
+def test_conditional_requests_get_304():
+	cache = StationListCache(load = CountingLoader([station()]))
+	app = FastAPI()
+
+	@app.get("/stations")
+	def stations(request: Request):
+		cached = cache.get("dicts")
+		return cached_json_response(request, cached.body, cached.etag, cached.last_modified)
+
+	client = TestClient(app)
+	first = client.get("/stations")
+	assert first.status_code == 200
+	assert first.json()[0]["station_key"] == "a"
+
+	etag = first.headers["etag"]
+	not_modified = client.get("/stations", headers = {"If-None-Match": etag})
+	assert not_modified.status_code == 304
+	assert not_modified.content == b""
+
+	# The station list may have changed within the second Last-Modified names.
+	since = client.get("/stations", headers = {"If-Modified-Since": first.headers["last-modified"]})
+	assert since.status_code == 200
+
+	assert client.get("/stations", headers = {"If-None-Match": '"stale"'}).status_code == 200
@@ -0,0 +1,52 @@
+import json
+
+import pytest
+
+from utils.station_cache import StationListCache
+from utils.tiles import StationTileCache, bbox_tiles
+from test_station_cache import CountingLoader, station
+from test_sqlite_storage_adapter import make_measurement
+
+
+def features(body:bytes):
+	return json.loads(body)["features"]
+
+
+def test_nearby_stations_cluster_until_zoomed_in():
+	stations = [station(key = "a", lat = 10.0, lon = 20.0), station(key = "b", lat = 10.01, lon = 20.01),
+				station(key = "c", lat = -40.0, lon = -70.0)]
+	tiles = StationTileCache(StationListCache(load = CountingLoader(stations)))
+
+	world = features(tiles.tile(0, 0, 0)[0])
+	assert sorted(f["properties"]["count"] for f in world) == [1, 2]
+	cluster = next(f for f in world if f["properties"]["cluster"])
+	assert cluster["geometry"]["coordinates"] == pytest.approx([20.005, 10.005])
+
+	close = features(tiles.bbox(9.99, 10.02, 19.99, 20.02, 12)[0])
+	assert sorted(f["properties"]["key"] for f in close) == ["a", "b"]
+	assert all(not f["properties"]["cluster"] for f in close)
+
+
+def test_tiles_are_cached_until_a_station_moves():
+	loader = CountingLoader([station(key = "a", timestamp = 100, lat = 1.0, lon = 2.0)])
+	station_cache = StationListCache(load = loader)
+	tiles = StationTileCache(station_cache)
+
+	body, etag, _ = tiles.tile(2, 2, 1)
+	assert len(features(body)) == 1
+	assert tiles.tile(2, 2, 1)[1] == etag
+	assert loader.calls == 1
+
+	loader.stations = [station(key = "a", timestamp = 200, lat = -60.0, lon = 2.0)]
+	station_cache.notify_ingest([make_measurement(key = "a", timestamp = 200, lat = -60.0, lon = 2.0)])
+	assert features(tiles.tile(2, 2, 1)[0]) == []
+	assert loader.calls == 2
+
+
+def test_bbox_tiles():
+	assert bbox_tiles(-10, 10, -10, 10, 0) == [(0, 0)]
+	assert bbox_tiles(-10, 10, -10, 10, 1) == [(0, 0), (0, 1), (1, 0), (1, 1)]
+	with pytest.raises(ValueError):
+		bbox_tiles(10, -10, 0, 1, 1)
+	with pytest.raises(ValueError):
+		bbox_tiles(-80, 80, -180, 180, 10)
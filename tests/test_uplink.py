@@ -0,0 +1,82 @@
+import gzip
+import json
+
+import requests
+
+from misc.serial_to_server import ChannelPayload, IOTStationUplink
+
+
+class FakeResponse:
+	def __init__(self, status_code):
+		self.status_code = status_code
+		self.text = ""
+
+
+class FakeSession:
+	def __init__(self):
+		self.up = True
+		self.batches = []
+
+	def post(self, url, data, headers, timeout):
+		if not self.up:
+			raise requests.ConnectionError("link down")
+		if headers.get("Content-Encoding") == "gzip":
+			data = gzip.decompress(data)
+		if headers["Content-Type"] == "application/msgpack":
+			import msgpack
+			frames = msgpack.unpackb(data)["frames"]
+		else:
+			frames = json.loads(data)["frames"]
+		self.batches.append([f["timestamp"] for f in frames])
+		return FakeResponse(200)
+
+
+def make_uplink(tmp_path, session, **kwargs) -> IOTStationUplink:
+	return IOTStationUplink(key = "buoy", lat = 1.0, lon = 2.0, spool_path = str(tmp_path / "spool.jsonl"),
+							session = session, flush_interval = 0.05, **kwargs)
+
+
+def channels():
+	return [ChannelPayload(measurement_name = "Temperature", unit = "C", value = 20)]
+
+
+def test_frames_are_sent_in_batches(tmp_path):
+	session = FakeSession()
+	uplink = make_uplink(tmp_path, session, batch_size = 3, compress = True)
+	for t in range(7):
+		uplink.post_frame(channels(), time_stamp = t)
+	uplink.close()
+
+	assert [t for batch in session.batches for t in batch] == list(range(7))
+	assert max(len(batch) for batch in session.batches) <= 3
+
+
+def test_frames_are_spooled_while_offline_and_replayed(tmp_path):
+	session = FakeSession()
+	session.up = False
+	uplink = make_uplink(tmp_path, session, retry_interval = 0)
+	for t in range(3):
+		uplink.post_frame(channels(), time_stamp = t)
+	uplink.close()
+	assert session.batches == []
+	assert len((tmp_path / "spool.jsonl").read_text().splitlines()) == 3
+
+	session.up = True
+	uplink = make_uplink(tmp_path, session, retry_interval = 0)
+	uplink.post_frame(channels(), time_stamp = 3)
+	uplink.close()
+
+	assert sorted(t for batch in session.batches for t in batch) == [0, 1, 2, 3]
+	assert not (tmp_path / "spool.jsonl").exists() or (tmp_path / "spool.jsonl").read_text() == ""
+	assert not (tmp_path / "spool.jsonl.replay").exists()
+
+
+def test_full_queue_spools_instead_of_blocking(tmp_path):
+	session = FakeSession()
+	session.up = False
+	uplink = make_uplink(tmp_path, session, max_pending = 1, retry_interval = 60)
+	for t in range(50):
+		uplink.post_frame(channels(), time_stamp = t)
+	uplink.close()
+	spooled = [json.loads(line)["timestamp"] for line in (tmp_path / "spool.jsonl").read_text().splitlines()]
+	assert sorted(spooled) == list(range(50))
@@ -0,0 +1,101 @@
+import json
+import threading
+import time
+
+import pytest
+
+from storage.write_behind import WriteBehindQueue, QueueFullError
+from test_sqlite_storage_adapter import make_measurement
+
+
+def test_flushes_when_flush_size_reached():
+	written = []
+	flushed = threading.Event()
+
+	def sink(batch):
+		written.extend(batch)
+		flushed.set()
+
+	queue = WriteBehindQueue(sink = sink, max_size = 100, flush_size = 3, flush_interval = 60)
+	queue.put([make_measurement(timestamp = t) for t in range(3)])
+
+	assert flushed.wait(5)
+	assert len(written) == 3
+	queue.close()
+
+
+def test_flushes_after_flush_interval():
+	written = []
+	queue = WriteBehindQueue(sink = written.extend, max_size = 100, flush_size = 100, flush_interval = 0.05)
+	queue.put([make_measurement()])
+
+	deadline = time.time() + 5
+	while not written and time.time() < deadline:
+		time.sleep(0.01)
+	assert len(written) == 1
+	assert queue.depth == 0
+	queue.close()
+
+
+def test_rejects_writes_beyond_capacity():
+	release = threading.Event()
+	queue = WriteBehindQueue(sink = lambda batch: release.wait(5), max_size = 2, flush_size = 100, flush_interval = 60)
+
+	queue.put([make_measurement(), make_measurement()])
+	with pytest.raises(QueueFullError):
+		queue.put([make_measurement()])
+	assert queue.depth == 2
+
+	release.set()
+	queue.close()
+
+
+def test_close_flushes_pending():
+	written = []
+	queue = WriteBehindQueue(sink = written.extend, max_size = 100, flush_size = 100, flush_interval = 60)
+	queue.put([make_measurement(timestamp = t) for t in range(10)])
+
+	queue.close()
+	assert len(written) == 10
+	assert queue.depth == 0
+	with pytest.raises(QueueFullError):
+		queue.put([make_measurement()])
+
+
+def test_failed_flush_is_retried():
+	written = []
+	attempts = []
+
+	def flaky_sink(batch):
+		attempts.append(len(batch))
+		if len(attempts) == 1:
+			raise IOError("disk unavailable")
+		written.extend(batch)
+
+	queue = WriteBehindQueue(sink = flaky_sink, max_size = 100, flush_size = 1, flush_interval = 60, retry_interval = 0.01)
+	queue.put([make_measurement()])
+	queue.close()
+
+	assert attempts == [1, 1]
+	assert len(written) == 1
+
+
+def test_batch_failing_every_retry_is_dead_lettered(tmp_path):
+	written = []
+
+	def sink(batch):
+		if any(m.key == "poison" for m in batch):
+			raise ValueError("cannot store this")
+		written.extend(batch)
+
+	dead_letter = tmp_path / "dead" / "letter.ndjson"
+	queue = WriteBehindQueue(sink = sink, flush_size = 3, flush_interval = 60, retry_interval = 0.01,
+							 max_retries = 2, dead_letter_path = str(dead_letter))
+	queue.put([make_measurement(key = "a")])
+	queue.put([make_measurement(key = "poison")])
+	queue.put([make_measurement(key = "b")])
+	queue.close()
+
+	assert [m.key for m in written] == ["a", "b"]
+	assert [json.loads(line)["key"] for line in dead_letter.read_text().splitlines()] == ["poison"]
+	assert queue.depth == 0 and queue.dead_lettered == 1
@@ -1,7 +1,9 @@
 
 import fastapi
 import urllib
+from email.utils import formatdate
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response
 from typing import Dict
 
 def enable_cors(app:fastapi.FastAPI):
@@ -9,4 +11,27 @@ def enable_cors(app:fastapi.FastAPI):
     	allow_origins = ["*"],
         allow_methods = ["*"],
         allow_headers = ["*"],
+        expose_headers = ["X-Next-Cursor"],
         allow_credentials = True)
+
+
+def cached_json_response(request:fastapi.Request, body:bytes, etag:str, last_modified:float) -> Response:
+	"""
+	Serves pre-encoded JSON with ETag/Last-Modified validators, answering 304 with no body when the client's copy is current.
+
+	Only If-None-Match can earn a 304. Last-Modified has whole second resolution, so a change within the second
+	of an earlier response would go unnoticed by a client revalidating with If-Modified-Since.
+	"""
+	headers = {"ETag": etag,
+			   "Last-Modified": formatdate(last_modified, usegmt = True),
+			   "Cache-Control": "no-cache"}
+
+	if_none_match = request.headers.get("if-none-match")
+	if if_none_match is not None:
+		not_modified = etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*"
+	else:
+		not_modified = False
+
+	if not_modified:
+		return Response(status_code = 304, headers = headers)
+	return Response(content = body, media_type = "application/json", headers = headers)
@@ -0,0 +1,131 @@
+"""
+Fans newly stored measurements out to live subscribers. Ingest publishes from the write-behind flusher
+thread; each subscriber reads from its own bounded buffer on the event loop.
+"""
+import asyncio
+import threading
+from collections import deque
+from typing import Deque, List, Optional, Set, Tuple
+
+from storage.models import Measurement
+
+
+class Subscription:
+	def __init__(self, hub:"LiveHub", loop:asyncio.AbstractEventLoop, buffer_size:int,
+				 key:Optional[str] = None,
+				 measurement_name:Optional[str] = None,
+				 lats:Optional[Tuple[float, float]] = None,
+				 lons:Optional[Tuple[float, float]] = None):
+		"""
+		Measurements matching every filter given, buffered until read. Once more than `buffer_size`
+		measurements are waiting the subscription is dropped, so a slow reader never holds up ingest.
+		"""
+		self.hub = hub
+		self.loop = loop
+		self.buffer_size = buffer_size
+		self.key = key
+		self.measurement_name = measurement_name
+		# Sorted, and matched exclusive of the edges, as bounded storage queries do.
+		self.lats = None if lats is None else tuple(sorted(lats))
+		self.lons = None if lons is None else tuple(sorted(lons))
+
+		self.closed = False
+		self.overflowed = False
+		self._batches:Deque[List[Measurement]] = deque()
+		self._buffered = 0
+		self._wakeup = asyncio.Event()
+
+	def matches(self, m:Measurement) -> bool:
+		return (self.key is None or m.key == self.key) and \
+			   (self.measurement_name is None or m.measurement_name == self.measurement_name) and \
+			   (self.lats is None or self.lats[0] < m.latitude < self.lats[1]) and \
+			   (self.lons is None or self.lons[0] < m.longitude < self.lons[1])
+
+	def __deliver__(self, batch:List[Measurement]) -> None:
+		# Runs on the event loop.
+		if self.closed:
+			return
+		if self._buffered + len(batch) > self.buffer_size:
+			self.overflowed = True
+			self.hub.__drop__(self)
+			self.close()
+			return
+		self._batches.append(batch)
+		self._buffered += len(batch)
+		self._wakeup.set()
+
+	def close(self) -> None:
+		# Runs on the event loop.
+		self.closed = True
+		self._batches.clear()
+		self._wakeup.set()
+
+	async def get(self) -> Optional[List[Measurement]]:
+		"""
+		The next batch of measurements, or None once the subscription is closed.
+		"""
+		while not self._batches and not self.closed:
+			self._wakeup.clear()
+			await self._wakeup.wait()
+		if self.closed:
+			return None
+		batch = self._batches.popleft()
+		self._buffered -= len(batch)
+		return batch
+
+
+class LiveHub:
+	def __init__(self, buffer_size:int = 10000, max_subscribers:int = 1000):
+		"""
+		buffer_size      Measurements a subscriber may fall behind by before it is dropped.
+		max_subscribers  `subscribe` raises ValueError beyond this.
+		"""
+		self.buffer_size = buffer_size
+		self.max_subscribers = max_subscribers
+		self.dropped = 0
+
+		self._lock = threading.Lock()
+		self._subscriptions:Set[Subscription] = set()
+
+	def __len__(self) -> int:
+		return len(self._subscriptions)
+
+	def subscribe(self, **filters) -> Subscription:
+		"""
+		Must be called from the event loop the subscription will be read on. Takes the filters of `Subscription`.
+		"""
+		subscription = Subscription(self, asyncio.get_running_loop(), self.buffer_size, **filters)
+		with self._lock:
+			if len(self._subscriptions) >= self.max_subscribers:
+				raise ValueError(f"Too many live subscribers ({self.max_subscribers})")
+			self._subscriptions.add(subscription)
+		return subscription
+
+	def unsubscribe(self, subscription:Subscription) -> None:
+		with self._lock:
+			self._subscriptions.discard(subscription)
+
+	def __drop__(self, subscription:Subscription) -> None:
+		with self._lock:
+			if subscription in self._subscriptions:
+				self._subscriptions.discard(subscription)
+				self.dropped += 1
+
+	def publish(self, measurements:List[Measurement]) -> None:
+		"""
+		Hands every subscriber the measurements it matches. Safe to call from any thread and never blocks on
+		a subscriber: delivery is scheduled on the subscriber's loop, and overflowing subscribers are dropped.
+		"""
+		if not self._subscriptions:
+			return
+		with self._lock:
+			subscriptions = list(self._subscriptions)
+
+		for subscription in subscriptions:
+			batch = [m for m in measurements if subscription.matches(m)]
+			if batch:
+				try:
+					subscription.loop.call_soon_threadsafe(subscription.__deliver__, batch)
+				except RuntimeError:
+					# The loop is closed, nobody is reading any more.
+					self.unsubscribe(subscription)
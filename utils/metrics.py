@@ -0,0 +1,210 @@
+"""
+Counters, gauges and histograms rendered in the Prometheus text exposition format, plus the SQLAlchemy
+hooks that time every statement and count pooled connections.
+"""
+import bisect
+import logging
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+slow_query_logger = logging.getLogger("storage.slow_queries")
+
+
+def _escape(value:str) -> str:
+	return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(names:Sequence[str], values:Sequence[str], extra:str = "") -> str:
+	pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+	if extra:
+		pairs.append(extra)
+	return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value:float) -> str:
+	if value == float("inf"):
+		return "+Inf"
+	return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Counter:
+	def __init__(self, name:str, help:str, labels:Sequence[str] = ()):
+		self.name = name
+		self.help = help
+		self.labels = tuple(labels)
+		self._values:Dict[Tuple[str, ...], float] = {}
+		self._lock = threading.Lock()
+
+	def inc(self, *labels:str, amount:float = 1) -> None:
+		with self._lock:
+			self._values[labels] = self._values.get(labels, 0) + amount
+
+	def value(self, *labels:str) -> float:
+		return self._values.get(labels, 0)
+
+	def render(self) -> List[str]:
+		with self._lock:
+			values = sorted(self._values.items())
+		lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+		lines += [f"{self.name}{_labels(self.labels, labels)} {_number(value)}" for labels, value in values]
+		return lines
+
+
+class Gauge:
+	def __init__(self, name:str, help:str, read:Callable[[], float]):
+		"""
+		Reports whatever `read` returns at scrape time.
+		"""
+		self.name = name
+		self.help = help
+		self.read = read
+
+	def render(self) -> List[str]:
+		return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {_number(self.read())}"]
+
+
+class Histogram:
+	def __init__(self, name:str, help:str, labels:Sequence[str] = (), buckets:Sequence[float] = DEFAULT_BUCKETS):
+		self.name = name
+		self.help = help
+		self.labels = tuple(labels)
+		self.buckets = tuple(sorted(buckets))
+		# labels -> (count per bucket, sum, count)
+		self._series:Dict[Tuple[str, ...], List] = {}
+		self._lock = threading.Lock()
+
+	def observe(self, value:float, *labels:str) -> None:
+		i = bisect.bisect_left(self.buckets, value)
+		with self._lock:
+			series = self._series.get(labels)
+			if series is None:
+				series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+			if i < len(self.buckets):
+				series[0][i] += 1
+			series[1] += value
+			series[2] += 1
+
+	def count(self, *labels:str) -> int:
+		series = self._series.get(labels)
+		return series[2] if series is not None else 0
+
+	def render(self) -> List[str]:
+		with self._lock:
+			snapshot = sorted((labels, (list(s[0]), s[1], s[2])) for labels, s in self._series.items())
+		lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+		for labels, (buckets, total, count) in snapshot:
+			cumulative = 0
+			for bound, n in zip(self.buckets, buckets):
+				cumulative += n
+				le = 'le="' + _number(bound) + '"'
+				lines.append(f"{self.name}_bucket{_labels(self.labels, labels, le)} {cumulative}")
+			le = 'le="+Inf"'
+			lines.append(f"{self.name}_bucket{_labels(self.labels, labels, le)} {count}")
+			lines.append(f"{self.name}_sum{_labels(self.labels, labels)} {_number(total)}")
+			lines.append(f"{self.name}_count{_labels(self.labels, labels)} {count}")
+		return lines
+
+
+class RateMeter:
+	def __init__(self, window:float = 60):
+		"""
+		Events per second over the last `window` seconds.
+		"""
+		self.window = window
+		self._events:Deque[Tuple[float, float]] = deque()
+		self._lock = threading.Lock()
+
+	def add(self, amount:float) -> None:
+		now = time.monotonic()
+		with self._lock:
+			self._events.append((now, amount))
+			self.__expire__(now)
+
+	def __expire__(self, now:float) -> None:
+		while self._events and self._events[0][0] < now - self.window:
+			self._events.popleft()
+
+	def rate(self) -> float:
+		with self._lock:
+			self.__expire__(time.monotonic())
+			return sum(amount for _, amount in self._events) / self.window
+
+
+class MetricsRegistry:
+	def __init__(self):
+		self._metrics:List = []
+
+	def register(self, metric):
+		self._metrics.append(metric)
+		return metric
+
+	def counter(self, name:str, help:str, labels:Sequence[str] = ()) -> Counter:
+		return self.register(Counter(name, help, labels))
+
+	def gauge(self, name:str, help:str, read:Callable[[], float]) -> Gauge:
+		return self.register(Gauge(name, help, read))
+
+	def histogram(self, name:str, help:str, labels:Sequence[str] = (), buckets:Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+		return self.register(Histogram(name, help, labels, buckets))
+
+	def render(self) -> str:
+		return "\n".join(line for metric in self._metrics for line in metric.render()) + "\n"
+
+
+def instrument_sqlalchemy(registry:MetricsRegistry, slow_query_seconds:Optional[float] = None, engine = Engine) -> None:
+	"""
+	Times every statement into `storage_query_duration_seconds`, labelled by statement kind, and counts
+	pooled connections. Statements slower than `slow_query_seconds` are logged to the "storage.slow_queries"
+	logger at WARNING.
+
+	engine  One engine, or by default the Engine class, which covers every engine including those partitions
+			create later.
+	"""
+	pool = Pool if engine is Engine else engine
+	durations = registry.histogram("storage_query_duration_seconds", "Duration of storage SQL statements.",
+								   labels = ["statement"])
+	opened = registry.counter("storage_connections_opened_total", "Database connections opened.")
+	checked_out = [0]
+	lock = threading.Lock()
+	registry.gauge("storage_connections_checked_out", "Database connections currently in use.", lambda: checked_out[0])
+
+	@event.listens_for(engine, "before_cursor_execute")
+	def start_timer(conn, cursor, statement, parameters, context, executemany):
+		conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+	@event.listens_for(engine, "after_cursor_execute")
+	def stop_timer(conn, cursor, statement, parameters, context, executemany):
+		elapsed = time.perf_counter() - conn.info["query_start"].pop()
+		kind = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+		durations.observe(elapsed, kind)
+		if slow_query_seconds is not None and elapsed >= slow_query_seconds:
+			slow_query_logger.warning("%.3f s%s: %s", elapsed, " (executemany)" if executemany else "",
+									  " ".join(statement.split())[:2000])
+
+	@event.listens_for(engine, "handle_error")
+	def drop_timer(context):
+		starts = context.connection.info.get("query_start") if context.connection is not None else None
+		if starts:
+			starts.pop()
+
+	@event.listens_for(pool, "connect")
+	def on_connect(dbapi_connection, connection_record):
+		opened.inc()
+
+	@event.listens_for(pool, "checkout")
+	def on_checkout(dbapi_connection, connection_record, connection_proxy):
+		with lock:
+			checked_out[0] += 1
+
+	@event.listens_for(pool, "checkin")
+	def on_checkin(dbapi_connection, connection_record):
+		with lock:
+			checked_out[0] -= 1
@@ -0,0 +1,67 @@
+"""
+Encodes MeasurementRecord tuples straight to JSON bytes, producing the same documents FastAPI produces
+for a `Measurement`:
+
+	{"key": ..., "measurement_name": ..., "unit": ..., "value": <float>, "timestamp": "<local ISO 8601>",
+	 "receipt_time": "<local ISO 8601>", "latitude": ..., "longitude": ..., "hardware": ...}
+
+Uses orjson when it is installed and the standard library otherwise.
+"""
+import json
+from datetime import datetime
+from typing import Dict, Iterable, List
+
+from storage.models import MeasurementRecord
+
+try:
+	import orjson
+except ImportError:
+	orjson = None
+
+
+def records_to_dicts(records:Iterable[MeasurementRecord]) -> List[Dict]:
+	# Frames share timestamps across channels, so each distinct one is converted once.
+	datetimes:Dict[int, datetime] = {}
+
+	def to_datetime(epoch:int) -> datetime:
+		converted = datetimes.get(epoch)
+		if converted is None:
+			converted = datetimes[epoch] = datetime.fromtimestamp(epoch)
+		return converted
+
+	return [{"key": key,
+			 "measurement_name": measurement_name,
+			 "unit": unit,
+			 "value": float(value),
+			 "timestamp": to_datetime(timestamp),
+			 "receipt_time": to_datetime(receipt_time),
+			 "latitude": latitude,
+			 "longitude": longitude,
+			 "hardware": hardware}
+			for key, measurement_name, unit, value, timestamp, receipt_time, latitude, longitude, hardware in records]
+
+
+def _default(obj):
+	if isinstance(obj, datetime):
+		return obj.isoformat()
+	raise TypeError(f"{type(obj).__name__} is not JSON serializable")
+
+
+def records_to_json(records:Iterable[MeasurementRecord]) -> bytes:
+	"""
+	A JSON array of the records.
+	"""
+	dicts = records_to_dicts(records)
+	if orjson is not None:
+		return orjson.dumps(dicts)
+	return json.dumps(dicts, separators = (",", ":"), default = _default).encode("utf-8")
+
+
+def records_to_ndjson(records:Iterable[MeasurementRecord]) -> bytes:
+	"""
+	One JSON object per record, each followed by a newline.
+	"""
+	dicts = records_to_dicts(records)
+	if orjson is not None:
+		return b"".join(orjson.dumps(d) + b"\n" for d in dicts)
+	return "".join(json.dumps(d, separators = (",", ":"), default = _default) + "\n" for d in dicts).encode("utf-8")
@@ -0,0 +1,123 @@
+import hashlib
+import json
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel
+
+from storage.models import LatestStationMeta, Measurement
+from utils.geojson_models import GeoJSONFeature, GeoJSONFeatureCollection, PointGeometry
+
+
+class CachedJSON(BaseModel):
+	body: bytes
+	etag: str
+	last_modified: float
+
+
+def stations_to_list(stations:List[LatestStationMeta]):
+	return [dict(key = s.station_key, lat = s.lat, lon = s.lon, latest = s.latest_time) for s in stations]
+
+
+def stations_to_dicts(stations:List[LatestStationMeta]):
+	return [s.dict() for s in stations]
+
+
+def stations_to_geojson(stations:List[LatestStationMeta]):
+	features:List[GeoJSONFeature] = []
+	for station in stations:
+		point_geom = PointGeometry(coordinates = [station.lon, station.lat])
+		features.append(GeoJSONFeature(properties = dict(key = station.station_key), geometry = point_geom))
+	return GeoJSONFeatureCollection(features = features)
+
+
+REPRESENTATIONS:Dict[str, Callable] = {"list": stations_to_list,
+									   "dicts": stations_to_dicts,
+									   "geojson": stations_to_geojson}
+
+
+class StationListCache:
+	def __init__(self, load:Callable[[], Iterable[LatestStationMeta]]):
+		"""
+		Holds the station listings as encoded JSON bytes, one per representation in REPRESENTATIONS.
+
+		load  Returns every station's latest position, e.g. `MeasurementsDBAdapter.get_stations`.
+
+		The cache is dropped only when `notify_ingest` sees a measurement that moves a station's latest
+		time or position, or introduces a new station.
+		"""
+		self.load = load
+
+		self._lock = threading.Lock()
+		self._generation = 0
+		self._last_modified = time.time()
+		# station key -> (latest time, lat, lon) as of the last load
+		self._latest:Optional[Dict[str, Tuple]] = None
+		self._stations:Optional[List[LatestStationMeta]] = None
+		self._entries:Dict[str, CachedJSON] = {}
+
+	def stations(self) -> Tuple[int, float, List[LatestStationMeta]]:
+		"""
+		Returns the current station list with its generation, which changes on every invalidation,
+		and the time it last changed. Other caches derived from the list key on the generation.
+		"""
+		with self._lock:
+			generation = self._generation
+			last_modified = self._last_modified
+			stations = self._stations
+		if stations is not None:
+			return generation, last_modified, stations
+
+		stations = list(self.load())
+		with self._lock:
+			# An ingest invalidated the cache while we were loading; use the list but don't keep it.
+			if generation == self._generation:
+				self._stations = stations
+				self._latest = {s.station_key: (s.latest_time, s.lat, s.lon) for s in stations}
+		return generation, last_modified, stations
+
+	def get(self, representation:str) -> CachedJSON:
+		with self._lock:
+			entry = self._entries.get(representation)
+			if entry is not None:
+				return entry
+
+		generation, last_modified, stations = self.stations()
+
+		content = jsonable_encoder(REPRESENTATIONS[representation](stations))
+		body = json.dumps(content, separators = (",", ":")).encode("utf-8")
+		entry = CachedJSON(body = body,
+						   etag = '"' + hashlib.sha1(body).hexdigest() + '"',
+						   last_modified = last_modified)
+
+		with self._lock:
+			if generation == self._generation:
+				self._entries[representation] = entry
+		return entry
+
+	def invalidate(self) -> None:
+		with self._lock:
+			self._generation += 1
+			self._last_modified = time.time()
+			self._latest = None
+			self._stations = None
+			self._entries = {}
+
+	def notify_ingest(self, measurements:Iterable[Measurement]) -> None:
+		"""
+		Called with every batch written to storage. Invalidates the cache if the batch changes any station listing.
+		"""
+		with self._lock:
+			latest = self._latest
+			if latest is None:
+				# Nothing cached, but a listing may be loading right now; make sure it isn't kept.
+				self._generation += 1
+				return
+
+		for m in measurements:
+			current = latest.get(m.key)
+			if current is None or (m.timestamp >= current[0] and (m.timestamp, m.latitude, m.longitude) != current):
+				self.invalidate()
+				return
@@ -0,0 +1,168 @@
+"""
+Clustered station GeoJSON per Web Mercator tile (the z/x/y scheme of OSM and Leaflet).
+
+Each tile is divided into a GRID x GRID raster of cells. Stations that share a cell are returned as one
+cluster feature at their mean position; a cell holding a single station is returned as that station:
+
+	{"type": "Feature", "geometry": {...}, "properties": {"cluster": true, "count": 12}}
+	{"type": "Feature", "geometry": {...}, "properties": {"cluster": false, "count": 1, "key": "buoy 3"}}
+
+Cell coordinates are computed once per station list at MAX_ZOOM; the cells of a coarser zoom are a bit shift away.
+"""
+import hashlib
+import json
+import math
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from utils.station_cache import StationListCache
+
+MAX_ZOOM = 20
+GRID_BITS = 3
+GRID = 1 << GRID_BITS
+MAX_LAT = 85.0511287798
+MAX_BBOX_TILES = 256
+
+FEATURE_COLLECTION_PREFIX = b'{"type":"FeatureCollection","features":['
+FEATURE_COLLECTION_SUFFIX = b']}'
+
+
+def lon_to_x(lon:np.ndarray) -> np.ndarray:
+	return np.clip((np.asarray(lon, dtype = np.float64) + 180.0) / 360.0, 0.0, 1.0 - 1e-12)
+
+
+def lat_to_y(lat:np.ndarray) -> np.ndarray:
+	lat = np.radians(np.clip(np.asarray(lat, dtype = np.float64), -MAX_LAT, MAX_LAT))
+	return np.clip((1.0 - np.log(np.tan(lat) + 1.0 / np.cos(lat)) / math.pi) / 2.0, 0.0, 1.0 - 1e-12)
+
+
+def bbox_tiles(min_lat:float, max_lat:float, min_lon:float, max_lon:float, zoom:int) -> List[Tuple[int, int]]:
+	"""
+	The (x, y) of every tile at `zoom` that intersects the box. Raises ValueError for an inverted box or
+	one that needs more than MAX_BBOX_TILES tiles.
+	"""
+	if min_lat > max_lat or min_lon > max_lon:
+		raise ValueError("min_lat/min_lon must not exceed max_lat/max_lon")
+	n = 1 << zoom
+	x0, x1 = (int(v * n) for v in lon_to_x([min_lon, max_lon]))
+	# y grows southwards
+	y0, y1 = (int(v * n) for v in lat_to_y([max_lat, min_lat]))
+	if (x1 - x0 + 1) * (y1 - y0 + 1) > MAX_BBOX_TILES:
+		raise ValueError(f"box covers more than {MAX_BBOX_TILES} tiles at zoom {zoom}, use a lower zoom")
+	return [(x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+
+class StationGrid:
+	def __init__(self, keys:List[str], lats:np.ndarray, lons:np.ndarray):
+		"""
+		Station positions and their cell coordinates at MAX_ZOOM.
+		"""
+		self.keys = keys
+		self.lats = lats
+		self.lons = lons
+		scale = float(1 << (MAX_ZOOM + GRID_BITS))
+		self.cx = (lon_to_x(lons) * scale).astype(np.int64)
+		self.cy = (lat_to_y(lats) * scale).astype(np.int64)
+
+	def tile_features(self, z:int, x:int, y:int) -> List[Dict]:
+		shift = MAX_ZOOM - z
+		cx = self.cx >> shift
+		cy = self.cy >> shift
+		inside = np.flatnonzero(((cx >> GRID_BITS) == x) & ((cy >> GRID_BITS) == y))
+		if len(inside) == 0:
+			return []
+
+		cells = (cx[inside] & (GRID - 1)) * GRID + (cy[inside] & (GRID - 1))
+		_, first, inverse, counts = np.unique(cells, return_index = True, return_inverse = True, return_counts = True)
+		lats = np.bincount(inverse, weights = self.lats[inside]) / counts
+		lons = np.bincount(inverse, weights = self.lons[inside]) / counts
+
+		features = []
+		for i, count in enumerate(counts.tolist()):
+			properties = dict(cluster = count > 1, count = count)
+			if count == 1:
+				properties["key"] = self.keys[inside[first[i]]]
+			features.append(dict(type = "Feature",
+								 geometry = dict(type = "Point", coordinates = [float(lons[i]), float(lats[i])]),
+								 properties = properties))
+		return features
+
+
+class StationTileCache:
+	def __init__(self, stations:StationListCache, max_tiles:int = 4096):
+		"""
+		Encoded cluster features per tile, rebuilt from `stations` whenever its generation changes.
+
+		stations   The station list cache; its invalidation on ingest drops every tile.
+		max_tiles  Least recently used tiles beyond this are evicted.
+		"""
+		self.stations = stations
+		self.max_tiles = max_tiles
+
+		self._lock = threading.Lock()
+		self._generation:Optional[int] = None
+		self._last_modified = 0.0
+		self._grid:Optional[StationGrid] = None
+		# (z, x, y) -> (comma separated encoded features, etag)
+		self._tiles:"OrderedDict[Tuple[int, int, int], Tuple[bytes, str]]" = OrderedDict()
+
+	def _current(self) -> Tuple[int, float, StationGrid]:
+		generation, last_modified, stations = self.stations.stations()
+		with self._lock:
+			if generation == self._generation:
+				return generation, self._last_modified, self._grid
+
+		grid = StationGrid(keys = [s.station_key for s in stations],
+						   lats = np.array([s.lat for s in stations], dtype = np.float64),
+						   lons = np.array([s.lon for s in stations], dtype = np.float64))
+		with self._lock:
+			if self._generation is None or generation > self._generation:
+				self._generation = generation
+				self._last_modified = last_modified
+				self._grid = grid
+				self._tiles = OrderedDict()
+		return generation, last_modified, grid
+
+	def _fragment(self, z:int, x:int, y:int) -> Tuple[bytes, str]:
+		generation, _, grid = self._current()
+		with self._lock:
+			entry = self._tiles.get((z, x, y)) if generation == self._generation else None
+			if entry is not None:
+				self._tiles.move_to_end((z, x, y))
+				return entry
+
+		features = grid.tile_features(z, x, y)
+		fragment = b",".join(json.dumps(f, separators = (",", ":")).encode("utf-8") for f in features)
+		entry = (fragment, '"' + hashlib.sha1(fragment).hexdigest() + '"')
+
+		with self._lock:
+			if generation == self._generation:
+				self._tiles[(z, x, y)] = entry
+				while len(self._tiles) > self.max_tiles:
+					self._tiles.popitem(last = False)
+		return entry
+
+	def tile(self, z:int, x:int, y:int) -> Tuple[bytes, str, float]:
+		"""
+		Returns the FeatureCollection of one tile as (body, etag, last modified). Raises ValueError for
+		a tile outside the map or beyond MAX_ZOOM.
+		"""
+		if not 0 <= z <= MAX_ZOOM or not 0 <= x < (1 << z) or not 0 <= y < (1 << z):
+			raise ValueError(f"no tile {z}/{x}/{y}, zoom must be in [0, {MAX_ZOOM}]")
+		fragment, etag = self._fragment(z, x, y)
+		return FEATURE_COLLECTION_PREFIX + fragment + FEATURE_COLLECTION_SUFFIX, etag, self._last_modified
+
+	def bbox(self, min_lat:float, max_lat:float, min_lon:float, max_lon:float, zoom:int) -> Tuple[bytes, str, float]:
+		"""
+		Joins the tiles covering the box into one FeatureCollection. Whole tiles are returned, so features
+		may lie slightly outside the box; that is what lets a panned viewport reuse the cached tiles.
+		"""
+		if not 0 <= zoom <= MAX_ZOOM:
+			raise ValueError(f"zoom must be in [0, {MAX_ZOOM}]")
+		entries = [self._fragment(zoom, x, y) for x, y in bbox_tiles(min_lat, max_lat, min_lon, max_lon, zoom)]
+		fragments = [fragment for fragment, _ in entries if fragment]
+		etag = '"' + hashlib.sha1("".join(e for _, e in entries).encode("ascii")).hexdigest() + '"'
+		return FEATURE_COLLECTION_PREFIX + b",".join(fragments) + FEATURE_COLLECTION_SUFFIX, etag, self._last_modified